@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the Enhanced Image Analysis MCP Server
+
+Generates a deterministic synthetic corpus, times server startup to the first
+``tools/list`` answer, each analysis stage per file and each tool end to end, and
+writes the results as JSON. Pass a saved baseline to fail on regressions:
+
+    python benchmark.py                                   # writes benchmark_results.json
+    python benchmark.py --save-baseline baseline.json     # record a baseline
+    python benchmark.py --baseline baseline.json          # exit 1 if anything regressed
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from queue import Empty
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Bump whenever the generator changes, so stale corpora are rebuilt
+CORPUS_VERSION = 1
+SEED = 20240601
+# A tool still running after this long is stopped and reported as failed
+TOOL_TIMEOUT_SECONDS = 1800
+
+SAVE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.gif': 'GIF', '.bmp': 'BMP', '.tiff': 'TIFF', '.webp': 'WEBP'}
+EXIF_FORMATS = {'JPEG', 'PNG', 'TIFF', 'WEBP'}
+SIZE_TIERS = {
+    'icon': (32, 32),
+    'small': (640, 480),
+    'medium': (1920, 1080),
+    'large': (4032, 3024),
+    'huge': (8660, 5774),  # 50 MP
+}
+# Formats generated at the huge tier; uncompressed 50 MP BMP/TIFF files would add 600 MB
+HUGE_FORMATS = {'.jpg', '.png', '.webp'}
+STAGES = ['open', 'decode', 'colour', 'exif', 'hashes', 'features', 'naming']
+
+
+def synthetic_image(rng: random.Random, size: Tuple[int, int], mode: str = 'RGB') -> Image.Image:
+    """Gradients plus random shapes: enough structure for colours, hashes and compression to behave like photos."""
+    width, height = size
+    channels = [Image.linear_gradient('L').rotate(rng.choice([0, 90, 180, 270])).resize(size) for _ in range(3)]
+    img = Image.merge('RGB', channels)
+    draw = ImageDraw.Draw(img)
+    for _ in range(rng.randint(6, 24)):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randint(1, max(1, width // 3)), rng.randint(1, max(1, height // 3))
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)([x, y, x + w, y + h], fill=fill)
+    return img.convert(mode) if mode != 'RGB' else img
+
+
+def camera_exif(rng: random.Random) -> Image.Exif:
+    exif = Image.Exif()
+    exif[0x010F] = rng.choice(['Canon', 'NIKON CORPORATION', 'Apple'])
+    exif[0x0110] = rng.choice(['EOS R5', 'Z 6', 'iPhone 15 Pro'])
+    exif[0x0132] = f"2024:{rng.randint(1, 12):02d}:{rng.randint(1, 28):02d} 12:00:00"
+    exif[0x0131] = rng.choice(['Adobe Photoshop 25.0', 'GIMP 2.10', 'Firmware 1.0'])
+    return exif
+
+
+def save(img: Image.Image, path: Path, exif: Optional[Image.Exif] = None, **params) -> None:
+    fmt = SAVE_FORMATS[path.suffix]
+    if fmt == 'JPEG':
+        params.setdefault('quality', 90)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+    elif fmt in ('GIF', 'BMP') and img.mode == 'RGBA':
+        img = img.convert('RGB')
+    if exif is not None and fmt in EXIF_FORMATS:
+        params['exif'] = exif
+    img.save(path, fmt, **params)
+
+
+def read_manifest(root: Path) -> Optional[Dict[str, Any]]:
+    """The manifest of a corpus this script generated under ``root``, or ``None``."""
+    try:
+        manifest = json.loads((root / 'manifest.json').read_text())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("settings"), dict) or manifest["settings"].get("seed") is None or "files" not in manifest:
+        return None
+    return manifest
+
+
+def generate_corpus(root: Path, supported_formats: List[str], bulk_count: int, quick: bool) -> Dict[str, Any]:
+    """Write the corpus under ``root`` unless an identical one is already there; returns its manifest.
+
+    An existing corpus with other settings is replaced, but only if ``root`` holds a
+    manifest written by this script; any other non-empty path is refused.
+    """
+    settings = {"version": CORPUS_VERSION, "seed": SEED, "formats": supported_formats, "bulk_count": bulk_count, "quick": quick}
+    manifest = read_manifest(root)
+    if manifest is not None and manifest["settings"] == settings:
+        return manifest
+    if manifest is None and root.exists() and (not root.is_dir() or any(root.iterdir())):
+        raise SystemExit(f"❌ Refusing to write the corpus to {root}: it is not empty and has no benchmark manifest.json. Pass an empty or new --corpus directory.")
+    shutil.rmtree(root, ignore_errors=True)
+    mixed, bulk = root / 'mixed', root / 'bulk'
+    mixed.mkdir(parents=True)
+    bulk.mkdir()
+    rng = random.Random(SEED)
+    files = []
+    tiers = {name: size for name, size in SIZE_TIERS.items() if not quick or name in ('icon', 'small', 'medium')}
+
+    def record(path: Path, tier: str, **info) -> None:
+        files.append({"path": str(path.relative_to(root)), "tier": tier, "bytes": path.stat().st_size, **info})
+
+    # Every supported format at every size tier, with and without EXIF
+    for ext in supported_formats:
+        for tier, size in tiers.items():
+            if tier == 'huge' and ext not in HUGE_FORMATS:
+                continue
+            img = synthetic_image(rng, size)
+            path = mixed / f"{tier}_{ext[1:]}{ext}"
+            save(img, path)
+            record(path, tier, exif=False)
+            if SAVE_FORMATS[ext] in EXIF_FORMATS and tier in ('small', 'large'):
+                path = mixed / f"{tier}_{ext[1:]}_exif{ext}"
+                save(img, path, camera_exif(rng))
+                record(path, tier, exif=True)
+    # Other pixel modes the decoder handles differently
+    for mode, ext in (('L', '.png'), ('RGBA', '.png'), ('RGBA', '.webp'), ('P', '.png')):
+        path = mixed / f"small_{mode.lower()}_{ext[1:]}{ext}"
+        save(synthetic_image(rng, SIZE_TIERS['small'], mode), path)
+        record(path, 'small', exif=False, mode=mode)
+    # Animated images
+    for name, ext, size, count in (('anim_small', '.gif', (320, 240), 24), ('anim_medium', '.gif', (1280, 720), 60), ('anim_small', '.webp', (320, 240), 24)):
+        frames = [synthetic_image(rng, size) for _ in range(count)]
+        path = mixed / f"{name}{ext}"
+        if ext == '.gif':
+            frames = [frame.convert('P', palette=Image.Palette.ADAPTIVE) for frame in frames]
+        frames[0].save(path, SAVE_FORMATS[ext], save_all=True, append_images=frames[1:], duration=80, loop=0)
+        record(path, 'animated', exif=False, frames=count)
+    # Bulk directory for tool throughput: photos at two sizes, a fifth of them re-encoded copies
+    originals = []
+    for i in range(bulk_count):
+        if originals and i % 5 == 4:
+            source = rng.choice(originals)
+            img = Image.open(source).convert('RGB')
+            img = img.resize((img.width * 3 // 4, img.height * 3 // 4))
+            path = bulk / f"copy_{i:05d}.jpg"
+            save(img, path, quality=75)
+        else:
+            size = SIZE_TIERS['small'] if i % 3 else SIZE_TIERS['medium']
+            ext = '.jpg' if i % 4 else '.png'
+            path = bulk / f"photo_{i:05d}{ext}"
+            save(synthetic_image(rng, size), path, camera_exif(rng) if i % 2 else None)
+            originals.append(path)
+        record(path, 'bulk', exif=None)
+    manifest = {"settings": settings, "files": files}
+    (root / 'manifest.json').write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Milliseconds: count, mean, p50, p95 and max of ``samples`` given in seconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(math.ceil(p * len(ordered))) - 1)] * 1000
+
+    return {"count": len(ordered), "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3), "p50_ms": round(percentile(0.5), 3), "p95_ms": round(percentile(0.95), 3), "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def time_stages(server_module: Any, root: Path, manifest: Dict[str, Any], repeat: int) -> Dict[str, Any]:
+    """Per-file latency of each analysis stage with the cache off, so every stage does real work."""
+    analyzer = server_module.EnhancedImageAnalysisServer()
+    samples = {stage: {} for stage in STAGES}
+    for entry in manifest["files"]:
+        if entry["tier"] == 'bulk':
+            continue
+        path = root / entry["path"]
+        for _ in range(repeat):
+            timings = {}
+            started = time.perf_counter()
+            with analyzer.open_context(path) as ctx:
+                ctx.header
+                timings['open'] = time.perf_counter() - started
+                for stage, run in (('decode', lambda: ctx.pixels), ('colour', lambda: analyzer.analyze_image_colors(path, ctx)), ('exif', lambda: analyzer.extract_exif_data(path, ctx)), ('hashes', lambda: analyzer.perceptual_hashes(path, ctx)), ('features', lambda: analyzer.feature_vector(path, ctx))):
+                    started = time.perf_counter()
+                    run()
+                    timings[stage] = time.perf_counter() - started
+                analysis = analyzer.advanced_heuristic_analysis(path, ctx)
+                started = time.perf_counter()
+                analyzer.generate_name_from_analysis(analysis, 'descriptive')
+                timings['naming'] = time.perf_counter() - started
+            for stage, seconds in timings.items():
+                samples[stage].setdefault(entry["tier"], []).append(seconds)
+    return {stage: {"all": summarize([s for tier in by_tier.values() for s in tier]), "by_tier": {tier: summarize(values) for tier, values in sorted(by_tier.items())}} for stage, by_tier in samples.items()}
+
+
+def peak_rss_mb(pid: Any = "self") -> Optional[float]:
+    """High-water resident set size of a process in MB.
+
+    Linux reports it per address space in /proc; ``ru_maxrss`` is only a fallback because
+    there it survives fork and exec, so a child would inherit this process's peak.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if pid != "self" or resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def tool_calls(root: Path) -> Dict[str, Tuple[str, Dict[str, Any], int]]:
+    """Tool name -> (function name, arguments, images processed)."""
+    bulk, mixed = root / 'bulk', root / 'mixed'
+    count = sum(1 for _ in bulk.iterdir())
+    big = next(iter(sorted(mixed.glob('large_jpg_exif.jpg'))), None) or next(iter(sorted(mixed.glob('medium_jpg.jpg'))))
+    return {
+        "ai_analyze_directory_images": ("ai_analyze_directory_images", {"directory_path": str(bulk)}, count),
+        "ai_analyze_directory_images_mixed": ("ai_analyze_directory_images", {"directory_path": str(mixed)}, sum(1 for _ in mixed.iterdir())),
+        "ai_analyze_single_image": ("ai_analyze_single_image", {"image_path": str(big), "detailed_analysis": True}, 1),
+        "extract_comprehensive_metadata": ("extract_comprehensive_metadata", {"image_path": str(big)}, 1),
+        "extract_metadata_batch": ("extract_metadata_batch", {"directory_path": str(bulk)}, count),
+        "find_duplicate_images": ("find_duplicate_images", {"directory_path": str(bulk)}, count),
+        "find_similar_images": ("find_similar_images", {"image_path": str(big), "directory_path": str(bulk)}, count),
+        "organize_images_by_content": ("organize_images_by_content", {"directory_path": str(bulk)}, count),
+    }
+
+
+def _tool_worker(function: str, arguments: Dict[str, Any], images: int, cache_dir: str, runs: int, queue: Any) -> None:
+    """Runs in a fresh process so peak RSS belongs to this tool alone."""
+    os.environ["IMAGE_ANALYSIS_CACHE_DIR"] = cache_dir
+    os.environ["IMAGE_ANALYSIS_CACHE"] = "1"
+    try:
+        import enhanced_image_analysis_server as server_module
+        tool = getattr(server_module, function)
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            output = tool(dict(arguments))
+            timings.append(time.perf_counter() - started)
+            if output and output[0].text.startswith("Error"):
+                raise RuntimeError(output[0].text)
+        # Read the pool workers' peaks before they exit (the pool keeps no public list of them)
+        pool = server_module._process_pool
+        worker_peaks = [peak_rss_mb(pid) for pid in (pool._processes or {})] if pool is not None else []
+        worker_peaks = [peak for peak in worker_peaks if peak is not None]
+        server_module.shutdown_pools()
+        result = {"cold_seconds": round(timings[0], 4), "cold_images_per_second": round(images / timings[0], 2)}
+        if len(timings) > 1:
+            warm = min(timings[1:])
+            result.update({"warm_seconds": round(warm, 4), "warm_images_per_second": round(images / warm, 2)})
+        result.update({"images": images, "peak_rss_mb": peak_rss_mb(), "peak_worker_rss_mb": max(worker_peaks) if worker_peaks else None, "workers_used": len(worker_peaks)})
+        queue.put(result)
+    except Exception as e:
+        queue.put({"error": str(e)})
+
+
+def time_tools(root: Path, names: Optional[List[str]], runs: int) -> Dict[str, Any]:
+    """Cold (empty cache) and warm timings for each tool, each in its own process."""
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for name, (function, arguments, images) in tool_calls(root).items():
+        if names and name not in names:
+            continue
+        print(f"   🛠️  {name} ...", flush=True)
+        with tempfile.TemporaryDirectory(prefix="bench-cache-") as cache_dir:
+            queue = context.Queue()
+            process = context.Process(target=_tool_worker, args=(function, arguments, images, cache_dir, runs, queue))
+            process.start()
+            results[name] = _tool_result(process, queue, TOOL_TIMEOUT_SECONDS)
+            process.join()
+    return results
+
+
+def _tool_result(process: Any, queue: Any, timeout: float) -> Dict[str, Any]:
+    """What the tool process reported, or an error if it died or ran out of time first."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            pass
+        if not process.is_alive():
+            try:
+                # A result put just before exiting may still be in the pipe
+                return queue.get(timeout=1)
+            except Empty:
+                return {"error": f"tool process exited with code {process.exitcode} before reporting (killed, or out of memory?)"}
+        if time.monotonic() > deadline:
+            process.terminate()
+            return {"error": f"timed out after {timeout:.0f}s"}
+
+
+# Modules that starting the server and answering list_tools should not load
+HEAVY_MODULES = ('PIL.Image', 'numpy', 'ctypes', 'concurrent.futures.process')
+
+
+def time_startup(runs: int) -> Dict[str, Any]:
+    """Time from launching the server to its answers to ``initialize`` and ``tools/list``.
+
+    Each run starts a fresh interpreter speaking MCP over stdio, the way clients launch
+    it. One extra run under ``-X importtime`` records which of ``HEAVY_MODULES`` were
+    imported by the time the server exited.
+    """
+    from mcp.types import LATEST_PROTOCOL_VERSION
+    script = str(Path(__file__).resolve().parent / "enhanced_image_analysis_server.py")
+    requests = [
+        {"jsonrpc": "2.0", "id": 1, "method": "initialize", "params": {"protocolVersion": LATEST_PROTOCOL_VERSION, "capabilities": {}, "clientInfo": {"name": "benchmark", "version": "1"}}},
+        {"jsonrpc": "2.0", "method": "notifications/initialized"},
+        {"jsonrpc": "2.0", "id": 2, "method": "tools/list"},
+    ]
+    payload = "".join(json.dumps(request) + "\n" for request in requests).encode()
+
+    def launch(*flags: str) -> Tuple[float, float, str]:
+        with tempfile.TemporaryDirectory(prefix="bench-cache-") as cache_dir, tempfile.TemporaryFile() as log:
+            env = dict(os.environ, IMAGE_ANALYSIS_CACHE_DIR=cache_dir)
+            started = time.perf_counter()
+            process = subprocess.Popen([sys.executable, *flags, script], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log, env=env)
+            process.stdin.write(payload)
+            process.stdin.flush()
+            answered = {}
+            for line in process.stdout:
+                message = json.loads(line)
+                answered[message.get("id")] = time.perf_counter() - started
+                if 2 in answered:
+                    break
+            # Closing stdin ends the session, as a client disconnecting would
+            process.communicate(timeout=30)
+            log.seek(0)
+            stderr = log.read().decode(errors="replace")
+            if 2 not in answered:
+                raise RuntimeError(f"server exited without answering tools/list: {stderr[-500:]}")
+            return answered[1], answered[2], stderr
+
+    initialize, list_tools = [], []
+    for _ in range(runs):
+        first, second, _ = launch()
+        initialize.append(first)
+        list_tools.append(second)
+    imported = {line.rsplit("|", 1)[-1].strip() for line in launch("-X", "importtime")[2].splitlines() if line.startswith("import time:")}
+    return {
+        "initialize_ms": round(min(initialize) * 1000, 1),
+        "list_tools_ms": round(min(list_tools) * 1000, 1),
+        "list_tools_median_ms": round(sorted(list_tools)[len(list_tools) // 2] * 1000, 1),
+        "heavy_modules_loaded": [name for name in HEAVY_MODULES if name in imported],
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Describe every metric that got worse than ``baseline`` by more than ``tolerance`` (a fraction).
+
+    Tiny absolute changes (under 0.5 ms, 5 ms of tool time, 20 ms of startup or 5 MB) are
+    ignored as noise.
+    """
+    regressions = []
+
+    def check(label: str, current: Optional[float], previous: Optional[float], floor: float, unit: str) -> None:
+        if current is None or previous is None:
+            return
+        if current > previous * (1 + tolerance) and current - previous > floor:
+            regressions.append(f"{label}: {previous:g}{unit} → {current:g}{unit} (+{(current / previous - 1) * 100 if previous else float('inf'):.0f}%)")
+
+    for stage, data in results.get("stages", {}).items():
+        old = baseline.get("stages", {}).get(stage, {})
+        for tier, stats in data["by_tier"].items():
+            check(f"stage {stage} [{tier}] p50", stats.get("p50_ms"), old.get("by_tier", {}).get(tier, {}).get("p50_ms"), 0.5, " ms")
+    startup, old_startup = results.get("startup", {}), baseline.get("startup", {})
+    check("startup list_tools", startup.get("list_tools_ms"), old_startup.get("list_tools_ms"), 20, " ms")
+    for name in set(startup.get("heavy_modules_loaded", [])) - set(old_startup.get("heavy_modules_loaded", startup.get("heavy_modules_loaded", []))):
+        regressions.append(f"startup now imports {name} before list_tools")
+    for tool, data in results.get("tools", {}).items():
+        old = baseline.get("tools", {}).get(tool, {})
+        for key in ("cold_seconds", "warm_seconds"):
+            check(f"tool {tool} {key}", data.get(key), old.get(key), 0.005, " s")
+        for key in ("peak_rss_mb", "peak_worker_rss_mb"):
+            check(f"tool {tool} {key}", data.get(key), old.get(key), 5, " MB")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the image analysis server on a synthetic corpus")
+    parser.add_argument("--corpus", type=Path, default=Path("benchmark_corpus"), help="Where to generate (or reuse) the corpus")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--baseline", type=Path, help="Compare against this results file and exit 1 on regressions")
+    parser.add_argument("--save-baseline", type=Path, help="Also write the results here")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a metric counts as regressed (default: 0.25 = 25%%)")
+    parser.add_argument("--bulk-count", type=int, default=300, help="Images in the bulk directory used for tool throughput")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed passes per file for stage latencies")
+    parser.add_argument("--runs", type=int, default=3, help="Tool runs per process: one cold, the rest warm")
+    parser.add_argument("--tools", nargs="*", help="Only benchmark these tools")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Server launches timed for time-to-first-list_tools")
+    parser.add_argument("--skip-startup", action="store_true")
+    parser.add_argument("--skip-stages", action="store_true")
+    parser.add_argument("--skip-tools", action="store_true")
+    parser.add_argument("--quick", action="store_true", help="Skip the large and huge tiers")
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    # Stage timings run in this process; keep it from touching the user's cache
+    os.environ.setdefault("IMAGE_ANALYSIS_CACHE", "0")
+    import enhanced_image_analysis_server as server_module
+
+    print("🚀 Enhanced Image Analysis Benchmark")
+    print("=" * 50)
+    started = time.perf_counter()
+    formats = sorted(server_module.EnhancedImageAnalysisServer().supported_formats)
+    manifest = generate_corpus(args.corpus, formats, args.bulk_count, args.quick)
+    print(f"📦 Corpus: {len(manifest['files'])} files in {args.corpus} ({sum(f['bytes'] for f in manifest['files']) / (1024 * 1024):.0f} MB, ready in {time.perf_counter() - started:.1f}s)")
+
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    import PIL
+    results = {
+        "meta": {"created": datetime.now().isoformat(timespec='seconds'), "python": platform.python_version(), "pillow": PIL.__version__, "numpy": numpy_version, "platform": platform.platform(), "cpu_count": os.cpu_count(), "workers": server_module.ANALYSIS_WORKERS, "corpus": manifest["settings"]},
+    }
+    if not args.skip_startup:
+        print("⏱️  Timing server startup ...", flush=True)
+        results["startup"] = startup = time_startup(max(1, args.startup_runs))
+        print(f"   initialize {startup['initialize_ms']:.0f} ms   list_tools {startup['list_tools_ms']:.0f} ms (median {startup['list_tools_median_ms']:.0f} ms)   heavy imports: {', '.join(startup['heavy_modules_loaded']) or 'none'}")
+    if not args.skip_stages:
+        print("⏱️  Timing analysis stages ...", flush=True)
+        results["stages"] = time_stages(server_module, args.corpus, manifest, args.repeat)
+        for stage, data in results["stages"].items():
+            stats = data["all"]
+            print(f"   {stage:<9} p50 {stats['p50_ms']:>9.2f} ms   p95 {stats['p95_ms']:>9.2f} ms   max {stats['max_ms']:>9.2f} ms")
+    if not args.skip_tools:
+        print("⏱️  Timing tools ...", flush=True)
+        results["tools"] = time_tools(args.corpus, args.tools, max(1, args.runs))
+        for tool, data in results["tools"].items():
+            if "error" in data:
+                print(f"   ❌ {tool}: {data['error']}")
+                continue
+            warm = f"   warm {data['warm_seconds']:.3f}s ({data['warm_images_per_second']:.0f} img/s)" if "warm_seconds" in data else ""
+            workers = f" (+{data['workers_used']} workers, each ≤ {data['peak_worker_rss_mb']} MB)" if data.get("workers_used") else ""
+            print(f"   {tool:<34} cold {data['cold_seconds']:.3f}s ({data['cold_images_per_second']:.0f} img/s){warm}   peak RSS {data['peak_rss_mb']} MB{workers}")
+
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"💾 Results written to {args.output}")
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(results, indent=2))
+        print(f"💾 Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        if regressions:
+            print(f"❌ {len(regressions)} regressions against {args.baseline}:")
+            for line in regressions:
+                print(f"   • {line}")
+            return 1
+        print(f"✅ No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,39 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
 import asyncio
+import base64
+import bisect
+import errno
+import fnmatch
+import functools
+import hashlib
+import heapq
+import importlib
+import importlib.util
+import io
 import json
 import logging
+import math
+import os
+import re
+import secrets
+import select
+import signal
+import socket
+import sqlite3
+import struct
 import sys
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from itertools import accumulate, chain, islice
+from concurrent.futures import BrokenExecutor, Executor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
-from PIL import Image
-from PIL.ExifTags import TAGS
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from datetime import datetime
 from mcp.server import Server
 from mcp.server.models import InitializationOptions
@@ -20,41 +47,1210 @@ try:
 except ImportError:
     MCP_AVAILABLE = False
 
-try:
+# Pillow and NumPy are only located here; they are imported on first use (see LazyModule)
+# so that launching the server and answering list_tools never pays for them
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+
+# Pillow plugins for the extensions in supported_formats, and the formats they register.
+# Only these are imported; Image.open() is limited to them so it never loads the rest.
+PIL_PLUGINS = ('BmpImagePlugin', 'GifImagePlugin', 'JpegImagePlugin', 'PngImagePlugin', 'TiffImagePlugin', 'WebPImagePlugin')
+PIL_FORMATS = ('JPEG', 'PNG', 'GIF', 'BMP', 'TIFF', 'WEBP')
+
+
+class LazyModule:
+    """Stand-in for a module global that imports the module on first attribute access.
+
+    ``load`` returns the real module, which then replaces the stand-in in this module's
+    globals, so later lookups go straight to the module.
+    """
+
+    def __init__(self, name: str, load: Callable[[], Any]):
+        self._name = name
+        self._load = load
+
+    def __getattr__(self, attr: str) -> Any:
+        module = self._load()
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+
+def load_pil() -> Any:
+    """Import ``PIL.Image`` with ``PIL_PLUGINS`` registered and return it."""
     from PIL import Image
-    PIL_AVAILABLE = True
-except ImportError:
-    PIL_AVAILABLE = False
+    for plugin in PIL_PLUGINS:
+        importlib.import_module(f"PIL.{plugin}")
+    # Opening an image only parses its header; pixel limits are enforced before decoding
+    Image.MAX_IMAGE_PIXELS = None
+    return Image
+
+Image = LazyModule("Image", load_pil)
+ImageChops = LazyModule("ImageChops", lambda: load_pil() and importlib.import_module("PIL.ImageChops"))
+ImageStat = LazyModule("ImageStat", lambda: load_pil() and importlib.import_module("PIL.ImageStat"))
+ExifTags = LazyModule("ExifTags", lambda: importlib.import_module("PIL.ExifTags"))
+np = LazyModule("np", lambda: importlib.import_module("numpy"))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Create server instance
-server = Server("enhanced-image-analysis-server")
+SERVER_VERSION = "2.1.0"
+server = Server("enhanced-image-analysis-server", version=SERVER_VERSION)
+
+# Bump whenever a change alters the content of cached analysis records
+ANALYZER_VERSION = 5
+
+CACHE_DIR = Path(os.environ.get("IMAGE_ANALYSIS_CACHE_DIR", Path.home() / ".cache" / "image-analysis-server")).expanduser()
+CACHE_ENABLED = os.environ.get("IMAGE_ANALYSIS_CACHE", "1") != "0"
+CACHE_MAX_MB = float(os.environ.get("IMAGE_ANALYSIS_CACHE_MAX_MB", "256"))
+CACHE_MAX_AGE_DAYS = float(os.environ.get("IMAGE_ANALYSIS_CACHE_MAX_AGE_DAYS", "30"))
+
+ANALYSIS_WORKERS = max(1, int(os.environ.get("IMAGE_ANALYSIS_WORKERS", os.cpu_count() or 1)))
+ANALYSIS_CHUNK_SIZE = max(1, int(os.environ.get("IMAGE_ANALYSIS_CHUNK_SIZE", "16")))
+# Directories smaller than this are analysed in-process; pool start-up would dominate
+PARALLEL_MIN_FILES = 32
+# Threads that run tool handlers off the event loop; also bounds concurrent tool calls
+BLOCKING_THREADS = max(2, int(os.environ.get("IMAGE_ANALYSIS_THREADS", "8")))
+IO_THREADS = max(1, int(os.environ.get("IMAGE_ANALYSIS_IO_THREADS", "16")))
+
+# Library roots whose new and modified images are analysed in the background
+WATCH_ROOTS = [Path(root).expanduser() for root in os.environ.get("IMAGE_ANALYSIS_WATCH_ROOTS", "").split(os.pathsep) if root]
+WATCH_CPU_SHARE = min(1.0, max(0.01, float(os.environ.get("IMAGE_ANALYSIS_WATCH_CPU_SHARE", "0.25"))))
+WATCH_POLL_SECONDS = max(1.0, float(os.environ.get("IMAGE_ANALYSIS_WATCH_POLL_SECONDS", "60")))
+# A file is only analysed once it has had no events for this long, so copies in progress are skipped
+WATCH_SETTLE_SECONDS = 2.0
+
+# Write-ahead journals of applied renames and moves, kept for resume and rollback
+JOURNAL_DIR = CACHE_DIR / "journals"
+
+# Background jobs (submit_job): their queue, file lists and result records, and how often progress is made durable
+JOB_DIR = CACHE_DIR / "jobs"
+JOB_CHECKPOINT_SECONDS = max(1.0, float(os.environ.get("IMAGE_ANALYSIS_JOB_CHECKPOINT_SECONDS", "10")))
+# Files analysed between checks for cancellation and checkpoints
+JOB_CHUNK_FILES = 512
+# A running job whose owner on another host has not reported for this long is taken over
+JOB_LEASE_SECONDS = 600
+# How often the owner of a running job renews its lease, from its own thread
+JOB_HEARTBEAT_SECONDS = 30
+# Idle servers look for queued or orphaned jobs this often
+JOB_POLL_SECONDS = 30
+
+# When set, server_stats output is also written to this file every STATS_INTERVAL seconds
+STATS_FILE = os.environ.get("IMAGE_ANALYSIS_STATS_FILE")
+STATS_INTERVAL = max(1.0, float(os.environ.get("IMAGE_ANALYSIS_STATS_INTERVAL", "60")))
+
+# Decoded pixel buffers in flight across all threads and pool workers are kept under this budget
+MEMORY_BUDGET_MB = max(16.0, float(os.environ.get("IMAGE_ANALYSIS_MEMORY_BUDGET_MB", "1024")))
+# A decode that cannot get room in the budget for this long fails instead of waiting on
+MEMORY_WAIT_SECONDS = max(1.0, float(os.environ.get("IMAGE_ANALYSIS_MEMORY_WAIT_SECONDS", "300")))
+# Larger images are refused before decoding; replaces Pillow's DecompressionBombError
+MAX_IMAGE_PIXELS = max(1, int(os.environ.get("IMAGE_ANALYSIS_MAX_PIXELS", "500000000")))
+# Rows of an oversized image decoded at a time are sized to stay near this many bytes
+DECODE_BAND_BYTES = 16 * 1024 * 1024
+
+# HTTP transport (--transport http): tool calls one client session may run at once, and how
+# long shutdown waits for in-flight calls before cancelling them
+CLIENT_MAX_CALLS = max(1, int(os.environ.get("IMAGE_ANALYSIS_CLIENT_MAX_CALLS", "4")))
+SHUTDOWN_GRACE_SECONDS = max(0.0, float(os.environ.get("IMAGE_ANALYSIS_SHUTDOWN_GRACE_SECONDS", "30")))
+
+
+class Metrics:
+    """Process-wide counters, rates and latency histograms, cheap enough to leave on.
+
+    Histograms use fixed millisecond buckets, so recording is a bisect and three
+    additions under one lock; percentiles are reported as bucket upper bounds. Counters
+    named in ``RATES`` also feed a one-minute window of per-second counts. Pool workers
+    keep their own instance and ship ``drain()`` deltas back to be ``merge``d.
+    """
+
+    BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+    RATES = ('files.analyzed', 'bytes.decoded')
+    RATE_WINDOW = 60
 
-class EnhancedImageAnalysisServer:
     def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self._windows = {name: {} for name in self.RATES}
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+            window = self._windows.get(name)
+            if window is not None:
+                second = int(time.monotonic())
+                window[second] = window.get(second, 0) + amount
+
+    def observe(self, name: str, seconds: float) -> None:
+        ms = seconds * 1000
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(self.BUCKETS_MS) + 1), 0.0, 0.0]
+            histogram[0][bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+            histogram[1] += ms
+            if ms > histogram[2]:
+                histogram[2] = ms
+
+    @contextmanager
+    def time(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed(self, name: str) -> Callable[[Callable], Callable]:
+        """Decorator form of ``time``."""
+        def decorate(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started)
+            return wrapper
+        return decorate
+
+    def drain(self) -> Dict[str, Any]:
+        """Return the raw state recorded since the last drain and start afresh."""
+        with self._lock:
+            state = {"counters": self.counters, "histograms": self.histograms}
+            self.counters, self.histograms = {}, {}
+        return state
+
+    def merge(self, state: Dict[str, Any]) -> None:
+        for name, amount in state["counters"].items():
+            self.incr(name, amount)
+        with self._lock:
+            for name, (buckets, total, peak) in state["histograms"].items():
+                histogram = self.histograms.setdefault(name, [[0] * (len(self.BUCKETS_MS) + 1), 0.0, 0.0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] = max(histogram[2], peak)
+
+    def _percentile(self, buckets: List[int], count: int, fraction: float, peak: float) -> float:
+        rank, seen = fraction * count, 0
+        for bound, n in zip(self.BUCKETS_MS + (peak,), buckets):
+            seen += n
+            if seen >= rank:
+                return round(min(bound, peak), 3)
+        return round(peak, 3)
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {name: (list(h[0]), h[1], h[2]) for name, h in self.histograms.items()}
+            rates = {}
+            for name, window in self._windows.items():
+                for second in [second for second in window if second <= now - self.RATE_WINDOW]:
+                    del window[second]
+                rates[name] = round(sum(window.values()) / self.RATE_WINDOW, 2)
+        hit_rates = {}
+        for name in counters:
+            if name.startswith('cache.') and name.endswith('.hits'):
+                kind = name[len('cache.'):-len('.hits')]
+                hits, misses = counters[name], counters.get(f"cache.{kind}.misses", 0)
+                hit_rates[kind] = round(hits / (hits + misses), 4) if hits + misses else None
+        latency = {}
+        for name, (buckets, total, peak) in sorted(histograms.items()):
+            count = sum(buckets)
+            latency[name] = {"count": count, "mean": round(total / count, 3), "p50": self._percentile(buckets, count, 0.5, peak), "p95": self._percentile(buckets, count, 0.95, peak), "p99": self._percentile(buckets, count, 0.99, peak), "max": round(peak, 3)}
+        return {
+            "uptime_seconds": round(now - self.started, 1),
+            "counters": dict(sorted(counters.items())),
+            "per_second_last_minute": rates,
+            "cache_hit_rates": hit_rates,
+            "latency_ms": latency,
+        }
+
+metrics = Metrics()
+
+class StatsDumper:
+    """Writes ``metrics.snapshot()`` as JSON to ``path`` every ``interval`` seconds (and once on stop)."""
+
+    def __init__(self, path: Path, interval: float = STATS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stats-dump", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(5)
+        self.dump()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def dump(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            tmp.write_text(json.dumps({"time": datetime.now().isoformat(timespec='seconds'), **metrics.snapshot()}, indent=2))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write stats to {self.path}: {e}")
+
+def process_exists(pid: int) -> bool:
+    """False only when no process ``pid`` is running on this host; assumed alive where that cannot be checked."""
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def mp_context() -> Any:
+    """Start method for pool workers and the state they share with the server.
+
+    Never fork: a child forked from the running stdio server blocks on the stdin buffer
+    lock held by the transport's reader thread before it can start.
+    """
+    import multiprocessing
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+class MemoryBudget:
+    """Admission control for pixel decoding, shared by threads and pool workers.
+
+    Each decode reserves its estimated size before allocating and releases it when its
+    file is closed; reservations wait while the budget is exhausted. A single
+    reservation larger than the whole budget is admitted once nothing else is running.
+    Reservations are also tallied per process, so those of a worker that died
+    mid-decode can be reclaimed, and a wait longer than ``MEMORY_WAIT_SECONDS`` fails.
+    The shared state is created on first use and handed to pool workers by
+    ``_init_worker``.
+    """
+
+    # Processes that can hold reservations at the same time
+    HOLDERS = 64
+
+    def __init__(self, limit_bytes: int, wait_seconds: float = MEMORY_WAIT_SECONDS):
+        self.limit = limit_bytes
+        self.wait_seconds = wait_seconds
+        self._state = None
+
+    def shared_state(self) -> Tuple[Any, Any, Any]:
+        if self._state is None:
+            context = mp_context()
+            # holders: (pid, bytes reserved) pairs, pid 0 marking a free slot
+            self._state = (context.Value('q', 0, lock=False), context.Condition(), context.Array('q', 2 * self.HOLDERS, lock=False))
+        return self._state
+
+    def attach(self, state: Tuple[Any, Any, Any]) -> None:
+        self._state = state
+
+    def in_use(self) -> int:
+        used, condition, _ = self.shared_state()
+        with condition:
+            return used.value
+
+    def _slot(self, holders: Any, pid: int, claim: bool = True) -> int:
+        """Index of ``pid``'s entry in ``holders``, taking a free one if ``claim``; -1 if there is none."""
+        free = -1
+        for i in range(0, len(holders), 2):
+            if holders[i] == pid:
+                return i
+            if free < 0 and holders[i] == 0:
+                free = i
+        if free >= 0 and claim:
+            holders[free], holders[free + 1] = pid, 0
+            return free
+        return -1
+
+    def _reclaim(self, dead: Callable[[int], bool]) -> int:
+        """Return the reservations of processes for which ``dead`` holds; the caller holds the condition."""
+        used, condition, holders = self._state
+        freed = 0
+        for i in range(0, len(holders), 2):
+            if holders[i] and holders[i] != os.getpid() and dead(holders[i]):
+                freed += holders[i + 1]
+                holders[i], holders[i + 1] = 0, 0
+        if freed:
+            used.value -= freed
+            metrics.incr('memory.reclaimed_bytes', freed)
+            condition.notify_all()
+        return freed
+
+    def reclaim(self, pids: Iterable[int]) -> int:
+        """Return the reservations held by ``pids``, the workers of a pool that broke."""
+        pids = set(pids)
+        if self._state is None or not pids:
+            return 0
+        with self._state[1]:
+            return self._reclaim(lambda pid: pid in pids)
+
+    def acquire(self, nbytes: int) -> int:
+        """Block until ``nbytes`` fit in the budget and reserve them; returns the amount to ``release``."""
+        used, condition, holders = self.shared_state()
+        need = min(nbytes, self.limit)
+        started = time.perf_counter()
+        with condition:
+            while used.value and used.value + need > self.limit:
+                waited = time.perf_counter() - started
+                if waited >= self.wait_seconds:
+                    metrics.incr('memory.wait_timeouts')
+                    raise TimeoutError(f"memory budget exhausted: waited {waited:.0f}s for {need / 2**20:,.0f} MB with {used.value / 2**20:,.0f} of {self.limit / 2**20:,.0f} MB reserved (IMAGE_ANALYSIS_MEMORY_BUDGET_MB)")
+                if not condition.wait(min(1.0, self.wait_seconds - waited)):
+                    self._reclaim(lambda pid: not process_exists(pid))
+            slot = self._slot(holders, os.getpid())
+            if slot < 0:
+                self._reclaim(lambda pid: not process_exists(pid))
+                slot = self._slot(holders, os.getpid())
+            if slot < 0:
+                raise RuntimeError(f"memory budget tracks at most {self.HOLDERS} processes")
+            holders[slot + 1] += need
+            used.value += need
+        waited = time.perf_counter() - started
+        if waited > 0.001:
+            metrics.observe('memory.admission_wait', waited)
+        return need
+
+    def release(self, reserved: int) -> None:
+        used, condition, holders = self.shared_state()
+        with condition:
+            slot = self._slot(holders, os.getpid(), claim=False)
+            if slot < 0:
+                # Reclaimed already, after this process was taken for dead
+                return
+            reserved = min(reserved, holders[slot + 1])
+            holders[slot + 1] -= reserved
+            if not holders[slot + 1]:
+                holders[slot] = 0
+            used.value -= reserved
+            condition.notify_all()
+
+memory_budget = MemoryBudget(int(MEMORY_BUDGET_MB * 1024 * 1024))
+
+
+class AnalysisCache:
+    """Persistent SQLite store of per-file analysis records.
+
+    Records are keyed by (device, inode, size, mtime_ns) plus ``ANALYZER_VERSION``, so a
+    renamed file still hits and a modified one misses. Least recently used records are
+    evicted once the store exceeds ``max_bytes`` or goes unread for ``max_age_days``.
+    """
+
+    # Access times are only rewritten when older than this, so warm reads stay read-only
+    TOUCH_INTERVAL = 3600
+    EVICT_EVERY = 500
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 256 * 1024 * 1024, max_age_days: float = 30):
+        self.path = cache_dir / "analysis_cache.sqlite3"
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self._lock = threading.Lock()
+        self._conn = None
+        self._puts = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS records (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, version INTEGER,
+                value TEXT NOT NULL, bytes INTEGER NOT NULL, accessed REAL NOT NULL,
+                PRIMARY KEY (dev, ino, size, mtime_ns, version))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS records_accessed ON records (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS snapshots (key TEXT PRIMARY KEY, dir_mtime_ns INTEGER, entries TEXT NOT NULL, updated REAL NOT NULL)")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def file_key(stat: os.stat_result) -> Tuple[int, int, int, int, int]:
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, ANALYZER_VERSION)
+
+    def get(self, stat: os.stat_result) -> Optional[Dict[str, Any]]:
+        key = self.file_key(stat)
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute("SELECT value, accessed FROM records WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND version=?", key).fetchone()
+                if row is None:
+                    metrics.incr('cache.records.misses')
+                    return None
+                now = time.time()
+                if now - row[1] > self.TOUCH_INTERVAL:
+                    conn.execute("UPDATE records SET accessed=? WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND version=?", (now,) + key)
+            metrics.incr('cache.records.hits')
+            return json.loads(row[0])
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.warning(f"Analysis cache read failed: {e}")
+            return None
+
+    def put(self, stat: os.stat_result, record: Dict[str, Any]) -> None:
+        """Merge ``record`` into the stored one; parts other analyses recorded are kept."""
+        key = self.file_key(stat)
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                with conn:
+                    row = conn.execute("SELECT value FROM records WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND version=?", key).fetchone()
+                    if row is not None:
+                        record = {**json.loads(row[0]), **record}
+                    value = json.dumps(record, default=str, separators=(',', ':'))
+                    conn.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)", key + (value, len(value), time.time()))
+                self._puts += 1
+                if self._puts % self.EVICT_EVERY == 0:
+                    self._evict(conn)
+        except (sqlite3.Error, OSError, TypeError, ValueError) as e:
+            logger.warning(f"Analysis cache write failed: {e}")
+
+    def get_snapshot(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with self._lock:
+                row = self._connect().execute("SELECT dir_mtime_ns, entries FROM snapshots WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            return {"dir_mtime_ns": row[0], "entries": json.loads(row[1])}
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logger.warning(f"Snapshot read failed: {e}")
+            return None
+
+    def put_snapshot(self, key: str, dir_mtime_ns: int, entries: Dict[str, Any]) -> None:
+        try:
+            value = json.dumps(entries, default=str, separators=(',', ':'))
+            with self._lock:
+                self._connect().execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)", (key, dir_mtime_ns, value, time.time()))
+        except (sqlite3.Error, OSError, TypeError, ValueError) as e:
+            logger.warning(f"Snapshot write failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            with self._lock:
+                count, size = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM records").fetchone()
+            return {"records": count, "mb": round(size / (1024 * 1024), 2), "max_mb": round(self.max_bytes / (1024 * 1024), 2)}
+        except (sqlite3.Error, OSError) as e:
+            return {"error": str(e)}
+
+    def evict(self) -> None:
+        try:
+            with self._lock:
+                self._evict(self._connect())
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Analysis cache eviction failed: {e}")
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM records WHERE accessed < ?", (time.time() - self.max_age,))
+        conn.execute("DELETE FROM snapshots WHERE updated < ?", (time.time() - self.max_age,))
+        excess = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM records").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        freed, cutoff = 0, None
+        for accessed, size in conn.execute("SELECT accessed, bytes FROM records ORDER BY accessed"):
+            freed += size
+            cutoff = accessed
+            if freed >= excess:
+                break
+        conn.execute("DELETE FROM records WHERE accessed <= ?", (cutoff,))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def _probe_jpeg(f) -> Optional[Dict[str, Any]]:
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        byte = f.read(1)
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            continue
+        if marker in (0xd9, 0xda):
+            return None
+        length = struct.unpack('>H', f.read(2))[0]
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            _, height, width, components = struct.unpack('>BHHB', f.read(6))
+            return {"format": "JPEG", "mode": {1: "L", 3: "RGB", 4: "CMYK"}.get(components), "width": width, "height": height}
+        f.seek(length - 2, 1)
+
+
+def _probe_png(f) -> Optional[Dict[str, Any]]:
+    data = f.read(26)
+    if len(data) < 26 or data[:8] != b'\x89PNG\r\n\x1a\n' or data[12:16] != b'IHDR':
+        return None
+    width, height, depth, color_type = struct.unpack('>IIBB', data[16:26])
+    mode = {0: "1" if depth == 1 else "I;16" if depth == 16 else "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}.get(color_type)
+    return {"format": "PNG", "mode": mode, "width": width, "height": height}
+
+
+def _probe_gif(f) -> Optional[Dict[str, Any]]:
+    data = f.read(13)
+    if len(data) < 13 or data[:6] not in (b'GIF87a', b'GIF89a'):
+        return None
+    width, height, flags = struct.unpack('<HHB', data[6:11])
+    mode = None
+    if flags & 0x80:
+        palette = f.read(3 << ((flags & 7) + 1))
+        # Pillow only keeps a palette that is not the identity grey ramp
+        if any(not (i // 3 == palette[i] == palette[i + 1] == palette[i + 2]) for i in range(0, len(palette), 3)):
+            mode = "P"
+    return {"format": "GIF", "mode": mode, "width": width, "height": height}
+
+
+def _probe_webp(f) -> Optional[Dict[str, Any]]:
+    data = f.read(30)
+    if len(data) < 30 or data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        return None
+    chunk = data[12:16]
+    if chunk == b'VP8X':
+        width = 1 + int.from_bytes(data[24:27], 'little')
+        height = 1 + int.from_bytes(data[27:30], 'little')
+        return {"format": "WEBP", "mode": "RGBA" if data[20] & 0x10 else "RGB", "width": width, "height": height}
+    if chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', data[26:30])
+        return {"format": "WEBP", "mode": "RGB", "width": width & 0x3fff, "height": height & 0x3fff}
+    if chunk == b'VP8L' and data[20] == 0x2f:
+        bits = int.from_bytes(data[21:25], 'little')
+        return {"format": "WEBP", "mode": "RGBA" if bits >> 28 & 1 else "RGB", "width": (bits & 0x3fff) + 1, "height": (bits >> 14 & 0x3fff) + 1}
+    return None
+
+
+def _probe_bmp(f) -> Optional[Dict[str, Any]]:
+    data = f.read(30)
+    if len(data) < 26 or data[:2] != b'BM':
+        return None
+    header_size = struct.unpack('<I', data[14:18])[0]
+    if header_size == 12:
+        width, height, _, bits = struct.unpack('<HHHH', data[18:26])
+    elif len(data) >= 30:
+        width, height, _, bits = struct.unpack('<iiHH', data[18:30])
+    else:
+        return None
+    # Palette and 32-bit images depend on the palette and channel masks; leave those to Pillow
+    mode = "RGB" if bits in (16, 24) else None
+    return {"format": "BMP", "mode": mode, "width": width, "height": abs(height)}
+
+
+def _probe_tiff(f) -> Optional[Dict[str, Any]]:
+    data = f.read(8)
+    if data[:4] == b'II*\x00':
+        endian = '<'
+    elif data[:4] == b'MM\x00*':
+        endian = '>'
+    else:
+        return None
+    f.seek(struct.unpack(endian + 'I', data[4:8])[0])
+    count = struct.unpack(endian + 'H', f.read(2))[0]
+    entries = f.read(12 * count)
+    tags = {}
+    for i in range(0, len(entries) - 11, 12):
+        tag, field_type, values = struct.unpack(endian + 'HHI', entries[i:i + 8])
+        if field_type == 3:
+            tags[tag] = (values, struct.unpack(endian + 'H', entries[i + 8:i + 10])[0])
+        elif field_type == 4:
+            tags[tag] = (values, struct.unpack(endian + 'I', entries[i + 8:i + 12])[0])
+    if 256 not in tags or 257 not in tags:
+        return None
+    photometric = tags.get(262, (1, None))[1]
+    samples = tags.get(277, (1, 1))[1]
+    bits_count, bits = tags.get(258, (1, 1))
+    mode = None
+    if photometric in (0, 1) and samples == 1 and bits in (1, 8):
+        mode = "1" if bits == 1 else "L"
+    elif photometric == 2 and samples == 3 and 339 not in tags and (bits_count == 3 or bits == 8):
+        mode = "RGB"
+    return {"format": "TIFF", "mode": mode, "width": tags[256][1], "height": tags[257][1]}
+
+
+_HEADER_PROBES = {'.jpg': _probe_jpeg, '.jpeg': _probe_jpeg, '.png': _probe_png, '.gif': _probe_gif, '.webp': _probe_webp, '.bmp': _probe_bmp, '.tiff': _probe_tiff, '.tif': _probe_tiff}
+
+
+def probe_image_header(image_path: Path) -> Optional[Dict[str, Any]]:
+    """Read format, mode and dimensions from the leading bytes of an image.
+
+    Only the file header is read, with small buffered reads that seek past JPEG
+    segments and into the first TIFF IFD. Returns ``None`` when the file does not
+    look like its extension, and leaves ``mode`` as ``None`` when Pillow's choice
+    depends on more than the header; callers fall back to Pillow in both cases.
+    """
+    probe = _HEADER_PROBES.get(image_path.suffix.lower())
+    if probe is None:
+        return None
+    try:
+        with open(image_path, 'rb', buffering=4096) as f:
+            return probe(f)
+    except (OSError, struct.error, IndexError):
+        return None
+
+
+# Frames of an animation decoded for analysis, spread evenly over its running time
+ANIMATION_SAMPLE_FRAMES = max(1, int(os.environ.get("IMAGE_ANALYSIS_ANIMATION_FRAMES", "8")))
+# Most frames decoded to composite one sample when the preceding keyframe is further back
+ANIMATION_COMPOSITE_FRAMES = 8
+
+def _skip_gif_blocks(f) -> None:
+    while True:
+        size = f.read(1)
+        if not size:
+            raise IndexError("truncated GIF")
+        if size == b'\0':
+            return
+        f.seek(size[0], 1)
+
+def _scan_gif_frames(f) -> Optional[Tuple[bytes, List[Tuple[int, int, bool, int, int]]]]:
+    data = f.read(13)
+    if len(data) < 13 or data[:6] not in (b'GIF87a', b'GIF89a'):
+        return None
+    width, height, flags = struct.unpack('<HHB', data[6:11])
+    prefix = data + (f.read(3 << ((flags & 7) + 1)) if flags & 0x80 else b'')
+    frames, start, transparent, delay = [], None, False, 0
+    while True:
+        position = f.tell()
+        introducer = f.read(1)
+        if introducer == b'!':
+            label = f.read(1)
+            if label == b'\xf9':
+                block = f.read(6)
+                start = position if start is None else start
+                transparent, delay = bool(block[1] & 1), struct.unpack('<H', block[2:4])[0] * 10
+                f.seek(-1, 1)
+            _skip_gif_blocks(f)
+        elif introducer == b',':
+            left, top, frame_width, frame_height, packed = struct.unpack('<HHHHB', f.read(9))
+            if packed & 0x80:
+                f.seek(3 << ((packed & 7) + 1), 1)
+            f.seek(1, 1)
+            _skip_gif_blocks(f)
+            key = not frames or ((left, top, frame_width, frame_height) == (0, 0, width, height) and not transparent)
+            frames.append((position if start is None else start, f.tell(), key, delay, frame_width * frame_height))
+            start, transparent, delay = None, False, 0
+        else:
+            # Trailer, or trailing garbage Pillow also ignores
+            return (prefix, frames) if frames else None
+
+def _scan_webp_frames(f) -> Optional[Tuple[bytes, List[Tuple[int, int, bool, int, int]]]]:
+    data = f.read(12)
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        return None
+    end = 8 + int.from_bytes(data[4:8], 'little')
+    prefix, frames, width, height = b'', [], 0, 0
+    while f.tell() + 8 <= end:
+        position = f.tell()
+        header = f.read(8)
+        fourcc, size = header[:4], int.from_bytes(header[4:8], 'little')
+        if fourcc in (b'VP8X', b'ANIM'):
+            payload = f.read(size + (size & 1))
+            prefix += header + payload
+            if fourcc == b'VP8X':
+                width, height = 1 + int.from_bytes(payload[4:7], 'little'), 1 + int.from_bytes(payload[7:10], 'little')
+        elif fourcc == b'ANMF':
+            payload = f.read(29)
+            x, y = 2 * int.from_bytes(payload[0:3], 'little'), 2 * int.from_bytes(payload[3:6], 'little')
+            frame_width, frame_height = 1 + int.from_bytes(payload[6:9], 'little'), 1 + int.from_bytes(payload[9:12], 'little')
+            duration, no_blend = int.from_bytes(payload[12:15], 'little'), bool(payload[15] & 0x02)
+            # Lossy frames without an ALPH chunk, and lossless ones whose header clears the alpha bit, are opaque
+            opaque = payload[16:20] == b'VP8 ' or (payload[16:20] == b'VP8L' and len(payload) == 29 and not int.from_bytes(payload[25:29], 'little') >> 28 & 1)
+            key = not frames or ((x, y, frame_width, frame_height) == (0, 0, width, height) and (no_blend or opaque))
+            frames.append((position, position + 8 + size + (size & 1), key, duration, frame_width * frame_height))
+            f.seek(position + 8 + size + (size & 1))
+        else:
+            f.seek(size + (size & 1), 1)
+    return (prefix, frames) if frames and prefix else None
+
+_FRAME_SCANNERS = {'GIF': _scan_gif_frames, 'WEBP': _scan_webp_frames}
+
+def scan_animation_frames(image_path: Path, image_format: str) -> Optional[Tuple[bytes, List[Tuple[int, int, bool, int, int]]]]:
+    """Index the frames of a GIF or WebP file from its block structure, without decoding any.
+
+    Returns the file's global header bytes and one ``(start, end, is_keyframe,
+    duration_ms, area)`` entry per frame, where ``start:end`` is the frame's byte range,
+    a keyframe is one that replaces the whole canvas and ``area`` is the pixel count of
+    the rectangle the frame paints. Returns ``None`` for other formats
+    and for files the scanner does not understand; callers fall back to Pillow.
+    """
+    scanner = _FRAME_SCANNERS.get(image_format)
+    if scanner is None:
+        return None
+    try:
+        with open(image_path, 'rb', buffering=65536) as f:
+            return scanner(f)
+    except (OSError, struct.error, IndexError, ValueError):
+        return None
+
+def sample_frame_indices(durations: List[int], count: int) -> List[int]:
+    """Indices of the frames showing at ``count`` evenly spaced points of the running time.
+
+    A frame shown for longer can be sampled more than once, which weights it by its
+    screen time when samples are aggregated.
+    """
+    # Browsers play zero-delay frames at about 100 ms
+    ends = list(accumulate(duration or 100 for duration in durations))
+    return [bisect.bisect_right(ends, (i + 0.5) * ends[-1] / count) for i in range(count)]
+
+def composite_chain(keyframes: List[int], areas: List[int], index: int, limit: int) -> List[int]:
+    """Frames to composite, in order, to reconstruct frame ``index``.
+
+    That is the nearest keyframe at or before it, followed by the frames in between. When
+    there are more than ``limit`` in total, the keyframe, the latest ``limit // 2``
+    frames and the intermediate frames painting the largest ``areas`` are kept; regions
+    none of them repaint may then show stale content.
+    """
+    key = keyframes[bisect.bisect_right(keyframes, index) - 1]
+    if index - key < limit:
+        return list(range(key, index + 1))
+    recent = list(range(index - limit // 2 + 1, index + 1))
+    largest = heapq.nlargest(limit - 1 - len(recent), range(key + 1, recent[0]), key=lambda i: (areas[i], i))
+    return [key] + sorted(largest) + recent
+
+def build_animation(image_format: str, prefix: bytes, frames: List[bytes]) -> bytes:
+    """A standalone GIF or WebP file holding ``frames`` after the original global header."""
+    if image_format == 'GIF':
+        return prefix + b''.join(frames) + b';'
+    body = b'WEBP' + prefix + b''.join(frames)
+    return b'RIFF' + len(body).to_bytes(4, 'little') + body
+
+
+# Bytes per pixel in Pillow's memory layout; modes not listed use four
+_MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I;16N': 2}
+# Modes Image.reduce() accepts
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA')
+# Bits per pixel of raw layouts whose row stride Pillow derives from the width
+_RAW_BITS = {'1': 1, 'L': 8, 'P': 8, 'LA': 16, 'I;16': 16, 'I;16B': 16, 'RGB': 24, 'BGR': 24, 'RGBA': 32, 'RGBX': 32, 'BGRA': 32, 'BGRX': 32, 'CMYK': 32}
+
+def decoded_bytes(mode: str, width: int, height: int) -> int:
+    """Memory Pillow allocates to hold a decoded ``mode`` image of this size."""
+    return width * height * _MODE_BYTES.get(mode, 4)
+
+def raw_layout(img: Image.Image) -> Optional[Tuple[int, int, int, str]]:
+    """``(offset, stride, ystep, rawmode)`` when the not-yet-loaded image is one uncompressed block of rows.
+
+    True of BMP, uncompressed TIFF and PPM; such images can be decoded a band of rows at
+    a time straight from the file.
+    """
+    if len(img.tile) != 1:
+        return None
+    codec, extents, offset, args = img.tile[0][:4]
+    if codec != 'raw' or tuple(extents) != (0, 0, img.width, img.height):
+        return None
+    if isinstance(args, str):
+        args = (args,)
+    rawmode, stride, ystep = (tuple(args) + (0, 1)[len(args) - 1:])[:3]
+    if stride == 0 and rawmode in _RAW_BITS:
+        stride = (img.width * _RAW_BITS[rawmode] + 7) // 8
+    if stride <= 0 or ystep not in (1, -1):
+        return None
+    return offset, stride, ystep, rawmode
+
+def reduce_in_bands(size: Tuple[int, int], mode: str, factor: int, read_band: Callable[[int, int], Image.Image]) -> Image.Image:
+    """Box-reduce an image by ``factor`` one band of rows at a time.
+
+    ``read_band(top, bottom)`` returns those rows as an image. Modes ``reduce`` cannot
+    handle are converted to RGB band by band. Band heights are multiples of ``factor``,
+    so the result is the same as reducing the whole image at once.
+    """
+    width, height = size
+    out_mode = mode if mode in REDUCIBLE_MODES else 'RGB'
+    out = Image.new(out_mode, (-(-width // factor), -(-height // factor)))
+    rows = factor * max(1, DECODE_BAND_BYTES // (width * 4 * factor))
+    for top in range(0, height, rows):
+        band = read_band(top, min(height, top + rows))
+        if band.mode != out_mode:
+            band = band.convert(out_mode)
+        out.paste(band.reduce(factor), (0, top // factor))
+    return out
+
+
+class ImageAnalysisContext:
+    """Per-file state shared by the analyzers.
+
+    The file is opened at most once; the header, EXIF, reduced-resolution pixels and
+    stat result are each loaded the first time an analyzer asks for them and reused.
+    """
+
+    def __init__(self, image_path: Path, analysis_size: Tuple[int, int] = (150, 150), cache: Optional[AnalysisCache] = None, record: Optional[Dict[str, Any]] = None):
+        self.path = image_path
+        self.analysis_size = analysis_size
+        self.cache = cache
+        self.record = {}
+        self._dirty = False
+        self._stat = None
+        self._file = None
+        self._image = None
+        self._pixels = None
+        self._frames = None
+        self._frame_index = None
+        self._frame_index_read = False
+        self._reserved = 0
+        if record is not None:
+            self.record = dict(record)
+        elif cache is not None:
+            self.record = cache.get(self.stat) or {}
+        # Keys served from the cache that have not been counted as hits yet
+        self._unread = set(self.record)
+
+    def __enter__(self) -> "ImageAnalysisContext":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._dirty and self.cache is not None:
+            self.cache.put(self.stat, self.record)
+            self._dirty = False
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._pixels = self._frames = None
+        if self._reserved:
+            memory_budget.release(self._reserved)
+            self._reserved = 0
+
+    @property
+    def stat(self) -> os.stat_result:
+        if self._stat is None:
+            self._stat = self.path.stat()
+        return self._stat
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            self._file = open(self.path, 'rb')
+            self._image = Image.open(self._file, formats=PIL_FORMATS)
+        return self._image
+
+    def memo(self, key: str, compute) -> Any:
+        """Return ``record[key]``, computing and recording it for the cache on first use."""
+        if key not in self.record:
+            metrics.incr(f'cache.{key}.misses')
+            self.record[key] = compute()
+            self._dirty = True
+        elif key in self._unread:
+            self._unread.discard(key)
+            metrics.incr(f'cache.{key}.hits')
+        return self.record[key]
+
+    @property
+    def header(self) -> Dict[str, Any]:
+        return self.memo('header', self._read_header)
+
+    @property
+    def exif(self) -> Dict[str, Any]:
+        return self.memo('exif', self._read_exif)
+
+    @metrics.timed('stage.open')
+    def _read_header(self) -> Dict[str, Any]:
+        if self._image is None:
+            header = probe_image_header(self.path)
+            if header is not None and header["mode"] is not None:
+                return header
+        img = self.image
+        return {"format": img.format, "mode": img.mode, "width": img.width, "height": img.height}
+
+    @metrics.timed('stage.exif')
+    def _read_exif(self) -> Dict[str, Any]:
+        exif_data = {}
+        if self.header["format"] in ('GIF', 'BMP'):
+            return exif_data
+        img = self.image
+        if img.format == 'PNG' and 'exif' not in img.info:
+            # Pillow would decode every pixel looking for an eXIf chunk after the image data
+            return exif_data
+        if hasattr(img, '_getexif'):
+            exif = img._getexif()
+            if exif:
+                for tag_id, value in exif.items():
+                    tag = ExifTags.TAGS.get(tag_id, tag_id)
+                    if isinstance(value, bytes):
+                        try:
+                            value = value.decode('utf-8')
+                        except:
+                            value = str(value)
+                    exif_data[tag] = value
+        return exif_data
+
+    @property
+    def pixels(self) -> Image.Image:
+        """RGB copy of the image reduced to fit ``analysis_size``.
+
+        The codec is asked for a downscaled image up front: JPEG uses DCT scaling via
+        ``draft`` and other formats are box-reduced by an integer factor before the mode
+        conversion, so full-resolution pixels are never converted. Uncompressed layouts
+        (BMP, raw TIFF, PPM) are read and reduced a band of rows at a time, so only the
+        band is ever held at full resolution. Compared with converting at full resolution
+        and then thumbnailing, brightness agrees within 0.01 and dominant-colour
+        percentages within 2 points on photographic input.
+
+        Images over ``MAX_IMAGE_PIXELS``, or whose decode would need more than the whole
+        memory budget, are refused with a ``ValueError``; the rest wait for
+        ``memory_budget`` to admit their estimated size before decoding and hold the
+        reservation until the context is closed.
+        """
+        if self._pixels is None and self.animation is not None:
+            self._pixels = self.frames[len(self.frames) // 2]
+        if self._pixels is None:
+            self.header  # capture dimensions before draft()/thumbnail() resize the image in place
+            started = time.perf_counter()
+            img = self.image
+            self._check_pixel_limit(img)
+            target_width, target_height = self.analysis_size
+            if img.format == 'JPEG':
+                img.draft('RGB', self.analysis_size)
+            factor = min(img.width // target_width, img.height // target_height)
+            layout = raw_layout(img) if factor > 1 else None
+            reduced = decoded_bytes('RGB', img.width // max(factor, 1), img.height // max(factor, 1))
+            if layout is not None:
+                need = min(DECODE_BAND_BYTES * 3, decoded_bytes(img.mode, img.width, img.height) * 2) + reduced
+            else:
+                need = decoded_bytes(img.mode, img.width, img.height) + reduced
+                if factor > 1 and img.mode not in REDUCIBLE_MODES:
+                    need += DECODE_BAND_BYTES * 2
+                elif factor <= 1 and img.mode != 'RGB':
+                    need += reduced
+            self._admit(img, need)
+            if layout is not None:
+                metrics.incr('decode.banded')
+                img = reduce_in_bands(img.size, img.mode, factor, self._raw_band_reader(img, *layout))
+            elif factor > 1 and img.mode in REDUCIBLE_MODES:
+                img = img.reduce(factor)
+            elif factor > 1:
+                source = img
+                img = reduce_in_bands(img.size, img.mode, factor, lambda top, bottom: source.crop((0, top, source.width, bottom)))
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.thumbnail(self.analysis_size)
+            self._pixels = img
+            metrics.observe('stage.decode', time.perf_counter() - started)
+            metrics.incr('bytes.decoded', self.stat.st_size)
+        return self._pixels
+
+    def _check_pixel_limit(self, img: Image.Image) -> None:
+        if img.width * img.height > MAX_IMAGE_PIXELS:
+            metrics.incr('memory.rejected')
+            raise ValueError(f"{img.width}x{img.height} image exceeds the {MAX_IMAGE_PIXELS:,} pixel limit (IMAGE_ANALYSIS_MAX_PIXELS)")
+
+    def _admit(self, img: Image.Image, need: int) -> None:
+        """Reserve ``need`` bytes of the memory budget until close, refusing decodes larger than all of it."""
+        if need > memory_budget.limit:
+            metrics.incr('memory.rejected')
+            raise ValueError(f"decoding this {img.width}x{img.height} {img.format} image needs about {need / 2**20:,.0f} MB, more than the {memory_budget.limit / 2**20:,.0f} MB memory budget (IMAGE_ANALYSIS_MEMORY_BUDGET_MB)")
+        self._reserved += memory_budget.acquire(need)
+
+    @property
+    def frame_index(self) -> Optional[Tuple[bytes, List[Tuple[int, int, bool, int, int]]]]:
+        """``scan_animation_frames`` result for the file, read once."""
+        if not self._frame_index_read:
+            self._frame_index = scan_animation_frames(self.path, self.header["format"])
+            self._frame_index_read = True
+        return self._frame_index
+
+    @property
+    def animation(self) -> Optional[Dict[str, Any]]:
+        """Frame count and running time of an animated GIF or WebP; ``None`` for still images."""
+        if self.header["format"] not in _FRAME_SCANNERS:
+            return None
+        if self.frame_index is not None:
+            durations = [frame[3] for frame in self.frame_index[1]]
+            return {"frames": len(durations), "duration_ms": sum(durations)} if len(durations) > 1 else None
+        frames = getattr(self.image, 'n_frames', 1)
+        return {"frames": frames, "duration_ms": None} if frames > 1 else None
+
+    @property
+    def frames(self) -> List[Image.Image]:
+        """Reduced RGB frames sampled at evenly spaced points of an animation; ``[pixels]`` for a still image.
+
+        Each sample is reconstructed by decoding only its ``composite_chain`` from a small
+        standalone file cut out of the original, so the cost is bounded by
+        ``ANIMATION_SAMPLE_FRAMES`` and ``ANIMATION_COMPOSITE_FRAMES`` however long the
+        animation runs. Files the frame scanner cannot index fall back to Pillow's
+        ``seek``, sampling evenly by frame number. ``pixels`` of an animation is the
+        middle sample.
+        """
+        if self._frames is None:
+            animation = self.animation
+            if animation is None:
+                self._frames = [self.pixels]
+            else:
+                self._frames = self._sample_frames(animation["frames"])
+        return self._frames
+
+    @property
+    def sampled_pixels(self) -> Image.Image:
+        """``pixels``, or for an animation all sampled frames stacked vertically, for whole-file statistics."""
+        frames = self.frames
+        if len(frames) == 1:
+            return frames[0]
+        width, height = frames[0].size
+        strip = Image.new('RGB', (width, height * len(frames)))
+        for i, frame in enumerate(frames):
+            strip.paste(frame, (0, i * height))
+        return strip
+
+    def _sample_frames(self, frame_count: int) -> List[Image.Image]:
+        started = time.perf_counter()
+        img = self.image
+        self._check_pixel_limit(img)
+        # The canvas being composited, the frame being pasted and its RGB copy
+        self._admit(img, decoded_bytes('RGBA', img.width, img.height) * 3)
+        decoded = {}
+        if self.frame_index is not None:
+            prefix, table = self.frame_index
+            keyframes = [i for i, frame in enumerate(table) if frame[2]]
+            indices = sample_frame_indices([frame[3] for frame in table], ANIMATION_SAMPLE_FRAMES)
+            for index in indices:
+                if index in decoded:
+                    continue
+                chain = composite_chain(keyframes, [frame[4] for frame in table], index, ANIMATION_COMPOSITE_FRAMES)
+                data = build_animation(img.format, prefix, [os.pread(self._file.fileno(), table[i][1] - table[i][0], table[i][0]) for i in chain])
+                with Image.open(io.BytesIO(data), formats=(img.format,)) as frame:
+                    frame.seek(len(chain) - 1)
+                    decoded[index] = self._reduce_frame(frame)
+                metrics.incr('frames.decoded', len(chain))
+        else:
+            indices = sample_frame_indices([0] * frame_count, ANIMATION_SAMPLE_FRAMES)
+            for index in sorted(set(indices)):
+                img.seek(index)
+                decoded[index] = self._reduce_frame(img)
+            metrics.incr('frames.decoded', indices[-1] + 1)
+        metrics.observe('stage.decode', time.perf_counter() - started)
+        metrics.incr('bytes.decoded', self.stat.st_size)
+        return [decoded[index] for index in indices]
+
+    def _reduce_frame(self, frame: Image.Image) -> Image.Image:
+        frame = frame.convert('RGB')
+        frame.thumbnail(self.analysis_size)
+        return frame
+
+    def _raw_band_reader(self, img: Image.Image, offset: int, stride: int, ystep: int, rawmode: str) -> Callable[[int, int], Image.Image]:
+        fd = self._file.fileno()
+
+        def read_band(top: int, bottom: int) -> Image.Image:
+            # Bottom-up layouts (ystep -1) store the last row first
+            start = offset + (top if ystep == 1 else img.height - bottom) * stride
+            data = os.pread(fd, (bottom - top) * stride, start)
+            if len(data) < (bottom - top) * stride:
+                raise OSError("image file is truncated")
+            band = Image.frombytes(img.mode, (img.width, bottom - top), data, 'raw', rawmode, stride, ystep)
+            if img.mode == 'P' and img.palette is not None:
+                band.putpalette(img.palette)
+            return band
+        return read_band
+
+
+def bits_to_int(bits: Iterable[bool]) -> int:
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bool(bit)
+    return value
+
+def color_histogram(img: Image.Image, bits: int) -> List[int]:
+    """Pixel counts of an RGB image over ``2 ** (3 * bits)`` bins, keeping the top ``bits`` of each channel."""
+    shift = 8 - bits
+    if NUMPY_AVAILABLE:
+        binned = (np.asarray(img, dtype=np.uint8).reshape(-1, 3) >> shift).astype(np.intp)
+        return np.bincount((binned[:, 0] << (2 * bits)) | (binned[:, 1] << bits) | binned[:, 2], minlength=1 << (3 * bits)).tolist()
+    counts = [0] * (1 << (3 * bits))
+    for count, (r, g, b) in img.point(lambda v: v >> shift).getcolors(1 << (3 * bits)):
+        counts[(r << (2 * bits)) | (g << bits) | b] = count
+    return counts
+
+FEATURE_DIMENSIONS = 67
+
+# Perceptual hashes computed for each image, as named in the hashes record part
+HASH_TYPES = ("phash", "dhash", "ahash")
+
+# First 8 rows of the (unnormalised) 32-point DCT-II basis; only the lowest frequencies feed pHash
+_DCT_BASIS = [[math.cos(math.pi * (2 * n + 1) * k / 64) for n in range(32)] for k in range(8)]
+
+def dct_low_frequencies(values: List[float]) -> List[float]:
+    """Top-left 8x8 block of the 2-D DCT of a row-major 32x32 block, row-major."""
+    if NUMPY_AVAILABLE:
+        basis = np.array(_DCT_BASIS)
+        return (basis @ np.array(values, dtype=np.float64).reshape(32, 32) @ basis.T).ravel().tolist()
+    rows = [values[r * 32:(r + 1) * 32] for r in range(32)]
+    # Transform rows first (32x8), then the columns of the result (8x8)
+    partial = [[sum(b * x for b, x in zip(basis, row)) for basis in _DCT_BASIS] for row in rows]
+    return [sum(basis[r] * partial[r][k] for r in range(32)) for basis in _DCT_BASIS for k in range(8)]
+
+
+class EnhancedImageAnalysisServer:
+    def __init__(self, cache: Optional[AnalysisCache] = None):
         self.supported_formats = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
+        self.analysis_size = (150, 150)
+        self.color_bin_bits = 4
+        self.grayscale_tolerance = 0.01
+        self.cache = cache
+
+    def open_context(self, image_path: Path, record: Optional[Dict[str, Any]] = None) -> ImageAnalysisContext:
+        """Open ``image_path``, starting from ``record`` instead of the cache when given."""
+        return ImageAnalysisContext(image_path, self.analysis_size, self.cache, record)
+
+    @contextmanager
+    def _use_context(self, image_path: Path, context: Optional[ImageAnalysisContext]) -> Iterator[ImageAnalysisContext]:
+        if context is not None:
+            yield context
+        else:
+            with self.open_context(image_path) as context:
+                yield context
 
-    def analyze_image_colors(self, image_path: Path) -> Dict[str, Any]:
-        try:
-            with Image.open(image_path) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                img.thumbnail((150, 150))
-                colors = img.getcolors(maxcolors=256*256*256)
-                if not colors:
-                    return {"error": "Could not analyze colors"}
-                colors.sort(reverse=True)
-                top_colors = []
-                total_pixels = sum(count for count, color in colors)
-                for i, (count, color) in enumerate(colors[:5]):
-                    percentage = (count / total_pixels) * 100
-                    top_colors.append({"rgb": color, "hex": f"#{color[0]:02x}{color[1]:02x}{color[2]:02x}", "percentage": round(percentage, 2)})
-                return {"dominant_colors": top_colors, "color_family": self.classify_color(top_colors[0]["rgb"]), "is_grayscale": self.is_grayscale_image(img), "brightness": self.calculate_brightness(img)}
+    def analyze_image_colors(self, image_path: Path, context: Optional[ImageAnalysisContext] = None) -> Dict[str, Any]:
+        try:
+            with self._use_context(image_path, context) as ctx:
+                return ctx.memo('colors', lambda: self._compute_colors(ctx.sampled_pixels, ctx.animation))
         except Exception as e:
+            metrics.incr(f'errors.{type(e).__name__}')
             return {"error": f"Color analysis failed: {str(e)}"}
 
+    def dominant_colors(self, img: Image.Image, k: int = 5) -> List[Tuple[int, Tuple[int, int, int]]]:
+        """Return up to ``k`` ``(pixel_count, rgb)`` pairs for an RGB image, most frequent first.
+
+        Pixels are binned by ``color_histogram`` at ``color_bin_bits`` per channel, so
+        neighbouring shades count as one colour and the work is bounded by the bin count
+        rather than the number of distinct colours. Each colour is reported as its bin
+        centre; ties are broken by colour value.
+        """
+        bits = self.color_bin_bits
+        shift, mask = 8 - bits, (1 << bits) - 1
+        half = 1 << (shift - 1)
+        counts = color_histogram(img, bits)
+        top = heapq.nsmallest(k, (i for i, count in enumerate(counts) if count), key=lambda i: (-counts[i], i))
+        return [(counts[i], (((i >> (2 * bits)) << shift) | half, (((i >> bits) & mask) << shift) | half, ((i & mask) << shift) | half)) for i in top]
+
+    @metrics.timed('stage.colour')
+    def _compute_colors(self, img: Image.Image, animation: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        colors = self.dominant_colors(img)
+        if not colors:
+            return {"error": "Could not analyze colors"}
+        top_colors = []
+        total_pixels = img.width * img.height
+        for count, color in colors:
+            percentage = (count / total_pixels) * 100
+            top_colors.append({"rgb": color, "hex": f"#{color[0]:02x}{color[1]:02x}{color[2]:02x}", "percentage": round(percentage, 2)})
+        result = {"dominant_colors": top_colors, "color_family": self.classify_color(top_colors[0]["rgb"]), **self.pixel_statistics(img)}
+        if animation is not None:
+            result["animation"] = animation
+        return result
+
     def classify_color(self, rgb: Tuple[int, int, int]) -> str:
         r, g, b = rgb
         if abs(r - g) < 15 and abs(g - b) < 15 and abs(r - b) < 15:
@@ -69,148 +1265,1986 @@ class EnhancedImageAnalysisServer:
             return "yellow"
         return "mixed"
 
-    def is_grayscale_image(self, img: Image.Image) -> bool:
+    def pixel_statistics(self, img: Image.Image) -> Dict[str, Any]:
+        """Brightness, contrast, saturation and a grayscale verdict over the whole frame.
+
+        Everything is computed from C-level histograms of the reduced image, so no
+        per-pixel Python objects are created. Brightness is the mean luma and contrast
+        its standard deviation, both scaled to 0-1. The image counts as grayscale when
+        at most ``grayscale_tolerance`` of its pixels have channels more than 10 apart.
+        """
         if img.mode == 'L':
-            return True
-        elif img.mode == 'RGB':
-            for r, g, b in list(img.getdata())[:100]:
-                if abs(r - g) > 10 or abs(g - b) > 10:
-                    return False
-            return True
-        return False
+            luma, is_grayscale, saturation = img, True, 0.0
+        else:
+            img = img.convert('RGB') if img.mode != 'RGB' else img
+            luma = img.convert('L')
+            r, g, b = img.split()
+            spread = ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b)).histogram()
+            is_grayscale = sum(spread[11:]) <= self.grayscale_tolerance * img.width * img.height
+            saturation = ImageStat.Stat(img.convert('HSV').getchannel('S')).mean[0] / 255.0
+        stat = ImageStat.Stat(luma)
+        return {"is_grayscale": is_grayscale, "brightness": stat.mean[0] / 255.0, "contrast": round(stat.stddev[0] / 255.0, 4), "saturation": round(saturation, 4)}
+
+    def is_grayscale_image(self, img: Image.Image) -> bool:
+        return self.pixel_statistics(img)["is_grayscale"]
 
     def calculate_brightness(self, img: Image.Image) -> float:
         try:
-            pixels = list(img.convert('L').getdata())
-            return sum(pixels) / len(pixels) / 255.0
-        except:
+            return self.pixel_statistics(img)["brightness"]
+        except Exception:
             return 0.5
 
-    def extract_exif_data(self, image_path: Path) -> Dict[str, Any]:
-        try:
-            with Image.open(image_path) as img:
-                exif_data = {}
-                if hasattr(img, '_getexif'):
-                    exif = img._getexif()
-                    if exif:
-                        for tag_id, value in exif.items():
-                            tag = TAGS.get(tag_id, tag_id)
-                            if isinstance(value, bytes):
-                                try:
-                                    value = value.decode('utf-8')
-                                except:
-                                    value = str(value)
-                            exif_data[tag] = value
-                return exif_data
-        except Exception as e:
-            return {"error": f"EXIF extraction failed: {str(e)}"}
+    def extract_exif_data(self, image_path: Path, context: Optional[ImageAnalysisContext] = None) -> Dict[str, Any]:
+        try:
+            with self._use_context(image_path, context) as ctx:
+                return ctx.exif
+        except Exception as e:
+            metrics.incr(f'errors.{type(e).__name__}')
+            return {"error": f"EXIF extraction failed: {str(e)}"}
+
+    @metrics.timed('stage.analysis')
+    def advanced_heuristic_analysis(self, image_path: Path, context: Optional[ImageAnalysisContext] = None) -> Dict[str, Any]:
+        analysis = {}
+        try:
+            with self._use_context(image_path, context) as ctx:
+                width, height = ctx.header['width'], ctx.header['height']
+                analysis['orientation'] = 'landscape' if width > height else 'portrait' if height > width else 'square'
+                analysis['size_category'] = self.categorize_size(width * height)
+                analysis['aspect_ratio'] = round(width / height, 2)
+                color_info = self.analyze_image_colors(image_path, ctx)
+                analysis.update(color_info)
+                exif_data = self.extract_exif_data(image_path, ctx)
+                if exif_data and "error" not in exif_data:
+                    if 'Make' in exif_data or 'Model' in exif_data:
+                        analysis['source'] = 'camera'
+                    if 'Software' in exif_data:
+                        software = str(exif_data['Software']).lower()
+                        if 'screenshot' in software or 'capture' in software:
+                            analysis['type'] = 'screenshot'
+                        elif 'photoshop' in software or 'gimp' in software:
+                            analysis['type'] = 'edited'
+                    if 'DateTime' in exif_data:
+                        analysis['has_timestamp'] = True
+                analysis['file_size_category'] = self.categorize_file_size(ctx.stat.st_size)
+                analysis['filename_hints'] = self.analyze_filename(image_path.stem.lower())
+            metrics.incr('files.analyzed')
+        except Exception as e:
+            metrics.incr(f'errors.{type(e).__name__}')
+            analysis['error'] = str(e)
+        return analysis
+
+    def perceptual_hashes(self, image_path: Path, context: Optional[ImageAnalysisContext] = None) -> Dict[str, Any]:
+        try:
+            with self._use_context(image_path, context) as ctx:
+                return ctx.memo('hashes', lambda: self._compute_hashes(ctx.pixels))
+        except Exception as e:
+            metrics.incr(f'errors.{type(e).__name__}')
+            return {"error": f"Hashing failed: {str(e)}"}
+
+    @metrics.timed('stage.hashes')
+    def _compute_hashes(self, pixels: Image.Image) -> Dict[str, str]:
+        """64-bit average, difference and DCT hashes of the reduced decode, as hex strings."""
+        gray = pixels.convert('L')
+        small = list(gray.resize((8, 8), Image.BOX).getdata())
+        mean = sum(small) / 64
+        ahash = bits_to_int(value > mean for value in small)
+        wide = list(gray.resize((9, 8), Image.BOX).getdata())
+        dhash = bits_to_int(wide[row * 9 + col] < wide[row * 9 + col + 1] for row in range(8) for col in range(8))
+        coefficients = dct_low_frequencies(list(gray.resize((32, 32), Image.BOX).getdata()))
+        median = sorted(coefficients)[32]
+        phash = bits_to_int(value > median for value in coefficients)
+        return {'ahash': f"{ahash:016x}", 'dhash': f"{dhash:016x}", 'phash': f"{phash:016x}"}
+
+    def feature_vector(self, image_path: Path, context: Optional[ImageAnalysisContext] = None) -> Dict[str, Any]:
+        try:
+            with self._use_context(image_path, context) as ctx:
+                return {"vector": ctx.memo('features', lambda: self._compute_features(self.analyze_image_colors(image_path, ctx), ctx))}
+        except Exception as e:
+            metrics.incr(f'errors.{type(e).__name__}')
+            return {"error": f"Feature extraction failed: {str(e)}"}
+
+    @metrics.timed('stage.features')
+    def _compute_features(self, colors: Dict[str, Any], ctx: ImageAnalysisContext) -> List[float]:
+        """``FEATURE_DIMENSIONS`` floats: a 64-bin colour histogram plus brightness, saturation and aspect ratio.
+
+        Histogram bins hold the square root of each bin's pixel share, so the histogram
+        part has unit length and Euclidean distance between vectors tracks the
+        Hellinger distance between colour distributions.
+        """
+        if 'error' in colors:
+            raise ValueError(colors['error'])
+        counts = color_histogram(ctx.sampled_pixels, 2)
+        total = sum(counts) or 1
+        vector = [math.sqrt(count / total) for count in counts]
+        aspect = max(-2.0, min(2.0, math.log(ctx.header['width'] / ctx.header['height'])))
+        vector.extend([0.5 * colors['brightness'], 0.5 * colors['saturation'], 0.25 * aspect])
+        return [round(value, 5) for value in vector]
+
+    # Per-file tasks the analysis pipeline can run: (method, record keys a cached answer needs)
+    TASKS = {
+        'analysis': ('advanced_heuristic_analysis', ('header', 'exif', 'colors')),
+        'hashes': ('perceptual_hashes', ('hashes',)),
+        'features': ('feature_vector', ('features',)),
+    }
+
+    def lookup_analysis(self, image_path: Path, task: str = 'analysis') -> Tuple[Optional[Dict[str, Any]], Optional[ImageAnalysisContext]]:
+        """Answer ``task`` from the cache without touching image data.
+
+        Returns ``(result, None)`` when the cached record is complete, otherwise
+        ``(None, context)``: the closed context keeps the stat to store the record
+        computed elsewhere under, and the cached parts to start that computation from.
+        """
+        if self.cache is None:
+            return None, None
+        method, keys = self.TASKS[task]
+        try:
+            with self.open_context(image_path) as ctx:
+                if all(key in ctx.record for key in keys):
+                    return getattr(self, method)(image_path, ctx), None
+                return None, ctx
+        except Exception as e:
+            return {'error': str(e)}, None
+
+    def analyze_files(self, image_files: Iterable[Path], executor: Optional[Executor] = None, max_workers: int = 1, chunk_size: int = ANALYSIS_CHUNK_SIZE, cancelled: Optional[Callable[[], bool]] = None, task: str = 'analysis') -> Iterator[Tuple[Path, Dict[str, Any]]]:
+        """Yield ``(path, result)`` for each file, in input order, where ``task`` names an entry of ``TASKS``.
+
+        Cache hits are answered in-process. Misses are grouped into chunks of
+        ``chunk_size`` and sent to ``executor`` with the parts already cached; at most two
+        chunks per worker are in flight, and the records they return are merged into the
+        cache here so there is a single writer. If a worker dies and breaks the pool, the pool is discarded and
+        the affected chunks are analysed in-process. ``cancelled`` is polled between
+        files; once it returns true, queued chunks are cancelled and iteration stops.
+        """
+        cancelled = cancelled or (lambda: False)
+        compute = getattr(self, self.TASKS[task][0])
+        if executor is None:
+            for image_path in image_files:
+                if cancelled():
+                    return
+                yield image_path, compute(image_path)
+            return
+        max_in_flight = 2 * max_workers
+        slots = deque()  # [path, analysis, cached context, future, index, chunk size]
+        batch, in_flight = [], 0
+
+        def pool_broken() -> None:
+            nonlocal executor
+            if executor is not None:
+                logger.warning("A pool worker died; analysing its files in-process and starting a new pool on the next call")
+                metrics.incr('pool.broken')
+                discard_process_pool(executor)
+                executor = None
+
+        def submit():
+            nonlocal batch, in_flight
+            if executor is not None:
+                try:
+                    future = executor.submit(_analyze_chunk, [(str(slot[0]), slot[2] and slot[2].record) for slot in batch], task)
+                except BrokenExecutor:
+                    pool_broken()
+                    for slot in batch:
+                        slot[1] = compute(slot[0])
+                else:
+                    for slot in batch:
+                        slot[3], slot[5] = future, len(batch)
+                    in_flight += 1
+            batch = []
+
+        def pop_head() -> Tuple[Path, Dict[str, Any]]:
+            nonlocal in_flight
+            image_path, analysis, cached, future, index, size = slots.popleft()
+            if future is not None:
+                try:
+                    results, worker_metrics = future.result()
+                    analysis, record = results[index]
+                    if index == 0:
+                        metrics.merge(worker_metrics)
+                    if cached is not None and record:
+                        self.cache.put(cached.stat, record)
+                except BrokenExecutor:
+                    pool_broken()
+                    analysis = None
+                except Exception as e:
+                    analysis = {'error': f"Worker failed: {str(e)}"}
+                if index == size - 1:
+                    in_flight -= 1
+            if analysis is None:
+                analysis = compute(image_path)
+            return image_path, analysis
+
+        def head_ready() -> bool:
+            return bool(slots) and (slots[0][1] is not None or (slots[0][3] is not None and slots[0][3].done()))
+
+        def cancel_pending() -> bool:
+            if not cancelled():
+                return False
+            for slot in slots:
+                if slot[3] is not None:
+                    slot[3].cancel()
+            return True
+
+        for image_path in image_files:
+            analysis, cached = self.lookup_analysis(image_path, task)
+            slot = [image_path, analysis, cached, None, len(batch), 0]
+            slots.append(slot)
+            if analysis is None and executor is None:
+                slot[1] = compute(image_path)
+            elif analysis is None:
+                batch.append(slot)
+                if len(batch) >= chunk_size:
+                    submit()
+            while in_flight >= max_in_flight or head_ready():
+                if cancel_pending():
+                    return
+                yield pop_head()
+            if cancel_pending():
+                return
+        if batch:
+            submit()
+        while slots:
+            if cancel_pending():
+                return
+            yield pop_head()
+
+    def extract_metadata(self, image_path: Path, include_color_analysis: bool = True) -> Dict[str, Any]:
+        metadata = {"filename": image_path.name, "path": str(image_path)}
+        with self.open_context(image_path) as ctx:
+            header = ctx.header
+            metadata.update({"format": header["format"], "mode": header["mode"], "size": (header["width"], header["height"]), "width": header["width"], "height": header["height"], "aspect_ratio": round(header["width"] / header["height"], 3)})
+            
+            stat = ctx.stat
+            metadata.update({"file_size_bytes": stat.st_size, "file_size_mb": round(stat.st_size / (1024 * 1024), 2), "created": datetime.fromtimestamp(stat.st_ctime).isoformat(), "modified": datetime.fromtimestamp(stat.st_mtime).isoformat()})
+            
+            exif_data = self.extract_exif_data(image_path, ctx)
+            if exif_data and "error" not in exif_data:
+                metadata["exif"] = exif_data
+            
+            if include_color_analysis:
+                color_analysis = self.analyze_image_colors(image_path, ctx)
+                if "error" not in color_analysis:
+                    metadata["color_analysis"] = color_analysis
+        return metadata
+
+    def categorize_size(self, pixels: int) -> str:
+        return "huge" if pixels > 8000000 else "large" if pixels > 2000000 else "medium" if pixels > 500000 else "small"
+
+    def categorize_file_size(self, bytes_size: int) -> str:
+        mb = bytes_size / (1024 * 1024)
+        return "large" if mb > 10 else "medium" if mb > 1 else "small"
+
+    def analyze_filename(self, filename: str) -> List[str]:
+        hints = []
+        patterns = {
+            'screenshot': ['screenshot', 'screen', 'capture', 'scr'], 'photo': ['photo', 'img', 'pic', 'picture', 'dsc'],
+            'download': ['download', 'temp', 'untitled'], 'edited': ['edit', 'modified', 'copy', 'final'],
+            'scan': ['scan', 'document', 'doc'], 'avatar': ['avatar', 'profile', 'headshot'],
+            'logo': ['logo', 'brand', 'icon'], 'diagram': ['diagram', 'chart', 'graph', 'flowchart']
+        }
+        for category, keywords in patterns.items():
+            if any(keyword in filename for keyword in keywords):
+                hints.append(category)
+        return hints
+
+    @metrics.timed('stage.naming')
+    def generate_name_from_analysis(self, analysis: Dict[str, Any], style: str) -> str:
+        parts = []
+        if style == "descriptive":
+            if 'color_family' in analysis and analysis['color_family'] not in ['mixed', 'gray']:
+                parts.append(analysis['color_family'])
+            if analysis.get('orientation') != 'square':
+                parts.append(analysis['orientation'])
+        elif style == "technical":
+            parts.append(f"{analysis.get('size_category', 'medium')}_res")
+            parts.append(analysis.get('orientation', 'unknown'))
+            if 'animation' in analysis:
+                parts.append('animated')
+            if analysis.get('source') == 'camera':
+                parts.append('camera')
+            elif 'screenshot' in analysis.get('filename_hints', []):
+                parts.append('screenshot')
+        elif style == "artistic":
+            if 'color_family' in analysis:
+                parts.append(analysis['color_family'])
+            if analysis.get('brightness', 0.5) > 0.7:
+                parts.append('bright')
+            elif analysis.get('brightness', 0.5) < 0.3:
+                parts.append('dark')
+            if analysis.get('is_grayscale'):
+                parts.append('bw')
+        elif style == "location":
+            if 'has_timestamp' in analysis:
+                parts.append('dated')
+            parts.append(analysis.get('orientation', 'photo'))
+        hints = analysis.get('filename_hints', [])
+        for hint in hints[:1]:
+            if hint not in parts:
+                parts.append(hint)
+        return '_'.join(parts) if parts else 'image'
+
+    def is_image_file(self, file_path: Path) -> bool:
+        return file_path.suffix.lower() in self.supported_formats
+
+    def iter_image_files(self, directory: Path, recursive: bool = False, max_depth: Optional[int] = None, include: Optional[List[str]] = None, exclude: Optional[List[str]] = None, skip_hidden: bool = False) -> Iterator[Path]:
+        """Yield supported images under ``directory`` as they are discovered; see ``iter_image_entries``."""
+        return (Path(entry.path) for entry in self.iter_image_entries(directory, recursive, max_depth, include, exclude, skip_hidden))
+
+    def iter_image_entries(self, directory: Path, recursive: bool = False, max_depth: Optional[int] = None, include: Optional[List[str]] = None, exclude: Optional[List[str]] = None, skip_hidden: bool = False) -> Iterator[os.DirEntry]:
+        """Yield ``DirEntry`` objects for supported images under ``directory`` as they are discovered.
+
+        Built on ``os.scandir``: names are filtered by extension before anything is
+        stat'ed, and ``DirEntry`` type information avoids a stat per entry on most
+        filesystems. Entries are visited depth-first in name order, which matches the
+        order of ``sorted()`` over the full result. ``include``/``exclude`` are globs
+        matched against the path relative to ``directory`` and against the bare name;
+        excluded directories are not descended into. Every directory, linked or not, is
+        entered at most once per (device, inode), so link loops terminate and a directory
+        also reachable through a symlink is not walked twice.
+        """
+        if not recursive:
+            max_depth = 0
+        visited = set()
+        try:
+            st = directory.stat()
+            visited.add((st.st_dev, st.st_ino))
+        except OSError as e:
+            logger.error(f"Error scanning directory: {e}")
+            return
+
+        def matches(rel: str, name: str, patterns: Optional[List[str]]) -> bool:
+            return bool(patterns) and any(fnmatch.fnmatch(rel, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+        def identity(entry: os.DirEntry) -> Tuple[int, int]:
+            st = entry.stat()
+            if not st.st_ino:
+                # DirEntry.stat() leaves the device and inode zero on Windows
+                st = os.stat(entry.path)
+            return st.st_dev, st.st_ino
+
+        def listing(path: str, prefix: str) -> Iterator[Tuple[os.DirEntry, str]]:
+            try:
+                with os.scandir(path) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError as e:
+                logger.error(f"Error scanning directory {path}: {e}")
+                return iter(())
+            return ((entry, prefix + entry.name) for entry in entries)
+
+        stack = [(listing(str(directory), ''), 0)]
+        while stack:
+            entries, depth = stack[-1]
+            item = next(entries, None)
+            if item is None:
+                stack.pop()
+                continue
+            entry, rel = item
+            name = entry.name
+            if skip_hidden and name.startswith('.'):
+                continue
+            if os.path.splitext(name)[1].lower() in self.supported_formats:
+                try:
+                    if entry.is_file() and not matches(rel, name, exclude) and (not include or matches(rel, name, include)):
+                        yield entry
+                        continue
+                except OSError:
+                    continue
+            if max_depth is not None and depth >= max_depth:
+                continue
+            try:
+                if not entry.is_dir() or matches(rel, name, exclude):
+                    continue
+                key = identity(entry)
+                if key in visited:
+                    continue
+                visited.add(key)
+            except OSError:
+                continue
+            stack.append((listing(entry.path, rel + '/'), depth + 1))
+
+    def get_image_files(self, directory: Path, recursive: bool = False) -> List[Path]:
+        return list(self.iter_image_files(directory, recursive))
+
+_worker_server = None
+
+def _init_worker(budget_state: Tuple[Any, Any, Any]) -> None:
+    """Process-pool initializer: share the parent's memory budget."""
+    memory_budget.attach(budget_state)
+
+def _analyze_chunk(items: List[Tuple[str, Optional[Dict[str, Any]]]], task: str = 'analysis') -> Tuple[List[Tuple[Dict[str, Any], Dict[str, Any]]], Dict[str, Any]]:
+    """Process-pool entry point: run ``task`` on a chunk of ``(path, cached record)`` items.
+
+    Returns ``(result, record)`` pairs plus the worker's metrics for the chunk.
+    """
+    global _worker_server
+    if _worker_server is None:
+        _worker_server = EnhancedImageAnalysisServer()
+        # Importing the module in the worker may already have counted something
+        metrics.reset()
+    compute = getattr(_worker_server, _worker_server.TASKS[task][0])
+    results = []
+    for image_path, cached in items:
+        path = Path(image_path)
+        try:
+            with _worker_server.open_context(path, cached) as ctx:
+                analysis = compute(path, ctx)
+                record = json.loads(json.dumps(ctx.record, default=str))
+        except Exception as e:
+            analysis, record = {'error': str(e)}, {}
+        results.append((analysis, record))
+    return results, metrics.drain()
+
+_process_pool = None
+_thread_pool = None
+_io_pool = None
+_pool_lock = threading.Lock()
+
+def get_process_pool() -> Executor:
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            _process_pool = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS, mp_context=mp_context(), initializer=_init_worker, initargs=(memory_budget.shared_state(),))
+        return _process_pool
+
+def discard_process_pool(pool: Executor) -> None:
+    """Drop a broken pool so the next ``get_process_pool`` call starts a fresh one."""
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    # Workers killed mid-decode never release their share of the memory budget
+    pids = list(getattr(pool, '_processes', None) or ())
+    pool.shutdown(wait=False, cancel_futures=True)
+    memory_budget.reclaim(pids)
+
+def get_io_pool() -> ThreadPoolExecutor:
+    """Threads for fanning out header and EXIF reads, separate from the tool-call threads."""
+    global _io_pool
+    with _pool_lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="image-io")
+        return _io_pool
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    with _pool_lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix="image-analysis")
+        return _thread_pool
+
+async def run_blocking(func, *args) -> Any:
+    """Run blocking PIL and filesystem work on the shared thread pool so the event loop stays free."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_thread_pool(), functools.partial(func, *args))
+
+def shutdown_pools() -> None:
+    global _process_pool, _thread_pool, _io_pool
+    with _pool_lock:
+        if _io_pool is not None:
+            _io_pool.shutdown(wait=False, cancel_futures=True)
+            _io_pool = None
+        if _thread_pool is not None:
+            _thread_pool.shutdown(wait=False, cancel_futures=True)
+            _thread_pool = None
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+
+class ToolRun:
+    """Progress reporting and cancellation for one tool call running off the event loop.
+
+    Progress notifications are only sent when the client supplied a progress token, and
+    at most once per ``interval`` seconds. ``cancelled`` is set by the event loop when the
+    client cancels the request and is polled by the worker thread between files.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, session: Any = None, progress_token: Any = None, interval: float = 1.0):
+        self.loop = loop
+        self.session = session
+        self.progress_token = progress_token
+        self.interval = interval
+        self.cancelled = threading.Event()
+        self._last_progress = 0.0
+
+    @classmethod
+    def for_request(cls, arguments: Dict[str, Any]) -> "ToolRun":
+        try:
+            interval = float(arguments.get("progress_interval", 1.0))
+        except (TypeError, ValueError):
+            raise ValueError(f"progress_interval must be a number of seconds, got {arguments['progress_interval']!r}") from None
+        try:
+            ctx = server.request_context
+        except LookupError:
+            return cls()
+        token = ctx.meta.progressToken if ctx.meta is not None else None
+        return cls(asyncio.get_running_loop(), ctx.session, token, interval)
+
+    def progress(self, done: int, total: Optional[int], message: Optional[str] = None) -> None:
+        if self.progress_token is None or self.loop is None:
+            return
+        now = time.monotonic()
+        if (total is None or done < total) and now - self._last_progress < self.interval:
+            return
+        self._last_progress = now
+        asyncio.run_coroutine_threadsafe(self.session.send_progress_notification(self.progress_token, done, total, message), self.loop)
+
+    def is_cancelled(self) -> bool:
+        return self.cancelled.is_set()
+
+class ForegroundActivity:
+    """Counts tool calls in flight so background work can stand aside while any are running."""
+
+    def __init__(self):
+        self._active = 0
+        self._lock = threading.Lock()
+        self.idle = threading.Event()
+        self.idle.set()
+
+    def __enter__(self) -> "ForegroundActivity":
+        with self._lock:
+            self._active += 1
+            self.idle.clear()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        with self._lock:
+            self._active -= 1
+            if self._active == 0:
+                self.idle.set()
+
+foreground = ForegroundActivity()
+
+class ClientLimits:
+    """Caps the tool calls each client session runs at once when many clients share the server.
+
+    Calls beyond ``per_client`` wait for one of that session's earlier calls to finish, so
+    a client submitting a burst of work cannot starve the others of the shared pools.
+    ``None`` leaves calls unlimited. Once ``closing`` is set new calls are refused.
+    """
+
+    def __init__(self, per_client: Optional[int] = None):
+        self.per_client = per_client
+        self.closing = False
+        # Calls holding a slot; only touched on the event loop
+        self.running = 0
+        self._slots: "weakref.WeakKeyDictionary[Any, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.closing:
+            raise RuntimeError("Server is shutting down")
+        try:
+            session = server.request_context.session
+        except LookupError:
+            session = None
+        if session is None or self.per_client is None:
+            yield
+            return
+        semaphore = self._slots.get(session)
+        if semaphore is None:
+            semaphore = self._slots[session] = asyncio.Semaphore(self.per_client)
+        if semaphore.locked():
+            metrics.incr("http.calls_queued")
+        async with semaphore:
+            self.running += 1
+            try:
+                yield
+            finally:
+                self.running -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"clients": len(self._slots), "running_calls": self.running, "max_calls_per_client": self.per_client}
+
+# Unlimited until serving over HTTP; stdio has a single client
+client_limits = ClientLimits()
+
+
+class DirectorySnapshot:
+    """What a tool saw in a directory on its previous run, persisted in the analysis cache.
+
+    Each entry maps the path relative to the directory to ``[size, mtime_ns, inode,
+    analysis]``. ``diff`` compares a fresh walk against it so only added, changed,
+    not-yet-analysed or previously failed files are handed on; ``results`` merges
+    their new analyses with the unchanged ones in walk order. Snapshots are keyed by
+    ``ANALYZER_VERSION`` like the cache, so a new analyser starts from scratch.
+    """
+
+    def __init__(self, cache: Optional[AnalysisCache], directory: Path, options: Dict[str, Any]):
+        self.cache = cache
+        self.directory = directory
+        self.key = json.dumps([str(directory.resolve()), options, ANALYZER_VERSION], sort_keys=True, default=str)
+        previous = cache.get_snapshot(self.key) if cache is not None else None
+        self.exists = previous is not None
+        self.previous = previous["entries"] if previous else {}
+        self.entries, self.order = {}, []
+        self.added, self.changed = [], []
+
+    def _rel(self, image_path: Path) -> str:
+        return os.path.relpath(image_path, self.directory)
+
+    def diff(self, entries: Iterable[os.DirEntry], need_analysis: bool = True) -> Iterator[Path]:
+        """Yield paths that are new or changed, plus unchanged ones lacking an analysis if ``need_analysis``."""
+        for entry in entries:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            rel = self._rel(entry.path)
+            identity = [st.st_size, st.st_mtime_ns, st.st_ino]
+            prior = self.previous.get(rel)
+            self.order.append(rel)
+            if prior is not None and prior[:3] == identity:
+                self.entries[rel] = prior
+                if not (need_analysis and (prior[3] is None or 'error' in prior[3])):
+                    continue
+            else:
+                (self.changed if prior is not None else self.added).append(rel)
+                self.entries[rel] = identity + [None]
+            yield Path(entry.path)
+
+    @property
+    def removed(self) -> List[str]:
+        return [rel for rel in self.previous if rel not in self.entries]
+
+    def summary(self) -> str:
+        return f"🔄 Since last scan: {len(self.added)} added, {len(self.changed)} changed, {len(self.removed)} removed"
+
+    def changes(self) -> Dict[str, int]:
+        return {"added": len(self.added), "changed": len(self.changed), "removed": len(self.removed)}
+
+    def record(self, image_path: Path, analysis: Dict[str, Any]) -> None:
+        entry = self.entries.get(self._rel(image_path))
+        if entry is not None:
+            entry[3] = analysis
+
+    def moved(self, old_path: Path, new_path: Path) -> None:
+        entry = self.entries.pop(self._rel(old_path), None)
+        if entry is not None and new_path.parent == old_path.parent:
+            # Filename hints are part of the analysis; the cache re-derives it cheaply next run
+            self.entries[self._rel(new_path)] = entry[:3] + [None]
+
+    def results(self, only_delta: bool = False) -> List[Tuple[Path, Dict[str, Any]]]:
+        delta = set(self.added) | set(self.changed)
+        return [(self.directory / rel, self.entries[rel][3] or {}) for rel in self.order if not only_delta or rel in delta]
+
+    def save(self) -> None:
+        if self.cache is None:
+            return
+        try:
+            dir_mtime_ns = self.directory.stat().st_mtime_ns
+        except OSError:
+            return
+        self.cache.put_snapshot(self.key, dir_mtime_ns, self.entries)
+
+
+class ResultPages:
+    """Computed results of recent directory runs, served a page at a time.
+
+    A run's header, per-file entries and footer are kept in memory so that follow-up
+    calls with a cursor never rescan or re-analyse the directory. The oldest runs are
+    dropped beyond ``max_runs`` or after ``ttl`` seconds. Runs stored with a structured
+    ``output_format`` keep a summary dict and result records instead of text, and their
+    pages are rendered with ``render_structured``.
+    """
+
+    MAX_PAGE_SIZE = 1000
+
+    def __init__(self, max_runs: int = 32, ttl: float = 3600):
+        self.max_runs = max_runs
+        self.ttl = ttl
+        self._runs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def store(self, header: List[str], entries: List[Any], footer: List[str], output_format: str = "text", summary: Optional[Dict[str, Any]] = None) -> str:
+        run_id = secrets.token_urlsafe(8)
+        with self._lock:
+            self._runs[run_id] = {"header": header, "entries": entries, "footer": footer, "format": output_format, "summary": summary, "created": time.monotonic()}
+            while len(self._runs) > self.max_runs:
+                self._runs.popitem(last=False)
+        return run_id
+
+    @staticmethod
+    def encode_cursor(run_id: str, offset: int) -> str:
+        return base64.urlsafe_b64encode(f"{run_id}:{offset}".encode()).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[str, int]:
+        try:
+            run_id, offset = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().rsplit(':', 1)
+            return run_id, int(offset)
+        except ValueError:
+            raise ValueError(f"Invalid cursor: {cursor}")
+
+    def render(self, run_id: str, offset: int, limit: int) -> str:
+        limit = max(1, min(int(limit), self.MAX_PAGE_SIZE))
+        with self._lock:
+            state = self._runs.get(run_id)
+            if state is None or time.monotonic() - state["created"] > self.ttl:
+                self._runs.pop(run_id, None)
+                raise ValueError("Cursor has expired; run the tool again without a cursor")
+        entries = state["entries"]
+        page = entries[offset:offset + limit]
+        if state["format"] != "text":
+            more = offset + limit < len(entries)
+            paging = {"offset": offset, "count": len(page), "total": len(entries), "next_cursor": self.encode_cursor(run_id, offset + limit) if more else None}
+            return render_structured(state["format"], state["summary"] if offset == 0 else None, page, paging=paging)
+        parts = list(state["header"]) if offset == 0 else [f"📄 Results {offset + 1}-{offset + len(page)} of {len(entries)}", ""]
+        parts.extend(page)
+        if offset == 0:
+            parts.extend(state["footer"])
+        if offset + limit < len(entries):
+            parts.extend(["", f"📄 Showing {offset + 1}-{offset + len(page)} of {len(entries)}. Next cursor: {self.encode_cursor(run_id, offset + limit)}"])
+        return "\n".join(parts)
+
+    def page(self, cursor: str, limit: int) -> str:
+        run_id, offset = self.decode_cursor(cursor)
+        return self.render(run_id, offset, limit)
+
+result_pages = ResultPages()
+
+OUTPUT_FORMATS = ("text", "json", "jsonl")
+OUTPUT_PROPERTIES = {
+    "output_format": {"type": "string", "default": "text", "enum": list(OUTPUT_FORMATS), "description": "text is the readable report; json and jsonl return compact structured results"},
+    "fields": {"type": ["array", "string"], "items": {"type": "string"}, "description": "Keep only these result fields (list or comma-separated), e.g. path,suggested,analysis.colors.dominant_color"}
+}
+
+def output_options(arguments: Dict[str, Any]) -> Tuple[str, Optional[List[str]]]:
+    """The ``output_format`` and ``fields`` arguments shared by every tool, validated."""
+    output_format = arguments.get("output_format", "text")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output_format: {output_format} (expected one of {', '.join(OUTPUT_FORMATS)})")
+    fields = arguments.get("fields")
+    if isinstance(fields, str):
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+    return output_format, fields or None
+
+def project_fields(record: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    """Keep only ``fields`` of ``record``; dotted names such as ``exif.DateTimeOriginal`` select nested keys."""
+    projected = {}
+    for field in fields:
+        keys = field.split('.')
+        value = record
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projected
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return projected
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, default=str, separators=(',', ':'), ensure_ascii=False)
+
+def render_structured(output_format: str, summary: Optional[Dict[str, Any]], records: List[Dict[str, Any]], fields: Optional[List[str]] = None, paging: Optional[Dict[str, Any]] = None) -> str:
+    """Serialise a tool's summary and per-item ``records`` as compact JSON or JSON Lines.
+
+    ``json`` is one object with ``summary``, ``results`` and, for paged runs, ``page``.
+    ``jsonl`` puts ``{"summary": ...}`` on the first line, one record per line after it
+    and ``{"page": ...}`` last. ``fields`` projects each record; the summary is kept
+    whole.
+    """
+    if fields:
+        records = [project_fields(record, fields) for record in records]
+    if output_format == "json":
+        document = {} if summary is None else {"summary": summary}
+        document["results"] = records
+        if paging is not None:
+            document["page"] = paging
+        return _dumps(document)
+    lines = [] if summary is None else [_dumps({"summary": summary})]
+    lines.extend(_dumps(record) for record in records)
+    if paging is not None:
+        lines.append(_dumps({"page": paging}))
+    return "\n".join(lines)
+
+def structured_reply(output_format: str, summary: Optional[Dict[str, Any]], records: List[Dict[str, Any]], fields: Optional[List[str]] = None, limit: Optional[int] = None) -> list[TextContent]:
+    """``render_structured`` as a tool result, paged through ``result_pages`` when ``limit`` is given."""
+    if limit is not None:
+        if fields:
+            records = [project_fields(record, fields) for record in records]
+        run_id = result_pages.store([], records, [], output_format, summary)
+        return [TextContent(type="text", text=result_pages.render(run_id, 0, limit))]
+    return [TextContent(type="text", text=render_structured(output_format, summary, records, fields))]
+
+def render_record(output_format: str, record: Dict[str, Any], fields: Optional[List[str]] = None) -> list[TextContent]:
+    """A single-item tool result as one compact JSON object (the same for ``json`` and ``jsonl``)."""
+    return [TextContent(type="text", text=_dumps(project_fields(record, fields) if fields else record))]
+
+def error_reply(output_format: str, message: str) -> list[TextContent]:
+    """An early-exit error: the plain message, or ``{"error": ...}`` in structured modes."""
+    if output_format == "text":
+        return [TextContent(type="text", text=message)]
+    return [TextContent(type="text", text=_dumps({"error": message}))]
+
+class RenamePlan:
+    """Collision-free target names for a batch of renames, reserved in memory.
+
+    Each target directory is listed once and every name in it, plus every name handed
+    out earlier in the plan, counts as taken, so no file is stat'ed per attempt. The
+    next free ``_N`` suffix is remembered per base name, which keeps thousands of files
+    mapping to one name linear. Names are compared case-insensitively so plans are also
+    safe on case-insensitive filesystems.
+    """
+
+    def __init__(self, journal_root: Path = JOURNAL_DIR):
+        self.journal_root = journal_root
+        self._taken = {}
+        self._counters = {}
+        self._renamed = None
+
+    def taken(self, directory: Path) -> set:
+        names = self._taken.get(directory)
+        if names is None:
+            try:
+                names = {name.casefold() for name in os.listdir(directory)}
+            except FileNotFoundError:
+                names = set()
+            self._taken[directory] = names
+        return names
+
+    def reserve(self, source: Path, directory: Path, name: str) -> Path:
+        """Return the path ``source`` should move to; ``source`` itself when it can stay.
+
+        A file that an earlier journaled plan renamed to ``name``, or a numbered variant
+        of it, in ``directory`` keeps its name, so re-running a plan is a no-op. Other
+        files that merely look numbered, like ``IMG_2041.jpg``, are planned as usual.
+        """
+        stem, ext = os.path.splitext(name)
+        taken = self.taken(directory)
+        if source.parent == directory and re.fullmatch(re.escape(stem) + r'(_\d+)?' + re.escape(ext), source.name, re.IGNORECASE) and self.renamed(source):
+            return source
+        key = (directory, stem.casefold(), ext.casefold())
+        counter = self._counters.get(key, 0)
+        candidate = name if counter == 0 else f"{stem}_{counter}{ext}"
+        while candidate.casefold() in taken:
+            counter += 1
+            candidate = f"{stem}_{counter}{ext}"
+        self._counters[key] = counter
+        taken.add(candidate.casefold())
+        return directory / candidate
+
+    def claim(self, target: Path) -> None:
+        """Mark ``target`` as taken, e.g. when replaying reservations made before a restart."""
+        self.taken(target.parent).add(target.name.casefold())
+
+    def renamed(self, path: Path) -> bool:
+        """Whether ``path`` is where an applied journal moved a file; journals are read on first use."""
+        if self._renamed is None:
+            self._renamed = RenameJournal.current_targets(self.journal_root)
+        return os.path.abspath(path) in self._renamed
+
+
+def move_no_replace(source: Path, target: Path) -> None:
+    """Rename ``source`` to ``target``, failing rather than overwriting if ``target`` exists.
+
+    A hard link claims the new name atomically; filesystems without hard links fall back
+    to a check followed by a plain rename.
+    """
+    try:
+        os.link(source, target, follow_symlinks=False)
+    except FileExistsError:
+        raise FileExistsError(errno.EEXIST, "Target already exists", str(target))
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EXDEV, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK, errno.ENOSYS):
+            raise
+        if os.path.lexists(target):
+            raise FileExistsError(errno.EEXIST, "Target already exists", str(target))
+        os.rename(source, target)
+        return
+    os.unlink(source)
+
+
+class RenameJournal:
+    """Write-ahead log for one batch of renames, so it can be applied, resumed and rolled back.
+
+    The first line holds the whole plan and is synced before anything moves; each
+    completed move, undo or created directory then appends a line. After a crash the
+    filesystem is checked for moves that happened but were not yet logged, so ``apply``
+    can resume where it stopped and ``rollback`` can undo exactly what was done.
+    """
+
+    SYNC_EVERY = 100
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.id = path.stem
+        self.plan = {}
+        self.done, self.undone, self.created_dirs = set(), set(), []
+        self.state = "planned"
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash; everything before it is intact
+                    break
+                if "moves" in event:
+                    self.plan = event
+                elif "done" in event:
+                    self.done.add(event["done"])
+                elif "undone" in event:
+                    self.undone.add(event["undone"])
+                elif "created_dir" in event:
+                    self.created_dirs.append(event["created_dir"])
+                elif "state" in event:
+                    self.state = event["state"]
+        self.moves = [(Path(source), Path(target)) for source, target in self.plan.get("moves", [])]
+
+    @classmethod
+    def create(cls, tool: str, directory: Path, moves: List[Tuple[Path, Path]], directory_root: Path = JOURNAL_DIR) -> "RenameJournal":
+        directory_root.mkdir(parents=True, exist_ok=True)
+        journal_id = f"{datetime.now():%Y%m%d-%H%M%S}-{secrets.token_hex(3)}"
+        path = directory_root / f"{journal_id}.jsonl"
+        plan = {"moves": [[str(source), str(target)] for source, target in moves], "tool": tool, "directory": str(directory), "created": datetime.now().isoformat(timespec='seconds')}
+        with open(path, 'x', encoding='utf-8') as f:
+            f.write(json.dumps(plan) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return cls(path)
+
+    @classmethod
+    def open(cls, journal_id: str, directory_root: Path = JOURNAL_DIR) -> "RenameJournal":
+        if not re.fullmatch(r'[\w-]+', journal_id or ''):
+            raise ValueError(f"Invalid journal id: {journal_id}")
+        path = directory_root / f"{journal_id}.jsonl"
+        if not path.exists():
+            raise ValueError(f"No rename journal with id {journal_id}")
+        return cls(path)
+
+    @classmethod
+    def list_all(cls, directory_root: Path = JOURNAL_DIR) -> List["RenameJournal"]:
+        if not directory_root.is_dir():
+            return []
+        return [cls(path) for path in sorted(directory_root.glob("*.jsonl"), reverse=True)]
+
+    @classmethod
+    def current_targets(cls, directory_root: Path = JOURNAL_DIR) -> set:
+        """Absolute paths files were moved to by journals and have not been moved away from since."""
+        targets = set()
+        for journal in reversed(cls.list_all(directory_root)):
+            for i, (source, target) in enumerate(journal.moves):
+                if i in journal.done and i not in journal.undone:
+                    targets.discard(os.path.abspath(source))
+                    targets.add(os.path.abspath(target))
+        return targets
+
+    @contextmanager
+    def _log(self) -> Iterator[Callable[[Dict[str, Any]], None]]:
+        with open(self.path, 'a', encoding='utf-8') as f:
+            written = 0
+
+            def log(event: Dict[str, Any]) -> None:
+                nonlocal written
+                f.write(json.dumps(event) + "\n")
+                f.flush()
+                written += 1
+                if written % self.SYNC_EVERY == 0:
+                    os.fsync(f.fileno())
+            try:
+                yield log
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _happened(self, source: Path, target: Path) -> bool:
+        """Whether a move not marked done was in fact carried out (or half carried out) before a crash."""
+        if not os.path.lexists(target):
+            return False
+        if not os.path.lexists(source):
+            return True
+        if os.path.samefile(source, target):
+            # Interrupted between claiming the target with a hard link and removing the source
+            os.unlink(source)
+            return True
+        return False
+
+    def apply(self, cancelled: Optional[Callable[[], bool]] = None, on_move: Optional[Callable[[Path, Path], None]] = None) -> Tuple[List[int], List[Tuple[int, str]]]:
+        """Carry out the moves not yet done, in plan order; returns ``(moved indices, [(index, error)])``."""
+        if self.state == "rolled_back":
+            raise ValueError(f"Journal {self.id} has been rolled back")
+        moved, errors = [], []
+        with self._log() as log:
+            for i, (source, target) in enumerate(self.moves):
+                if i in self.done:
+                    continue
+                if cancelled is not None and cancelled():
+                    return moved, errors
+                try:
+                    if not self._happened(source, target):
+                        if not target.parent.exists():
+                            target.parent.mkdir(parents=True)
+                            self.created_dirs.append(str(target.parent))
+                            log({"created_dir": str(target.parent)})
+                        move_no_replace(source, target)
+                except Exception as e:
+                    errors.append((i, str(e)))
+                    continue
+                self.done.add(i)
+                log({"done": i})
+                moved.append(i)
+                if on_move is not None:
+                    on_move(source, target)
+            self.state = "applied"
+            log({"state": "applied"})
+        return moved, errors
+
+    def rollback(self) -> Tuple[List[int], List[Tuple[int, str]]]:
+        """Move every completed rename back, newest first, and remove directories the batch created."""
+        restored, errors = [], []
+        with self._log() as log:
+            for i in reversed(range(len(self.moves))):
+                source, target = self.moves[i]
+                if i in self.undone or not (i in self.done or self._happened(source, target)):
+                    continue
+                try:
+                    move_no_replace(target, source)
+                except Exception as e:
+                    errors.append((i, str(e)))
+                    continue
+                self.undone.add(i)
+                log({"undone": i})
+                restored.append(i)
+            for directory in reversed(self.created_dirs):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+            self.state = "rolled_back"
+            log({"state": "rolled_back"})
+        return restored, errors
+
+    def summary(self) -> str:
+        return f"🧾 {self.id}: {self.plan.get('tool', '?')} in {self.plan.get('directory', '?')} — {len(self.done)}/{len(self.moves)} moved, {len(self.undone)} rolled back ({self.state})"
+
+    def describe(self) -> Dict[str, Any]:
+        return {"id": self.id, "tool": self.plan.get("tool"), "directory": self.plan.get("directory"), "created": self.plan.get("created"), "moves": len(self.moves), "moved": len(self.done), "rolled_back": len(self.undone), "state": self.state}
+
+def analyze_image_files(image_files: Iterable[Path], run: Optional[ToolRun] = None, task: str = 'analysis') -> Iterator[Tuple[Path, Dict[str, Any]]]:
+    """Analyse ``image_files`` in order as they are discovered.
+
+    The process pool is only used once at least ``PARALLEL_MIN_FILES`` files have been
+    seen. Progress totals are reported as soon as discovery has finished, and a final
+    notification with the total always follows the last file.
+    """
+    run = run or ToolRun()
+    discovered, exhausted = 0, False
+
+    def counted() -> Iterator[Path]:
+        nonlocal discovered, exhausted
+        for image_path in image_files:
+            discovered += 1
+            yield image_path
+        exhausted = True
+
+    source = counted()
+    head = list(islice(source, PARALLEL_MIN_FILES))
+    if ANALYSIS_WORKERS > 1 and len(head) >= PARALLEL_MIN_FILES:
+        analyses = image_server.analyze_files(chain(head, source), get_process_pool(), ANALYSIS_WORKERS, cancelled=run.is_cancelled, task=task)
+    else:
+        analyses = image_server.analyze_files(chain(head, source), cancelled=run.is_cancelled, task=task)
+    i, total = 0, None
+    for i, (image_path, analysis) in enumerate(analyses, 1):
+        yield image_path, analysis
+        total = discovered if exhausted else None
+        run.progress(i, total, f"[{i}/{total or '?'}] {image_path.name}")
+    # Streamed discovery only ends when the files run out, after the last notification went
+    if total != i and not run.is_cancelled():
+        run.progress(i, i, f"[{i}/{i}] done")
+
+class Inotify:
+    """Minimal ctypes binding to Linux inotify; raises ``OSError`` where it is unavailable."""
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def add_watch(self, path: str) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            import ctypes
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_add_watch failed for {path}: {os.strerror(err)}")
+        self.paths[wd] = path
+
+    def read(self, timeout: float) -> List[Tuple[int, Optional[str]]]:
+        """Return ``(mask, path)`` events, waiting up to ``timeout`` seconds for the first."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset + self._EVENT.size <= len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            directory = self.paths.get(wd)
+            if mask & self.IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif mask & self.IN_Q_OVERFLOW or directory is not None:
+                events.append((mask, os.path.join(directory, name) if directory is not None and name else directory))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    """Pre-warms the analysis cache for images added to or changed under ``roots``.
+
+    Changes are picked up with inotify on Linux and by rescanning every
+    ``poll_interval`` seconds elsewhere (or once the watch limit is hit). Events for a
+    file are coalesced until it has been quiet for ``settle`` seconds. Analysis runs on
+    one low-priority thread that waits while tool calls are in flight and sleeps between
+    files so that it uses at most ``cpu_share`` of a core.
+    """
+
+    def __init__(self, analyzer: EnhancedImageAnalysisServer, roots: List[Path], cpu_share: float = WATCH_CPU_SHARE, poll_interval: float = WATCH_POLL_SECONDS, settle: float = WATCH_SETTLE_SECONDS):
+        self.analyzer = analyzer
+        self.roots = roots
+        self.cpu_share = cpu_share
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.pending = OrderedDict()
+        self.seen = {}
+        self.analyzed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="image-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        try:
+            # Linux applies niceness per thread, so this leaves the tool-call threads alone
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            logger.info(f"Watching {len(self.roots)} root(s) by polling every {self.poll_interval:g}s ({e})")
+            inotify = None
+        try:
+            if inotify is not None:
+                try:
+                    for root in self.roots:
+                        self._watch_tree(inotify, str(root))
+                    logger.info(f"Watching {len(inotify.paths)} directories with inotify")
+                except OSError as e:
+                    logger.warning(f"{e}; falling back to polling")
+                    inotify.close()
+                    inotify = None
+            self._rescan()
+            next_poll = time.monotonic() + self.poll_interval
+            while not self._stop.is_set():
+                if inotify is not None:
+                    self._handle_events(inotify, inotify.read(0.5))
+                else:
+                    self._stop.wait(0.5)
+                    if time.monotonic() >= next_poll:
+                        self._rescan()
+                        next_poll = time.monotonic() + self.poll_interval
+                self._analyze_settled()
+        except Exception as e:
+            logger.error(f"Library watcher stopped: {e}")
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def _watch_tree(self, inotify: Inotify, top: str) -> None:
+        for dirpath, dirnames, _ in os.walk(top):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            inotify.add_watch(dirpath)
+
+    def _rescan(self, root: Optional[Path] = None) -> None:
+        """Queue every image under ``root`` (default: all roots) whose size or mtime changed, and forget vanished ones."""
+        for top in [root] if root is not None else self.roots:
+            found = set()
+            for entry in self.analyzer.iter_image_entries(top, recursive=True, skip_hidden=True):
+                if self._stop.is_set():
+                    return
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                found.add(entry.path)
+                if self.seen.get(entry.path) != (st.st_size, st.st_mtime_ns):
+                    self.seen[entry.path] = (st.st_size, st.st_mtime_ns)
+                    self._queue(entry.path, settled=True)
+            prefix = os.path.join(str(top), '')
+            for path in [path for path in self.seen if path.startswith(prefix) and path not in found]:
+                del self.seen[path]
+
+    def _forget(self, path: str) -> None:
+        """Drop a deleted or moved-away file, or everything under such a directory."""
+        prefix = os.path.join(path, '')
+        for table in (self.seen, self.pending):
+            for known in [known for known in table if known == path or known.startswith(prefix)]:
+                del table[known]
+
+    def _queue(self, path: str, settled: bool = False) -> None:
+        self.pending.pop(path, None)
+        self.pending[path] = 0.0 if settled else time.monotonic()
+
+    def _handle_events(self, inotify: Inotify, events: List[Tuple[int, Optional[str]]]) -> None:
+        for mask, path in events:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self._rescan()
+            elif path is None or os.path.basename(path).startswith('.'):
+                continue
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM | Inotify.IN_DELETE_SELF):
+                self._forget(path)
+            elif mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    try:
+                        self._watch_tree(inotify, path)
+                    except OSError as e:
+                        logger.warning(f"Not watching {path}: {e}")
+                    self._rescan(Path(path))
+            elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO) and self.analyzer.is_image_file(Path(path)):
+                self._queue(path)
+
+    def _analyze_settled(self) -> None:
+        while self.pending and not self._stop.is_set():
+            path, queued = next(iter(self.pending.items()))
+            if time.monotonic() - queued < self.settle:
+                # Entries are kept in event order, so everything behind this one is newer
+                return
+            if not foreground.idle.is_set():
+                foreground.idle.wait(0.5)
+                return
+            del self.pending[path]
+            # Only this thread's CPU time, not the tool calls running alongside it
+            started = time.thread_time()
+            analysis = self.analyzer.advanced_heuristic_analysis(Path(path))
+            if 'error' not in analysis:
+                self.analyzed += 1
+                try:
+                    st = os.stat(path)
+                    self.seen[path] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    pass
+            busy = time.thread_time() - started
+            self._stop.wait(busy * (1 - self.cpu_share) / self.cpu_share)
+
+def popcount64(values: "np.ndarray") -> "np.ndarray":
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+class HammingIndex:
+    """Multi-index hashing: finds all pairs of 64-bit hashes within ``radius`` bits.
+
+    The bits are split into ``radius + 1`` disjoint segments. Two hashes that differ in
+    at most ``radius`` bits must agree exactly on at least one segment, so only hashes
+    that share a segment value are ever compared. Each pair is reported once, from the
+    first segment the two hashes share.
+    """
+
+    def __init__(self, hashes: List[int], radius: int, bits: int = 64):
+        self.hashes = hashes
+        self.radius = radius
+        count = radius + 1
+        self.masks, shift = [], 0
+        for i in range(count):
+            width = bits // count + (1 if i < bits % count else 0)
+            self.masks.append(((1 << width) - 1) << shift)
+            shift += width
+
+    def pairs(self) -> Iterator[Tuple[int, int, int]]:
+        """Yield ``(i, j, distance)`` with ``i < j`` for every pair within the radius."""
+        if NUMPY_AVAILABLE and self.hashes:
+            values = np.array(self.hashes, dtype=np.uint64)
+            for segment, mask in enumerate(self.masks):
+                yield from self._segment_pairs_vectorized(values, mask, self.masks[:segment])
+            return
+        for segment, mask in enumerate(self.masks):
+            earlier = self.masks[:segment]
+            buckets = {}
+            for i, value in enumerate(self.hashes):
+                buckets.setdefault(value & mask, []).append(i)
+            for members in buckets.values():
+                if len(members) > 1:
+                    yield from self._bucket_pairs(members, earlier)
+
+    def _bucket_pairs(self, members: List[int], earlier: List[int]) -> Iterator[Tuple[int, int, int]]:
+        hashes, radius = self.hashes, self.radius
+        for a, i in enumerate(members):
+            value = hashes[i]
+            for j in members[a + 1:]:
+                diff = value ^ hashes[j]
+                distance = diff.bit_count()
+                if distance <= radius and all(diff & m for m in earlier):
+                    yield i, j, distance
+
+    def _segment_pairs_vectorized(self, values: "np.ndarray", mask: int, earlier: List[int]) -> Iterator[Tuple[int, int, int]]:
+        """Sort by segment value, then compare each hash with the one ``k`` places on for k = 1, 2, ...
+
+        A position drops out as soon as its partner ``k`` places on has a different
+        segment value, so the total work is the number of same-bucket pairs.
+        """
+        keys = values & np.uint64(mask)
+        order = np.argsort(keys, kind='stable')
+        keys, values = keys[order], values[order]
+        earlier = [np.uint64(m) for m in earlier]
+        active = np.arange(len(values) - 1)
+        k = 1
+        while active.size:
+            active = active[active + k < len(values)]
+            partners = active + k
+            active = active[keys[active] == keys[partners]]
+            partners = active + k
+            diff = values[active] ^ values[partners]
+            distances = popcount64(diff)
+            keep = distances <= self.radius
+            for m in earlier:
+                keep &= (diff & m) != 0
+            first, second = order[active[keep]], order[partners[keep]]
+            for i, j, distance in zip(np.minimum(first, second).tolist(), np.maximum(first, second).tolist(), distances[keep].tolist()):
+                yield i, j, distance
+            k += 1
+
+
+def group_near_duplicates(hashes: List[int], radius: int) -> List[List[int]]:
+    """Cluster hashes linked by chains of near matches (union-find over ``HammingIndex`` pairs).
+
+    Returns groups of indices into ``hashes``, largest first; singletons are omitted.
+    """
+    parent = list(range(len(hashes)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i: int, j: int) -> None:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    # Identical hashes are linked directly and indexed once
+    first_seen, distinct, owners = {}, [], []
+    for i, value in enumerate(hashes):
+        if value in first_seen:
+            union(first_seen[value], i)
+        else:
+            first_seen[value] = i
+            distinct.append(value)
+            owners.append(i)
+    for a, b, _ in HammingIndex(distinct, radius).pairs():
+        union(owners[a], owners[b])
+
+    groups = {}
+    for i in range(len(hashes)):
+        groups.setdefault(find(i), []).append(i)
+    return sorted((members for members in groups.values() if len(members) > 1), key=len, reverse=True)
+
+class FeatureIndex:
+    """Colour-feature vectors of one scanned directory, searchable by k nearest neighbours.
+
+    ``vectors`` is an ``N x FEATURE_DIMENSIONS`` float32 matrix (a flat ``array`` without
+    NumPy) with the matching ``paths`` and ``[size, mtime_ns]`` identities alongside.
+    Approximate search uses random-hyperplane LSH: each of ``LSH_TABLES`` tables keys a
+    vector by the signs of ``LSH_BITS`` random projections of it (centred on the index
+    mean), and candidates from the query's bucket and its one-bit neighbours are then
+    ranked exactly. Without NumPy every search is exact.
+    """
+
+    LSH_TABLES = 8
+    LSH_BITS = 14
+    # "auto" mode switches to approximate search from this many images
+    APPROXIMATE_MIN_ROWS = 20000
+
+    def __init__(self, paths: List[str], identities: List[List[int]], vectors: Any, built: str):
+        self.paths = paths
+        self.identities = identities
+        self.vectors = vectors
+        self.built = built
+        self._norms = None
+        self._lsh = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    @classmethod
+    def from_rows(cls, paths: List[str], identities: List[List[int]], rows: List[List[float]]) -> "FeatureIndex":
+        if NUMPY_AVAILABLE:
+            vectors = np.array(rows, dtype=np.float32).reshape(len(rows), FEATURE_DIMENSIONS)
+        else:
+            vectors = array('f', chain.from_iterable(rows))
+        return cls(paths, identities, vectors, datetime.now().isoformat(timespec='seconds'))
+
+    @classmethod
+    def load(cls, base: Path) -> Optional["FeatureIndex"]:
+        """Open an index written by ``save``; the vectors are memory-mapped, not read."""
+        if not base.with_suffix('.json').exists():
+            return None
+        try:
+            meta = json.loads(base.with_suffix('.json').read_text())
+            count = len(meta['paths'])
+            data = base.with_suffix('.f32')
+            if data.stat().st_size != count * FEATURE_DIMENSIONS * 4:
+                return None
+            if not NUMPY_AVAILABLE:
+                vectors = array('f')
+                with open(data, 'rb') as f:
+                    vectors.fromfile(f, count * FEATURE_DIMENSIONS)
+            elif count:
+                vectors = np.memmap(data, dtype=np.float32, mode='r', shape=(count, FEATURE_DIMENSIONS))
+            else:
+                vectors = np.zeros((0, FEATURE_DIMENSIONS), dtype=np.float32)
+            return cls(meta['paths'], meta['identities'], vectors, meta['built'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable feature index {base}: {e}")
+            return None
+
+    def save(self, base: Path) -> None:
+        base.parent.mkdir(parents=True, exist_ok=True)
+        # The JSON file is written last and names the row count, so a torn write is detected on load.
+        # Temporary names are unique because concurrent calls may save the same index.
+        for suffix, write in (('.f32', lambda f: self.vectors.tofile(f)), ('.json', lambda f: f.write(json.dumps({"built": self.built, "paths": self.paths, "identities": self.identities}).encode()))):
+            tmp = base.with_suffix(f"{suffix}.{secrets.token_hex(4)}.tmp")
+            with open(tmp, 'wb') as f:
+                write(f)
+            os.replace(tmp, base.with_suffix(suffix))
+
+    def vector(self, row: int) -> List[float]:
+        if NUMPY_AVAILABLE:
+            return self.vectors[row].tolist()
+        return self.vectors[row * FEATURE_DIMENSIONS:(row + 1) * FEATURE_DIMENSIONS].tolist()
+
+    def search(self, query: List[float], k: int, approximate: bool = False) -> List[Tuple[int, float]]:
+        """Return up to ``k`` ``(row, distance)`` pairs, nearest first."""
+        if not len(self):
+            return []
+        if not NUMPY_AVAILABLE:
+            distances = ((sum((a - b) ** 2 for a, b in zip(query, self.vector(row))), row) for row in range(len(self)))
+            return [(row, math.sqrt(d)) for d, row in heapq.nsmallest(k, distances)]
+        q = np.asarray(query, dtype=np.float32)
+        rows = self._lsh_candidates(q) if approximate else None
+        if rows is None or len(rows) < k:
+            rows = None
+            vectors, norms = self.vectors, self._squared_norms()
+        else:
+            vectors, norms = self.vectors[rows], self._squared_norms()[rows]
+        # |v - q|^2 = |v|^2 - 2 v.q + |q|^2, one matrix-vector product over the candidates
+        distances = norms - 2 * (vectors @ q) + float(q @ q)
+        k = min(k, len(distances))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top], kind='stable')]
+        found = top if rows is None else rows[top]
+        return [(int(row), math.sqrt(max(float(d), 0.0))) for row, d in zip(found, distances[top])]
+
+    def _squared_norms(self) -> "np.ndarray":
+        with self._lock:
+            if self._norms is None:
+                self._norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+            return self._norms
+
+    def _lsh_candidates(self, q: "np.ndarray") -> "np.ndarray":
+        with self._lock:
+            if self._lsh is None:
+                self._lsh = self._build_lsh()
+        planes, center, tables = self._lsh
+        weights = 1 << np.arange(self.LSH_BITS, dtype=np.int64)
+        signatures = ((((q - center) @ planes) > 0).reshape(self.LSH_TABLES, self.LSH_BITS) @ weights)
+        found = []
+        for signature, (order, keys) in zip(signatures.tolist(), tables):
+            probes = np.array([signature] + [signature ^ (1 << bit) for bit in range(self.LSH_BITS)], dtype=np.int64)
+            starts, ends = np.searchsorted(keys, probes, 'left'), np.searchsorted(keys, probes, 'right')
+            found.extend(order[start:end] for start, end in zip(starts.tolist(), ends.tolist()) if end > start)
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+
+    def _build_lsh(self) -> Tuple["np.ndarray", "np.ndarray", List[Tuple["np.ndarray", "np.ndarray"]]]:
+        # A fixed seed keeps the tables identical across restarts
+        planes = np.random.default_rng(0).standard_normal((FEATURE_DIMENSIONS, self.LSH_TABLES * self.LSH_BITS)).astype(np.float32)
+        center = self.vectors.mean(axis=0, dtype=np.float64).astype(np.float32)
+        weights = 1 << np.arange(self.LSH_BITS, dtype=np.int64)
+        signatures = np.empty((len(self), self.LSH_TABLES), dtype=np.int64)
+        for start in range(0, len(self), 65536):
+            block = ((self.vectors[start:start + 65536] - center) @ planes) > 0
+            signatures[start:start + 65536] = block.reshape(-1, self.LSH_TABLES, self.LSH_BITS) @ weights
+        tables = []
+        for t in range(self.LSH_TABLES):
+            order = np.argsort(signatures[:, t], kind='stable')
+            tables.append((order, signatures[order, t]))
+        return planes, center, tables
+
+
+class FeatureIndexStore:
+    """Where ``FeatureIndex`` files live, with the most recently used indexes kept open.
+
+    Without a directory (cache disabled) indexes are only held in memory.
+    """
+
+    def __init__(self, directory: Optional[Path], max_loaded: int = 4):
+        self.directory = directory
+        self.max_loaded = max_loaded
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _base(self, key: str) -> Path:
+        return self.directory / hashlib.sha1(key.encode()).hexdigest()[:20]
+
+    def get(self, key: str) -> Optional[FeatureIndex]:
+        with self._lock:
+            if key in self._loaded:
+                self._loaded.move_to_end(key)
+                return self._loaded[key]
+        index = FeatureIndex.load(self._base(key)) if self.directory is not None else None
+        if index is not None:
+            self._remember(key, index)
+        return index
+
+    def put(self, key: str, index: FeatureIndex) -> None:
+        if self.directory is not None:
+            index.save(self._base(key))
+        self._remember(key, index)
+
+    def _remember(self, key: str, index: FeatureIndex) -> None:
+        with self._lock:
+            self._loaded[key] = index
+            self._loaded.move_to_end(key)
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+
+feature_indexes = FeatureIndexStore(CACHE_DIR / "features" if CACHE_ENABLED else None)
+
+def build_feature_index(directory: Path, walk_options: Dict[str, Any], previous: Optional[FeatureIndex], run: Optional[ToolRun] = None) -> FeatureIndex:
+    """Index the images under ``directory``, reusing ``previous`` rows for files whose size and mtime are unchanged."""
+    reuse = {path: (identity, row) for row, (path, identity) in enumerate(zip(previous.paths, previous.identities))} if previous else {}
+    paths, identities, rows, pending = [], [], [], []
+    for entry in image_server.iter_image_entries(directory, **walk_options):
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        identity = [st.st_size, st.st_mtime_ns]
+        prior = reuse.get(entry.path)
+        paths.append(entry.path)
+        identities.append(identity)
+        if prior is not None and prior[0] == identity:
+            rows.append(previous.vector(prior[1]))
+        else:
+            rows.append(None)
+            pending.append(len(rows) - 1)
+    for i, (_, result) in zip(pending, analyze_image_files((Path(paths[i]) for i in pending), run, task='features')):
+        rows[i] = result.get('vector')
+    keep = [i for i, row in enumerate(rows) if row is not None]
+    return FeatureIndex.from_rows([paths[i] for i in keep], [identities[i] for i in keep], [rows[i] for i in keep])
+
+def suggest_path(plan: RenamePlan, image_path: Path, analysis: Dict[str, Any], naming_style: str, prefix: str = "") -> Path:
+    """Where ``ai_analyze_directory_images`` would rename ``image_path``, reserved in ``plan``."""
+    if 'error' in analysis:
+        raise ValueError(analysis['error'])
+    new_name = image_server.generate_name_from_analysis(analysis, naming_style)
+    if prefix:
+        new_name = f"{prefix}_{new_name}"
+    return plan.reserve(image_path, image_path.parent, f"{new_name}{image_path.suffix.lower()}")
+
+def categorize_image(image_path: Path, organization_method: str, analysis: Optional[Dict[str, Any]] = None) -> str:
+    """The ``organize_images_by_content`` folder for one image; ``analysis`` is needed for the content method."""
+    if organization_method == "content":
+        if 'error' in analysis:
+            raise ValueError(analysis['error'])
+        if 'screenshot' in analysis.get('filename_hints', []):
+            return "screenshots"
+        elif 'photo' in analysis.get('filename_hints', []):
+            return "photos"
+        elif analysis.get('source') == 'camera':
+            return "camera_photos"
+        elif 'edited' in analysis.get('filename_hints', []):
+            return "edited_images"
+        elif analysis.get('orientation') == 'portrait':
+            return "portraits"
+        elif analysis.get('orientation') == 'landscape':
+            return "landscapes"
+        elif analysis.get('color_family') in ['black', 'white', 'gray']:
+            return "black_white"
+    elif organization_method == "date":
+        date = datetime.fromtimestamp(image_path.stat().st_ctime)
+        return f"{date.year}-{date.month:02d}"
+    elif organization_method == "size":
+        with image_server.open_context(image_path) as ctx:
+            return image_server.categorize_size(ctx.header["width"] * ctx.header["height"])
+    elif organization_method == "format":
+        return image_path.suffix.lower().replace('.', '')
+    return "miscellaneous"
+
+class JobQueue:
+    """Durable background runs of the directory tools, executed one at a time.
+
+    A job lists its files once into ``<id>.files`` and appends one JSON record per file
+    to ``<id>.jsonl``. Every ``JOB_CHECKPOINT_SECONDS`` the results are synced and the
+    files done, the synced length and running totals are committed to SQLite, so after
+    a crash or restart the job truncates its results to that length and carries on from
+    the next file. Renames and moves are applied last under a ``RenameJournal``, which
+    resumes the same way.
+
+    Server processes sharing the cache directory share the queue. A job is claimed by
+    recording ``host:pid`` as its owner, and a heartbeat thread renews that lease every
+    ``JOB_HEARTBEAT_SECONDS`` for the whole run, listing included. Another process on
+    the same host takes the job over only once the owner has exited; one on another
+    host, once the owner has not reported for ``JOB_LEASE_SECONDS``.
+    """
+
+    TOOLS = ("ai_analyze_directory_images", "organize_images_by_content")
+    FINISHED = ("completed", "failed", "cancelled")
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._conn = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._current: Optional[Tuple[str, ToolRun]] = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.directory / "jobs.sqlite3"), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, tool TEXT NOT NULL, arguments TEXT NOT NULL, state TEXT NOT NULL,
+                created REAL NOT NULL, updated REAL NOT NULL, total INTEGER, done INTEGER NOT NULL DEFAULT 0,
+                results_bytes INTEGER NOT NULL DEFAULT 0, totals TEXT NOT NULL DEFAULT '{}', journal_id TEXT, error TEXT, owner TEXT)""")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _update(self, job_id: str, only_if: Tuple[str, ...] = ("running",), mine: bool = True, **values: Any) -> bool:
+        """Set ``values`` on the job if it is in one of the ``only_if`` states (and, with ``mine``,
+        still owned by this process); returns whether it was."""
+        columns = "".join(f"{column}=?, " for column in values)
+        states = ", ".join("?" for _ in only_if)
+        params = tuple(values.values()) + (time.time(), job_id) + only_if + ((self.owner,) if mine else ())
+        with self._lock:
+            return self._connect().execute(f"UPDATE jobs SET {columns}updated=? WHERE id=? AND state IN ({states})" + (" AND owner=?" if mine else ""), params).rowcount > 0
+
+    @staticmethod
+    def _job(row: Tuple) -> Dict[str, Any]:
+        job_id, tool, arguments, state, created, updated, total, done, results_bytes, totals, journal_id, error, owner = row
+        return {"id": job_id, "tool": tool, "arguments": json.loads(arguments), "state": state, "created": datetime.fromtimestamp(created).isoformat(timespec='seconds'), "updated": datetime.fromtimestamp(updated).isoformat(timespec='seconds'), "total": total, "done": done, "results_bytes": results_bytes, "totals": json.loads(totals), "journal_id": journal_id, "error": error, "owner": owner, "_updated": updated}
+
+    def submit(self, tool: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        job_id = f"{datetime.now():%Y%m%d-%H%M%S}-{secrets.token_hex(3)}"
+        now = time.time()
+        self._execute("INSERT INTO jobs (id, tool, arguments, state, created, updated) VALUES (?, ?, ?, 'queued', ?, ?)", (job_id, tool, json.dumps(arguments), now, now))
+        self._wake.set()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Dict[str, Any]:
+        if not re.fullmatch(r'[\w-]+', job_id or ''):
+            raise ValueError(f"Invalid job id: {job_id}")
+        rows = self._execute("SELECT * FROM jobs WHERE id=?", (job_id,))
+        if not rows:
+            raise ValueError(f"No job with id {job_id}")
+        return self._job(rows[0])
+
+    def list(self, limit: int) -> Tuple[int, List[Dict[str, Any]]]:
+        count = self._execute("SELECT COUNT(*) FROM jobs")[0][0]
+        return count, [self._job(row) for row in self._execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,))]
+
+    def cancel(self, job_id: str) -> Dict[str, Any]:
+        self.get(job_id)
+        # A job running in another server process sees this after its current chunk
+        self._update(job_id, only_if=("queued", "running"), mine=False, state="cancelled")
+        current = self._current
+        if current is not None and current[0] == job_id:
+            current[1].cancelled.set()
+        return self.get(job_id)
+
+    @staticmethod
+    def summary(job: Dict[str, Any]) -> str:
+        line = f"🧾 {job['id']}: {job['tool']} in {job['arguments'].get('directory_path', '?')} — {job['state']}, {job['done']}/{job['total'] if job['total'] is not None else '?'} files"
+        return f"{line} ({job['error']})" if job["error"] else line
+
+    @staticmethod
+    def describe(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in job.items() if key not in ("results_bytes", "_updated")}
+
+    def stats(self) -> Dict[str, int]:
+        try:
+            return dict(self._execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+        except (sqlite3.Error, OSError) as e:
+            return {"error": str(e)}
+
+    def results(self, job: Dict[str, Any], offset: int, limit: int) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """Up to ``limit`` records from byte ``offset`` of the results made durable so far, and the next offset."""
+        end = job["results_bytes"]
+        records = []
+        if offset < 0:
+            raise ValueError(f"Invalid cursor: offset {offset}")
+        if offset >= end:
+            return records, None
+        with open(self.directory / f"{job['id']}.jsonl", 'rb') as f:
+            if offset:
+                # A crafted or stale cursor must still point at the start of a record
+                f.seek(offset - 1)
+                if f.read(1) != b"\n":
+                    raise ValueError(f"Invalid cursor: offset {offset} is not the start of a result of job {job['id']}")
+            f.seek(offset)
+            while len(records) < limit and offset < end:
+                line = f.readline()
+                offset += len(line)
+                records.append(json.loads(line))
+        return records, offset if offset < end else None
+
+    def start(self) -> None:
+        """Run queued jobs, including any interrupted by the last shutdown or a crash, in submission order."""
+        self._thread = threading.Thread(target=self._run, name="image-jobs", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Stop after checkpointing the running job; it is resumed on the next start."""
+        self._stop.set()
+        current = self._current
+        if current is not None:
+            current[1].cancelled.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _orphaned(self, job: Dict[str, Any]) -> bool:
+        """Whether a job marked running has lost its owner, e.g. to a crash or a killed server."""
+        if job["owner"] is None or job["owner"] == self.owner:
+            # Claims only happen while this process runs nothing, so its own job was left by an earlier life
+            return True
+        host, _, pid = job["owner"].rpartition(":")
+        if host == socket.gethostname() and os.name != 'nt' and pid.isdigit():
+            # A live owner on this host keeps its job however slow it is; its lease only matters elsewhere
+            return not process_exists(int(pid))
+        return time.time() - job["_updated"] > JOB_LEASE_SECONDS
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """Take the oldest queued or orphaned job, or ``None`` when there is nothing to run."""
+        for row in self._execute("SELECT * FROM jobs WHERE state IN ('queued', 'running') ORDER BY created"):
+            job = self._job(row)
+            if job["state"] == "running" and not self._orphaned(job):
+                continue
+            # Only one process wins: the owner must still be the one just read
+            with self._lock:
+                claimed = self._connect().execute("UPDATE jobs SET state='running', owner=?, updated=? WHERE id=? AND state=? AND owner IS ?", (self.owner, time.time(), job["id"], job["state"], job["owner"])).rowcount > 0
+            if claimed:
+                return job
+        return None
 
-    def advanced_heuristic_analysis(self, image_path: Path) -> Dict[str, Any]:
-        analysis = {}
-        try:
-            with Image.open(image_path) as img:
-                width, height = img.size
-                analysis['orientation'] = 'landscape' if width > height else 'portrait' if height > width else 'square'
-                analysis['size_category'] = self.categorize_size(width * height)
-                analysis['aspect_ratio'] = round(width / height, 2)
-                color_info = self.analyze_image_colors(image_path)
-                analysis.update(color_info)
-                exif_data = self.extract_exif_data(image_path)
-                if exif_data and "error" not in exif_data:
-                    if 'Make' in exif_data or 'Model' in exif_data:
-                        analysis['source'] = 'camera'
-                    if 'Software' in exif_data:
-                        software = str(exif_data['Software']).lower()
-                        if 'screenshot' in software or 'capture' in software:
-                            analysis['type'] = 'screenshot'
-                        elif 'photoshop' in software or 'gimp' in software:
-                            analysis['type'] = 'edited'
-                    if 'DateTime' in exif_data:
-                        analysis['has_timestamp'] = True
-                analysis['file_size_category'] = self.categorize_file_size(image_path.stat().st_size)
-                analysis['filename_hints'] = self.analyze_filename(image_path.stem.lower())
-        except Exception as e:
-            analysis['error'] = str(e)
-        return analysis
+    def _run(self) -> None:
+        # Jobs left running by a crash or a killed server pick up from their checkpoint
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                job = self._claim()
+            except (sqlite3.Error, OSError) as e:
+                logger.error(f"Job queue unavailable: {e}")
+                return
+            if job is None:
+                self._wake.wait(JOB_POLL_SECONDS)
+                continue
+            run = ToolRun()
+            self._current = (job["id"], run)
+            finished = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(job["id"], run, finished), name="image-jobs-heartbeat", daemon=True)
+            heartbeat.start()
+            try:
+                with metrics.time(f"job.{job['tool']}"):
+                    self._execute_job(job, run)
+            except Exception as e:
+                logger.error(f"Job {job['id']} failed: {e}")
+                metrics.incr(f"errors.{type(e).__name__}")
+                self._update(job["id"], state="failed", error=str(e))
+            finally:
+                finished.set()
+                heartbeat.join()
+                self._current = None
 
-    def categorize_size(self, pixels: int) -> str:
-        return "huge" if pixels > 8000000 else "large" if pixels > 2000000 else "medium" if pixels > 500000 else "small"
+    def _heartbeat(self, job_id: str, run: ToolRun, finished: threading.Event) -> None:
+        """Renew the lease on a running job until ``finished``; stop the job if it was cancelled or taken elsewhere."""
+        while not finished.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                renewed = self._update(job_id)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not renew the lease on job {job_id}: {e}")
+                continue
+            if not renewed:
+                run.cancelled.set()
+                return
 
-    def categorize_file_size(self, bytes_size: int) -> str:
-        mb = bytes_size / (1024 * 1024)
-        return "large" if mb > 10 else "medium" if mb > 1 else "small"
+    def _list_files(self, job: Dict[str, Any], run: ToolRun) -> Optional[Path]:
+        """Write the job's file list once; ``None`` if ``run`` was cancelled before it was complete."""
+        arguments = job["arguments"]
+        directory = Path(arguments["directory_path"])
+        recursive = arguments.get("recursive", False) if job["tool"] == "ai_analyze_directory_images" else False
+        image_files = image_server.iter_image_files(directory, recursive, arguments.get("max_depth"), arguments.get("include"), arguments.get("exclude"), arguments.get("skip_hidden", False))
+        files_path = self.directory / f"{job['id']}.files"
+        tmp = files_path.with_suffix('.tmp')
+        total = 0
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for image_path in image_files:
+                if run.is_cancelled():
+                    break
+                f.write(json.dumps(str(image_path)) + "\n")
+                total += 1
+            f.flush()
+            os.fsync(f.fileno())
+        if run.is_cancelled():
+            tmp.unlink()
+            return None
+        os.replace(tmp, files_path)
+        self._update(job["id"], total=total, done=0, results_bytes=0, totals='{}')
+        job.update(total=total, done=0, results_bytes=0, totals={})
+        return files_path
 
-    def analyze_filename(self, filename: str) -> List[str]:
-        hints = []
-        patterns = {
-            'screenshot': ['screenshot', 'screen', 'capture', 'scr'], 'photo': ['photo', 'img', 'pic', 'picture', 'dsc'],
-            'download': ['download', 'temp', 'untitled'], 'edited': ['edit', 'modified', 'copy', 'final'],
-            'scan': ['scan', 'document', 'doc'], 'avatar': ['avatar', 'profile', 'headshot'],
-            'logo': ['logo', 'brand', 'icon'], 'diagram': ['diagram', 'chart', 'graph', 'flowchart']
-        }
-        for category, keywords in patterns.items():
-            if any(keyword in filename for keyword in keywords):
-                hints.append(category)
-        return hints
+    def _records(self, job: Dict[str, Any], image_files: List[Path], plan: RenamePlan, run: ToolRun) -> Iterator[Dict[str, Any]]:
+        """The per-file records of ``image_files`` in order, stopping early if ``run`` is cancelled."""
+        arguments = job["arguments"]
+        if job["tool"] == "ai_analyze_directory_images":
+            naming_style, prefix = arguments.get("naming_style", "descriptive"), arguments.get("prefix", "")
+            for image_path, analysis in analyze_image_files(image_files, run):
+                try:
+                    new_path = suggest_path(plan, image_path, analysis, naming_style, prefix)
+                    yield {"path": str(image_path), "original": image_path.name, "suggested": new_path.name, "status": "suggested", "analysis": analysis}
+                except Exception as e:
+                    yield {"path": str(image_path), "original": image_path.name, "status": "error", "error": str(e)}
+            return
+        method = arguments.get("organization_method", "content")
+        directory = Path(arguments["directory_path"])
+        pairs = analyze_image_files(image_files, run) if method == "content" else ((image_path, None) for image_path in image_files)
+        for image_path, analysis in pairs:
+            if run.is_cancelled():
+                return
+            try:
+                category = categorize_image(image_path, method, analysis)
+                record = {"path": str(image_path), "category": category}
+            except Exception as e:
+                category = "errors"
+                record = {"path": str(image_path), "category": category, "error": str(e)}
+            record["target"] = str(plan.reserve(image_path, directory / category, image_path.name))
+            yield record
 
-    def generate_name_from_analysis(self, analysis: Dict[str, Any], style: str) -> str:
-        parts = []
-        if style == "descriptive":
-            if 'color_family' in analysis and analysis['color_family'] not in ['mixed', 'gray']:
-                parts.append(analysis['color_family'])
-            if analysis.get('orientation') != 'square':
-                parts.append(analysis['orientation'])
-        elif style == "technical":
-            parts.append(f"{analysis.get('size_category', 'medium')}_res")
-            parts.append(analysis.get('orientation', 'unknown'))
-            if analysis.get('source') == 'camera':
-                parts.append('camera')
-            elif 'screenshot' in analysis.get('filename_hints', []):
-                parts.append('screenshot')
-        elif style == "artistic":
-            if 'color_family' in analysis:
-                parts.append(analysis['color_family'])
-            if analysis.get('brightness', 0.5) > 0.7:
-                parts.append('bright')
-            elif analysis.get('brightness', 0.5) < 0.3:
-                parts.append('dark')
-            if analysis.get('is_grayscale'):
-                parts.append('bw')
-        elif style == "location":
-            if 'has_timestamp' in analysis:
-                parts.append('dated')
-            parts.append(analysis.get('orientation', 'photo'))
-        hints = analysis.get('filename_hints', [])
-        for hint in hints[:1]:
-            if hint not in parts:
-                parts.append(hint)
-        return '_'.join(parts) if parts else 'image'
+    @staticmethod
+    def _target(record: Dict[str, Any]) -> Optional[Path]:
+        if "target" in record:
+            return Path(record["target"])
+        if "suggested" in record:
+            return Path(record["path"]).with_name(record["suggested"])
+        return None
 
-    def is_image_file(self, file_path: Path) -> bool:
-        return file_path.suffix.lower() in self.supported_formats
+    @staticmethod
+    def _count(totals: Dict[str, Any], record: Dict[str, Any]) -> None:
+        totals["processed"] = totals.get("processed", 0) + 1
+        if "error" in record:
+            totals["errors"] = totals.get("errors", 0) + 1
+        for key, value in (("categories", record.get("category")), ("color_families", record.get("analysis", {}).get("color_family")), ("orientations", record.get("analysis", {}).get("orientation"))):
+            if value is not None:
+                counts = totals.setdefault(key, {})
+                counts[value] = counts.get(value, 0) + 1
 
-    def get_image_files(self, directory: Path, recursive: bool = False) -> List[Path]:
+    def _execute_job(self, job: Dict[str, Any], run: ToolRun) -> None:
+        job_id, arguments = job["id"], job["arguments"]
+        files_path = self.directory / f"{job_id}.files"
+        if job["total"] is None or not files_path.exists():
+            files_path = self._list_files(job, run)
         image_files = []
-        try:
-            if recursive:
-                for file_path in directory.rglob("*"):
-                    if file_path.is_file() and self.is_image_file(file_path):
-                        image_files.append(file_path)
+        if files_path is not None:
+            with open(files_path, encoding='utf-8') as f:
+                image_files = [Path(json.loads(line)) for line in f]
+        done, totals = job["done"], job["totals"]
+        plan = RenamePlan()
+        with open(self.directory / f"{job_id}.jsonl", 'a+b') as results:
+            # Records written after the last checkpoint are dropped and redone
+            results.truncate(job["results_bytes"])
+            results.seek(0)
+            for line in results:
+                target = self._target(json.loads(line))
+                if target is not None:
+                    plan.claim(target)
+            if done:
+                logger.info(f"Resuming job {job_id} at file {done + 1} of {len(image_files)}")
+            last_checkpoint = time.monotonic()
+            while done < len(image_files) and not run.is_cancelled():
+                lines = []
+                for record in self._records(job, image_files[done:done + JOB_CHUNK_FILES], plan, run):
+                    self._count(totals, record)
+                    lines.append(_dumps(record) + "\n")
+                results.write("".join(lines).encode('utf-8'))
+                done += len(lines)
+                if done == len(image_files) or run.is_cancelled() or time.monotonic() - last_checkpoint >= JOB_CHECKPOINT_SECONDS:
+                    results.flush()
+                    os.fsync(results.fileno())
+                    self._update(job_id, only_if=("running", "cancelled"), done=done, results_bytes=results.tell(), totals=json.dumps(totals))
+                    last_checkpoint = time.monotonic()
+                    metrics.incr("jobs.checkpoints")
+        
+        apply = arguments.get("rename_files" if job["tool"] == "ai_analyze_directory_images" else "create_folders", False)
+        if apply and not run.is_cancelled():
+            if job["journal_id"] is None:
+                moves = []
+                with open(self.directory / f"{job_id}.jsonl", 'rb') as f:
+                    for line in f:
+                        record = json.loads(line)
+                        target = self._target(record)
+                        if target is not None and str(target) != record["path"]:
+                            moves.append((Path(record["path"]), target))
+                journal = RenameJournal.create(job["tool"], Path(arguments["directory_path"]), moves)
+                self._update(job_id, journal_id=journal.id)
             else:
-                for file_path in directory.iterdir():
-                    if file_path.is_file() and self.is_image_file(file_path):
-                        image_files.append(file_path)
-        except Exception as e:
-            logger.error(f"Error scanning directory: {e}")
-        return sorted(image_files)
+                journal = RenameJournal.open(job["journal_id"])
+            moved, errors = journal.apply(run.is_cancelled)
+            totals.update(moved=len(journal.done), move_errors=len(errors))
+        
+        if run.is_cancelled():
+            if self._stop.is_set():
+                self._update(job_id, state="queued", owner=None)
+            return
+        self._update(job_id, state="completed", totals=json.dumps(totals))
+
+jobs = JobQueue(JOB_DIR)
 
 # Create server instance
-image_server = EnhancedImageAnalysisServer()
+image_server = EnhancedImageAnalysisServer(AnalysisCache(CACHE_DIR, int(CACHE_MAX_MB * 1024 * 1024), CACHE_MAX_AGE_DAYS) if CACHE_ENABLED else None)
 
 @server.list_tools()
 async def handle_list_tools() -> list[Tool]:
     """List available tools."""
-    return [
+    tools = [
         Tool(
             name="ai_analyze_directory_images",
             description="Analyze all images in a directory",
@@ -219,9 +3253,17 @@ async def handle_list_tools() -> list[Tool]:
                 "properties": {
                     "directory_path": {"type": "string"},
                     "recursive": {"type": "boolean", "default": False},
+                    "max_depth": {"type": "integer", "minimum": 0, "description": "Deepest subdirectory level to scan when recursive (0 = top level only)"},
+                    "include": {"type": "array", "items": {"type": "string"}, "description": "Only analyse files matching one of these globs"},
+                    "exclude": {"type": "array", "items": {"type": "string"}, "description": "Skip files and directories matching these globs"},
+                    "skip_hidden": {"type": "boolean", "default": False},
+                    "since_last_scan": {"type": "boolean", "default": False, "description": "Only report files added or changed since the previous run on this directory"},
                     "rename_files": {"type": "boolean", "default": False},
                     "prefix": {"type": "string", "default": ""},
-                    "naming_style": {"type": "string", "default": "descriptive", "enum": ["descriptive", "technical", "artistic", "location"]}
+                    "naming_style": {"type": "string", "default": "descriptive", "enum": ["descriptive", "technical", "artistic", "location"]},
+                    "progress_interval": {"type": "number", "default": 1.0, "description": "Minimum seconds between progress notifications"},
+                    "limit": {"type": "integer", "minimum": 1, "maximum": 1000, "description": "Return at most this many per-file results plus a continuation cursor"},
+                    "cursor": {"type": "string", "description": "Continuation cursor from a previous page; other arguments are ignored"}
                 },
                 "required": ["directory_path"]
             }
@@ -251,6 +3293,131 @@ async def handle_list_tools() -> list[Tool]:
                 "required": ["image_path"]
             }
         ),
+        Tool(
+            name="extract_metadata_batch",
+            description="Extract metadata for many images as compact JSON Lines",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "image_paths": {"type": "array", "items": {"type": "string"}},
+                    "directory_path": {"type": "string"},
+                    "pattern": {"type": "string", "description": "Glob filter for files in directory_path, e.g. *.jpg"},
+                    "recursive": {"type": "boolean", "default": False},
+                    "include_color_analysis": {"type": "boolean", "default": False},
+                    "progress_interval": {"type": "number", "default": 1.0, "description": "Minimum seconds between progress notifications"}
+                }
+            }
+        ),
+        Tool(
+            name="find_duplicate_images",
+            description="Find duplicate and near-duplicate images using perceptual hashes",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "directory_path": {"type": "string"},
+                    "recursive": {"type": "boolean", "default": False},
+                    "max_depth": {"type": "integer", "minimum": 0},
+                    "include": {"type": "array", "items": {"type": "string"}},
+                    "exclude": {"type": "array", "items": {"type": "string"}},
+                    "skip_hidden": {"type": "boolean", "default": False},
+                    "hash_type": {"type": "string", "default": "phash", "enum": list(HASH_TYPES)},
+                    "threshold": {"type": "integer", "default": 4, "minimum": 0, "maximum": 8, "description": "Maximum differing bits (of 64) for two images to count as near-duplicates; 0 finds exact visual duplicates"},
+                    "progress_interval": {"type": "number", "default": 1.0, "description": "Minimum seconds between progress notifications"},
+                    "limit": {"type": "integer", "minimum": 1, "maximum": 1000, "description": "Return at most this many groups plus a continuation cursor"},
+                    "cursor": {"type": "string", "description": "Continuation cursor from a previous page; other arguments are ignored"}
+                },
+                "required": ["directory_path"]
+            }
+        ),
+        Tool(
+            name="find_similar_images",
+            description="Find the images in a directory whose colours and shape are most similar to a query image",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "image_path": {"type": "string", "description": "Query image"},
+                    "directory_path": {"type": "string", "description": "Library to search"},
+                    "recursive": {"type": "boolean", "default": False},
+                    "max_depth": {"type": "integer", "minimum": 0},
+                    "include": {"type": "array", "items": {"type": "string"}},
+                    "exclude": {"type": "array", "items": {"type": "string"}},
+                    "skip_hidden": {"type": "boolean", "default": False},
+                    "k": {"type": "integer", "default": 10, "minimum": 1, "maximum": 100},
+                    "mode": {"type": "string", "default": "auto", "enum": ["auto", "exact", "approximate"], "description": "approximate uses an LSH index; auto picks it for large libraries"},
+                    "refresh": {"type": "boolean", "default": False, "description": "Rescan the directory for added or changed images before searching"},
+                    "progress_interval": {"type": "number", "default": 1.0, "description": "Minimum seconds between progress notifications"}
+                },
+                "required": ["image_path", "directory_path"]
+            }
+        ),
+        Tool(
+            name="manage_rename_journals",
+            description="List, inspect, resume or roll back the journaled renames and moves made by the other tools",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "action": {"type": "string", "default": "list", "enum": ["list", "status", "resume", "rollback"]},
+                    "journal_id": {"type": "string", "description": "Journal to act on; required except for list"},
+                    "limit": {"type": "integer", "default": 20, "minimum": 1, "maximum": 1000, "description": "Journals to show for list"}
+                }
+            }
+        ),
+        Tool(
+            name="submit_job",
+            description="Run ai_analyze_directory_images or organize_images_by_content as a durable background job that checkpoints and resumes after restarts",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "tool": {"type": "string", "enum": list(JobQueue.TOOLS)},
+                    "arguments": {"type": "object", "description": "The tool's own arguments, as for a direct call; directory_path is required, while since_last_scan, limit and cursor do not apply"}
+                },
+                "required": ["tool", "arguments"]
+            }
+        ),
+        Tool(
+            name="job_status",
+            description="Report the progress and totals of a background job, or list recent jobs",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "job_id": {"type": "string", "description": "Job to report; omit to list recent jobs"},
+                    "limit": {"type": "integer", "default": 20, "minimum": 1, "maximum": 1000, "description": "Jobs to show when listing"}
+                }
+            }
+        ),
+        Tool(
+            name="job_results",
+            description="Page through the per-file results a background job has checkpointed so far",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "job_id": {"type": "string"},
+                    "limit": {"type": "integer", "default": 100, "minimum": 1, "maximum": 1000},
+                    "cursor": {"type": "string", "description": "Continuation cursor from a previous page; replaces job_id"}
+                }
+            }
+        ),
+        Tool(
+            name="cancel_job",
+            description="Cancel a queued or running background job; results checkpointed so far are kept",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "job_id": {"type": "string"}
+                },
+                "required": ["job_id"]
+            }
+        ),
+        Tool(
+            name="server_stats",
+            description="Report server metrics: stage and tool latencies, throughput, cache hit rates and errors",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "reset": {"type": "boolean", "default": False, "description": "Clear counters and histograms after reporting"}
+                }
+            }
+        ),
         Tool(
             name="organize_images_by_content",
             description="Organize images into folders",
@@ -259,44 +3426,107 @@ async def handle_list_tools() -> list[Tool]:
                 "properties": {
                     "directory_path": {"type": "string"},
                     "create_folders": {"type": "boolean", "default": False},
-                    "organization_method": {"type": "string", "default": "content", "enum": ["content", "date", "size", "format"]}
+                    "include": {"type": "array", "items": {"type": "string"}, "description": "Only organize files matching one of these globs"},
+                    "exclude": {"type": "array", "items": {"type": "string"}, "description": "Skip files matching these globs"},
+                    "skip_hidden": {"type": "boolean", "default": False},
+                    "since_last_scan": {"type": "boolean", "default": False, "description": "Only organize files added or changed since the previous run on this directory"},
+                    "organization_method": {"type": "string", "default": "content", "enum": ["content", "date", "size", "format"]},
+                    "progress_interval": {"type": "number", "default": 1.0, "description": "Minimum seconds between progress notifications"},
+                    "limit": {"type": "integer", "minimum": 1, "maximum": 1000, "description": "Return at most this many per-file results plus a continuation cursor"},
+                    "cursor": {"type": "string", "description": "Continuation cursor from a previous page; other arguments are ignored"}
                 },
                 "required": ["directory_path"]
             }
         )
     ]
+    for tool in tools:
+        tool.inputSchema["properties"].update(OUTPUT_PROPERTIES)
+    return tools
+
+_tool_names = None
 
 @server.call_tool()
 async def handle_call_tool(name: str, arguments: dict) -> list[TextContent]:
     """Handle tool calls."""
+    global _tool_names
+    if _tool_names is None:
+        _tool_names = {tool.name for tool in await handle_list_tools()}
     try:
-        if name == "ai_analyze_directory_images":
-            return await ai_analyze_directory_images(arguments)
-        elif name == "ai_analyze_single_image":
-            return await ai_analyze_single_image(arguments)
-        elif name == "extract_comprehensive_metadata":
-            return await extract_comprehensive_metadata(arguments)
-        elif name == "organize_images_by_content":
-            return await organize_images_by_content(arguments)
-        else:
-            raise ValueError(f"Unknown tool: {name}")
+        # Set before the first await in this block, so the cancellation handler always has it
+        run = ToolRun.for_request(arguments)
+        async with client_limits.slot():
+            # Unknown names share one histogram so clients cannot grow the metrics without bound
+            with foreground, metrics.time(f"tool.{name}" if name in _tool_names else "tool.unknown"):
+                if name == "ai_analyze_directory_images":
+                    return await run_blocking(ai_analyze_directory_images, arguments, run)
+                elif name == "ai_analyze_single_image":
+                    return await run_blocking(ai_analyze_single_image, arguments)
+                elif name == "extract_comprehensive_metadata":
+                    return await run_blocking(extract_comprehensive_metadata, arguments)
+                elif name == "extract_metadata_batch":
+                    return await run_blocking(extract_metadata_batch, arguments, run)
+                elif name == "find_duplicate_images":
+                    return await run_blocking(find_duplicate_images, arguments, run)
+                elif name == "find_similar_images":
+                    return await run_blocking(find_similar_images, arguments, run)
+                elif name == "manage_rename_journals":
+                    return await run_blocking(manage_rename_journals, arguments, run)
+                elif name == "organize_images_by_content":
+                    return await run_blocking(organize_images_by_content, arguments, run)
+                elif name == "submit_job":
+                    return await run_blocking(submit_job, arguments)
+                elif name == "job_status":
+                    return await run_blocking(job_status, arguments)
+                elif name == "job_results":
+                    return await run_blocking(job_results, arguments)
+                elif name == "cancel_job":
+                    return await run_blocking(cancel_job, arguments)
+                elif name == "server_stats":
+                    return server_stats(arguments)
+                else:
+                    raise ValueError(f"Unknown tool: {name}")
+    except asyncio.CancelledError:
+        # The worker thread cannot be interrupted; tell it to stop at the next file
+        run.cancelled.set()
+        raise
     except Exception as e:
+        metrics.incr(f"errors.{type(e).__name__}")
+        if arguments.get("output_format", "text") != "text":
+            return [TextContent(type="text", text=_dumps({"error": str(e)}))]
         return [TextContent(type="text", text=f"Error: {str(e)}")]
 
-async def ai_analyze_single_image(arguments: Dict[str, Any]) -> list[TextContent]:
+def server_stats(arguments: Dict[str, Any]) -> list[TextContent]:
+    stats = metrics.snapshot()
+    if image_server.cache is not None:
+        stats["analysis_cache"] = image_server.cache.stats()
+    stats["memory_budget"] = {"in_use_mb": round(memory_budget.in_use() / 2**20, 1), "max_mb": round(memory_budget.limit / 2**20, 1), "max_pixels": MAX_IMAGE_PIXELS}
+    if client_limits.per_client is not None:
+        stats["http_clients"] = client_limits.stats()
+    stats["jobs"] = jobs.stats()
+    if arguments.get("reset", False):
+        metrics.reset()
+    output_format, fields = output_options(arguments)
+    if output_format != "text":
+        return render_record(output_format, stats, fields)
+    return [TextContent(type="text", text=json.dumps(stats, indent=2))]
+
+def ai_analyze_single_image(arguments: Dict[str, Any]) -> list[TextContent]:
     image_path = Path(arguments["image_path"])
     naming_style = arguments.get("naming_style", "descriptive")
     detailed_analysis = arguments.get("detailed_analysis", False)
+    output_format, fields = output_options(arguments)
     
     if not image_path.exists():
-        return [TextContent(type="text", text=f"Image file does not exist: {image_path}")]
+        return error_reply(output_format, f"Image file does not exist: {image_path}")
     if not image_server.is_image_file(image_path):
-        return [TextContent(type="text", text=f"File is not a supported image format: {image_path}")]
+        return error_reply(output_format, f"File is not a supported image format: {image_path}")
     
     try:
         analysis_data = image_server.advanced_heuristic_analysis(image_path)
         new_name = image_server.generate_name_from_analysis(analysis_data, naming_style)
         
+        if output_format != "text":
+            return render_record(output_format, {"path": str(image_path), "suggested": f"{new_name}{image_path.suffix.lower()}", "naming_style": naming_style, "analysis": analysis_data}, fields)
         if detailed_analysis:
             analysis_text = f"""🎯 Enhanced Image Analysis
 📁 File: {image_path.name}
@@ -313,6 +3543,8 @@ async def ai_analyze_single_image(arguments: Dict[str, Any]) -> list[TextContent
 🎨 Visual Analysis:
 - Color Family: {analysis_data.get('color_family', 'unknown')}
 - Brightness: {analysis_data.get('brightness', 0.5):.2f}
+- Contrast: {analysis_data.get('contrast', 0.0):.2f}
+- Saturation: {analysis_data.get('saturation', 0.0):.2f}
 - Grayscale: {analysis_data.get('is_grayscale', False)}
 
 📝 Content Insights:
@@ -328,151 +3560,398 @@ async def ai_analyze_single_image(arguments: Dict[str, Any]) -> list[TextContent
         else:
             return [TextContent(type="text", text=f"💡 Suggested name: {new_name}{image_path.suffix.lower()}\n🎨 Style: {naming_style}\n🔍 Analysis: Advanced heuristics")]
     except Exception as e:
-        return [TextContent(type="text", text=f"Error analyzing image: {str(e)}")]
+        return error_reply(output_format, f"Error analyzing image: {str(e)}")
 
-async def ai_analyze_directory_images(arguments: Dict[str, Any]) -> list[TextContent]:
+def ai_analyze_directory_images(arguments: Dict[str, Any], run: Optional[ToolRun] = None) -> list[TextContent]:
     directory_path = Path(arguments["directory_path"])
     recursive = arguments.get("recursive", False)
     rename_files = arguments.get("rename_files", False)
     prefix = arguments.get("prefix", "")
     naming_style = arguments.get("naming_style", "descriptive")
+    limit = arguments.get("limit")
     
+    if arguments.get("cursor"):
+        return [TextContent(type="text", text=result_pages.page(arguments["cursor"], limit or 100))]
+    
+    output_format, fields = output_options(arguments)
+    structured = output_format != "text"
     if not directory_path.exists():
-        return [TextContent(type="text", text=f"Directory does not exist: {directory_path}")]
+        return error_reply(output_format, f"Directory does not exist: {directory_path}")
     
-    image_files = image_server.get_image_files(directory_path, recursive)
-    if not image_files:
+    since_last_scan = arguments.get("since_last_scan", False)
+    walk_options = {"recursive": recursive, "max_depth": arguments.get("max_depth"), "include": arguments.get("include"), "exclude": arguments.get("exclude"), "skip_hidden": arguments.get("skip_hidden", False)}
+    entries = image_server.iter_image_entries(directory_path, **walk_options)
+    snapshot = DirectorySnapshot(image_server.cache, directory_path, {"tool": "analyze", **walk_options})
+    run = run or ToolRun()
+    results, renamed_files, records = [], [], []
+    analyses = list(analyze_image_files(snapshot.diff(entries), run))
+    cancelled = run.is_cancelled()
+    if cancelled:
+        rename_files = False
+    else:
+        for image_path, analysis_data in analyses:
+            snapshot.record(image_path, analysis_data)
+        analyses = snapshot.results(only_delta=since_last_scan)
+    if not analyses and not cancelled:
+        snapshot.save()
+        if structured:
+            summary = {"directory": str(directory_path), "naming_style": naming_style, "processed": 0, "cancelled": False}
+            if snapshot.exists:
+                summary["changes"] = snapshot.changes()
+            return structured_reply(output_format, summary, [], fields, limit)
+        if since_last_scan and snapshot.exists:
+            return [TextContent(type="text", text=f"No new or changed images since the last scan\n{snapshot.summary()}")]
         return [TextContent(type="text", text="No image files found in the directory")]
     
-    results, renamed_files, analysis_results = [], [], []
-    
-    for i, image_path in enumerate(image_files):
+    plan, moves, labels, move_records = RenamePlan(), [], [], []
+    for i, (image_path, analysis_data) in enumerate(analyses):
         try:
-            progress = f"[{i+1}/{len(image_files)}]"
-            analysis_data = image_server.advanced_heuristic_analysis(image_path)
-            new_name = image_server.generate_name_from_analysis(analysis_data, naming_style)
-            
-            if prefix:
-                new_name = f"{prefix}_{new_name}"
-            
-            new_name = f"{new_name}{image_path.suffix.lower()}"
-            new_path = image_path.parent / new_name
-            
-            counter = 1
-            original_new_name = new_name
-            while new_path.exists() and new_path != image_path:
-                name_parts = original_new_name.rsplit('.', 1)
-                new_name = f"{name_parts[0]}_{counter}.{name_parts[1]}"
-                new_path = image_path.parent / new_name
-                counter += 1
+            progress = f"[{i+1}/{len(analyses)}]"
+            new_path = suggest_path(plan, image_path, analysis_data, naming_style, prefix)
+            new_name = new_path.name
+            record = {'path': str(image_path), 'original': image_path.name, 'suggested': new_name, 'status': 'suggested', 'analysis': analysis_data}
             
             if rename_files and new_path != image_path:
-                try:
-                    image_path.rename(new_path)
-                    renamed_files.append(f"{progress} ✅ {image_path.name} → {new_name}")
-                except Exception as e:
-                    results.append(f"{progress} ❌ Failed to rename {image_path.name}: {str(e)}")
-            else:
+                moves.append((image_path, new_path))
+                labels.append(progress)
+                move_records.append(record)
+                record['status'] = 'pending'
+            elif not structured:
                 results.append(f"{progress} 💡 {image_path.name} → {new_name}")
             
-            analysis_results.append({'original': image_path.name, 'suggested': new_name, 'analysis': analysis_data})
+            records.append(record)
         except Exception as e:
-            results.append(f"{progress} ❌ Error processing {image_path.name}: {str(e)}")
+            if structured:
+                records.append({'path': str(image_path), 'original': image_path.name, 'status': 'error', 'error': str(e)})
+            else:
+                results.append(f"{progress} ❌ Error processing {image_path.name}: {str(e)}")
     
-    summary_parts = [f"🎯 Enhanced Image Analysis Complete", f"📊 Processed {len(image_files)} image files using {naming_style} style", ""]
+    # Taken before renaming, which would otherwise show the old names as removed
+    scan_changes = snapshot.changes() if structured else snapshot.summary()
+    journal = None
+    if moves:
+        journal = RenameJournal.create("ai_analyze_directory_images", directory_path, moves)
+        moved, errors = journal.apply(run.is_cancelled, snapshot.moved)
+        for i in moved:
+            move_records[i]['status'] = 'renamed'
+        for i, error in errors:
+            move_records[i].update(status='rename_failed', error=str(error))
+        if not structured:
+            renamed_files.extend(f"{labels[i]} ✅ {moves[i][0].name} → {moves[i][1].name}" for i in moved)
+            renamed_files.extend(f"{labels[i]} ❌ Failed to rename {moves[i][0].name}: {error}" for i, error in errors)
+    
+    color_families, orientations = {}, {}
+    for record in records:
+        analysis = record.get('analysis', {})
+        if 'color_family' in analysis:
+            color_families[analysis['color_family']] = color_families.get(analysis['color_family'], 0) + 1
+        if 'orientation' in analysis:
+            orientations[analysis['orientation']] = orientations.get(analysis['orientation'], 0) + 1
+    
+    if structured:
+        summary = {"directory": str(directory_path), "naming_style": naming_style, "processed": len(analyses), "cancelled": cancelled}
+        if not cancelled:
+            if snapshot.exists:
+                summary["changes"] = scan_changes
+            snapshot.save()
+        summary.update(renamed=len(journal.done) if journal else 0, journal_id=journal.id if journal else None, color_families=color_families, orientations=orientations)
+        return structured_reply(output_format, summary, records, fields, limit)
+    
+    if cancelled:
+        summary_parts = [f"⏹️ Enhanced Image Analysis Cancelled", f"📊 Processed {len(analyses)} image files using {naming_style} style before cancellation; no files were renamed", ""]
+    else:
+        summary_parts = [f"🎯 Enhanced Image Analysis Complete", f"📊 Processed {len(analyses)} image files using {naming_style} style", ""]
+        if snapshot.exists:
+            summary_parts.insert(2, scan_changes)
+        snapshot.save()
     
     if rename_files:
-        summary_parts.extend([f"✅ Successfully renamed {len(renamed_files)} files:", ""])
-        summary_parts.extend(renamed_files)
+        if journal is not None:
+            summary_parts.append(f"🧾 Journal {journal.id}: undo with manage_rename_journals (action=rollback)")
+        summary_parts.extend([f"✅ Successfully renamed {len(journal.done) if journal else 0} files:", ""])
+        entries = renamed_files
     else:
         summary_parts.extend([f"💡 Suggested names (use rename_files=true to apply):", ""])
-        summary_parts.extend(results)
+        entries = results
     
-    if analysis_results:
-        color_families, orientations = {}, {}
-        for result in analysis_results:
-            analysis = result['analysis']
-            if 'color_family' in analysis:
-                color_families[analysis['color_family']] = color_families.get(analysis['color_family'], 0) + 1
-            if 'orientation' in analysis:
-                orientations[analysis['orientation']] = orientations.get(analysis['orientation'], 0) + 1
-        
-        summary_parts.extend(["", "📈 Analysis Insights:", f"🎨 Color distribution: {dict(list(color_families.items())[:3])}", f"📐 Orientations: {orientations}"])
+    footer_parts = []
+    if any('analysis' in record for record in records):
+        footer_parts.extend(["", "📈 Analysis Insights:", f"🎨 Color distribution: {dict(list(color_families.items())[:3])}", f"📐 Orientations: {orientations}"])
     
-    return [TextContent(type="text", text="\n".join(summary_parts))]
+    if limit is not None:
+        run_id = result_pages.store(summary_parts, entries, footer_parts)
+        return [TextContent(type="text", text=result_pages.render(run_id, 0, limit))]
+    return [TextContent(type="text", text="\n".join(summary_parts + entries + footer_parts))]
 
-async def extract_comprehensive_metadata(arguments: Dict[str, Any]) -> list[TextContent]:
+def extract_comprehensive_metadata(arguments: Dict[str, Any]) -> list[TextContent]:
     image_path = Path(arguments["image_path"])
     include_color_analysis = arguments.get("include_color_analysis", True)
+    output_format, fields = output_options(arguments)
     
     if not image_path.exists():
-        return [TextContent(type="text", text=f"Image file does not exist: {image_path}")]
+        return error_reply(output_format, f"Image file does not exist: {image_path}")
     
     try:
-        metadata = {"filename": image_path.name, "path": str(image_path)}
-        
-        with Image.open(image_path) as img:
-            metadata.update({"format": img.format, "mode": img.mode, "size": img.size, "width": img.width, "height": img.height, "aspect_ratio": round(img.width / img.height, 3)})
-        
-        stat = image_path.stat()
-        metadata.update({"file_size_bytes": stat.st_size, "file_size_mb": round(stat.st_size / (1024 * 1024), 2), "created": datetime.fromtimestamp(stat.st_ctime).isoformat(), "modified": datetime.fromtimestamp(stat.st_mtime).isoformat()})
-        
-        exif_data = image_server.extract_exif_data(image_path)
-        if exif_data and "error" not in exif_data:
-            metadata["exif"] = exif_data
-        
-        if include_color_analysis:
-            color_analysis = image_server.analyze_image_colors(image_path)
-            if "error" not in color_analysis:
-                metadata["color_analysis"] = color_analysis
-        
+        metadata = image_server.extract_metadata(image_path, include_color_analysis)
+        if output_format != "text":
+            return render_record(output_format, metadata, fields)
         metadata_text = json.dumps(metadata, indent=2, default=str)
         return [TextContent(type="text", text=f"🔍 Comprehensive Metadata for {image_path.name}:\n\n```json\n{metadata_text}\n```")]
     except Exception as e:
-        return [TextContent(type="text", text=f"Error extracting metadata: {str(e)}")]
+        return error_reply(output_format, f"Error extracting metadata: {str(e)}")
+
+def extract_metadata_batch(arguments: Dict[str, Any], run: Optional[ToolRun] = None) -> list[TextContent]:
+    include_color_analysis = arguments.get("include_color_analysis", False)
+    output_format, fields = output_options(arguments)
+    structured = output_format != "text"
+    
+    if arguments.get("image_paths"):
+        image_files = (Path(image_path) for image_path in arguments["image_paths"])
+    elif arguments.get("directory_path"):
+        directory_path = Path(arguments["directory_path"])
+        if not directory_path.exists():
+            return error_reply(output_format, f"Directory does not exist: {directory_path}")
+        pattern = arguments.get("pattern")
+        image_files = image_server.iter_image_files(directory_path, arguments.get("recursive", False), include=[pattern] if pattern else None)
+    else:
+        return error_reply(output_format, "Provide image_paths or directory_path")
+    
+    run = run or ToolRun()
+    
+    def extract(image_path: Path) -> Union[str, Dict[str, Any]]:
+        try:
+            record = image_server.extract_metadata(image_path, include_color_analysis)
+            if fields:
+                record = {"path": str(image_path), **project_fields(record, fields)}
+        except Exception as e:
+            record = {"path": str(image_path), "error": str(e)}
+        return record if structured else json.dumps(record, default=str, separators=(',', ':'))
+    
+    lines = []
+    pool = get_io_pool()
+    while not run.is_cancelled():
+        chunk = list(islice(image_files, 256))
+        if not chunk:
+            break
+        lines.extend(pool.map(extract, chunk))
+        run.progress(len(lines), None, f"{len(lines)} files")
+    if not run.is_cancelled():
+        run.progress(len(lines), len(lines), f"{len(lines)} files")
+    
+    if structured:
+        summary = {"files": len(lines), "errors": sum('error' in record for record in lines), "cancelled": run.is_cancelled()}
+        return structured_reply(output_format, summary, lines)
+    if not lines:
+        return [TextContent(type="text", text="No image files found")]
+    return [TextContent(type="text", text="\n".join(lines))]
+
+def find_duplicate_images(arguments: Dict[str, Any], run: Optional[ToolRun] = None) -> list[TextContent]:
+    directory_path = Path(arguments["directory_path"])
+    hash_type = arguments.get("hash_type", "phash")
+    threshold = max(0, min(int(arguments.get("threshold", 4)), 8))
+    limit = arguments.get("limit")
+    
+    if arguments.get("cursor"):
+        return [TextContent(type="text", text=result_pages.page(arguments["cursor"], limit or 100))]
+    
+    output_format, fields = output_options(arguments)
+    if hash_type not in HASH_TYPES:
+        return error_reply(output_format, f"Unknown hash_type: {hash_type} (expected one of {', '.join(HASH_TYPES)})")
+    if not directory_path.exists():
+        return error_reply(output_format, f"Directory does not exist: {directory_path}")
+    
+    image_files = image_server.iter_image_files(directory_path, arguments.get("recursive", False), arguments.get("max_depth"), arguments.get("include"), arguments.get("exclude"), arguments.get("skip_hidden", False))
+    paths, hashes, failed = [], [], 0
+    for image_path, result in analyze_image_files(image_files, run, task='hashes'):
+        if hash_type in result:
+            paths.append(image_path)
+            hashes.append(int(result[hash_type], 16))
+        else:
+            failed += 1
+    
+    groups = group_near_duplicates(hashes, threshold)
+    
+    def describe(i: int) -> str:
+        try:
+            with image_server.open_context(paths[i]) as ctx:
+                return f"{ctx.header['width']}x{ctx.header['height']}, {ctx.stat.st_size / 1024:.0f} KB"
+        except Exception as e:
+            return f"unreadable: {e}"
+    
+    def display(image_path: Path) -> str:
+        return str(image_path.relative_to(directory_path)) if image_path.is_relative_to(directory_path) else str(image_path)
+    
+    duplicates = sum(len(group) - 1 for group in groups)
+    if output_format != "text":
+        records = []
+        for group in groups:
+            group.sort(key=lambda i: (-paths[i].stat().st_size, str(paths[i])))
+            keep = hashes[group[0]]
+            records.append({"keep": str(paths[group[0]]), "members": [{"path": str(paths[i]), "distance": (hashes[i] ^ keep).bit_count(), "bytes": paths[i].stat().st_size} for i in group]})
+        summary = {"directory": str(directory_path), "hash_type": hash_type, "threshold": threshold, "hashed": len(paths), "failed": failed, "groups": len(groups), "redundant": duplicates}
+        return structured_reply(output_format, summary, records, fields, limit)
+    header = [f"🔍 Duplicate scan: {directory_path}", f"📸 Hashed {len(paths)} images with {hash_type} (threshold {threshold} bits)"]
+    if failed:
+        header.append(f"❌ Could not hash {failed} files")
+    header.extend([f"🧩 Found {len(groups)} groups covering {duplicates + len(groups)} images ({duplicates} redundant copies)", ""])
+    entries = []
+    for number, group in enumerate(groups, 1):
+        # Suggest keeping the largest file, which is usually the least recompressed copy
+        group.sort(key=lambda i: (-paths[i].stat().st_size, str(paths[i])))
+        keep = hashes[group[0]]
+        lines = [f"Group {number} ({len(group)} images):", f"   ✅ keep: {display(paths[group[0]])} ({describe(group[0])})"]
+        for i in group[1:]:
+            lines.append(f"   • {display(paths[i])} ({describe(i)}) — distance {(hashes[i] ^ keep).bit_count()}")
+        entries.append("\n".join(lines))
+    footer = [] if groups else ["✨ No duplicates found"]
+    
+    if limit is not None:
+        run_id = result_pages.store(header, entries, footer)
+        return [TextContent(type="text", text=result_pages.render(run_id, 0, limit))]
+    return [TextContent(type="text", text="\n".join(header + entries + footer))]
+
+def find_similar_images(arguments: Dict[str, Any], run: Optional[ToolRun] = None) -> list[TextContent]:
+    image_path = Path(arguments["image_path"])
+    directory_path = Path(arguments["directory_path"])
+    k = max(1, min(int(arguments.get("k", 10)), 100))
+    mode = arguments.get("mode", "auto")
+    output_format, fields = output_options(arguments)
+    run = run or ToolRun()
+    
+    if not image_path.exists():
+        return error_reply(output_format, f"Image file does not exist: {image_path}")
+    if not directory_path.exists():
+        return error_reply(output_format, f"Directory does not exist: {directory_path}")
+    
+    walk_options = {"recursive": arguments.get("recursive", False), "max_depth": arguments.get("max_depth"), "include": arguments.get("include"), "exclude": arguments.get("exclude"), "skip_hidden": arguments.get("skip_hidden", False)}
+    key = json.dumps([str(directory_path.resolve()), walk_options], sort_keys=True, default=str)
+    index = feature_indexes.get(key)
+    if index is None or arguments.get("refresh", False):
+        index = build_feature_index(directory_path, walk_options, index, run)
+        if run.is_cancelled():
+            return error_reply(output_format, "Cancelled")
+        feature_indexes.put(key, index)
+    
+    query = image_server.feature_vector(image_path)
+    if "error" in query:
+        return error_reply(output_format, f"Error analyzing {image_path.name}: {query['error']}")
+    approximate = mode == "approximate" or (mode == "auto" and len(index) >= FeatureIndex.APPROXIMATE_MIN_ROWS)
+    started = time.perf_counter()
+    matches = index.search(query["vector"], k + 1, approximate and NUMPY_AVAILABLE)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    query_path = image_path.resolve()
+    matches = [(row, distance) for row, distance in matches if Path(index.paths[row]).resolve() != query_path][:k]
+    
+    if output_format != "text":
+        summary = {"query": str(image_path), "directory": str(directory_path), "indexed": len(index), "built": index.built, "search": "approximate" if approximate and NUMPY_AVAILABLE else "exact", "search_ms": round(elapsed_ms, 2)}
+        records = [{"rank": rank, "path": str(index.paths[row]), "distance": round(float(distance), 4)} for rank, (row, distance) in enumerate(matches, 1)]
+        return structured_reply(output_format, summary, records, fields)
+    result_parts = [
+        f"🔎 Images similar to {image_path.name} in {directory_path}",
+        f"📚 Index of {len(index)} images built {index.built}; {'approximate' if approximate and NUMPY_AVAILABLE else 'exact'} search took {elapsed_ms:.1f} ms",
+        ""
+    ]
+    for rank, (row, distance) in enumerate(matches, 1):
+        match_path = Path(index.paths[row])
+        shown = match_path.relative_to(directory_path) if match_path.is_relative_to(directory_path) else match_path
+        result_parts.append(f"{rank}. {shown} — distance {distance:.3f}")
+    if not matches:
+        result_parts.append("No other images in the index")
+    return [TextContent(type="text", text="\n".join(result_parts))]
+
+def manage_rename_journals(arguments: Dict[str, Any], run: Optional[ToolRun] = None) -> list[TextContent]:
+    action = arguments.get("action", "list")
+    output_format, fields = output_options(arguments)
+    structured = output_format != "text"
+    run = run or ToolRun()
+    
+    if action == "list":
+        journals = RenameJournal.list_all()
+        limit = int(arguments.get("limit", 20))
+        if structured:
+            return structured_reply(output_format, {"journals": len(journals), "shown": min(limit, len(journals))}, [journal.describe() for journal in journals[:limit]], fields)
+        if not journals:
+            return [TextContent(type="text", text="No rename journals found")]
+        result_parts = [f"🧾 Rename journals ({len(journals)}):", ""] + [journal.summary() for journal in journals[:limit]]
+        if len(journals) > limit:
+            result_parts.append(f"... and {len(journals) - limit} older")
+        return [TextContent(type="text", text="\n".join(result_parts))]
+    
+    journal = RenameJournal.open(arguments.get("journal_id"))
+    if action == "status":
+        if structured:
+            records = [{"source": str(source), "target": str(target), "state": "rolled_back" if i in journal.undone else "moved" if i in journal.done else "pending"} for i, (source, target) in enumerate(journal.moves)]
+            return structured_reply(output_format, journal.describe(), records, fields)
+        result_parts = [journal.summary(), ""]
+        for i, (source, target) in enumerate(journal.moves):
+            mark = "↩️" if i in journal.undone else "✅" if i in journal.done else "⏳"
+            result_parts.append(f"{mark} {source} → {target}")
+        return [TextContent(type="text", text="\n".join(result_parts))]
+    if action == "resume":
+        moved, errors = journal.apply(run.is_cancelled)
+        verb = "Moved"
+    elif action == "rollback":
+        moved, errors = journal.rollback()
+        verb = "Restored"
+    else:
+        raise ValueError(f"Unknown action: {action}")
+    if structured:
+        summary = {**journal.describe(), "action": action, "succeeded": len(moved), "errors": len(errors)}
+        return structured_reply(output_format, summary, [{"source": str(journal.moves[i][0]), "error": str(error)} for i, error in errors], fields)
+    result_parts = [journal.summary(), f"✅ {verb} {len(moved)} files", f"❌ Encountered {len(errors)} errors"]
+    result_parts.extend(f"❌ {journal.moves[i][0].name}: {error}" for i, error in errors)
+    return [TextContent(type="text", text="\n".join(result_parts))]
 
-async def organize_images_by_content(arguments: Dict[str, Any]) -> list[TextContent]:
+def organize_images_by_content(arguments: Dict[str, Any], run: Optional[ToolRun] = None) -> list[TextContent]:
     directory_path = Path(arguments["directory_path"])
     create_folders = arguments.get("create_folders", False)
     organization_method = arguments.get("organization_method", "content")
+    limit = arguments.get("limit")
+    
+    if arguments.get("cursor"):
+        return [TextContent(type="text", text=result_pages.page(arguments["cursor"], limit or 100))]
     
+    output_format, fields = output_options(arguments)
+    structured = output_format != "text"
     if not directory_path.exists():
-        return [TextContent(type="text", text=f"Directory does not exist: {directory_path}")]
+        return error_reply(output_format, f"Directory does not exist: {directory_path}")
     
-    image_files = image_server.get_image_files(directory_path, False)
-    if not image_files:
+    since_last_scan = arguments.get("since_last_scan", False)
+    walk_options = {"include": arguments.get("include"), "exclude": arguments.get("exclude"), "skip_hidden": arguments.get("skip_hidden", False)}
+    entries = image_server.iter_image_entries(directory_path, False, **walk_options)
+    snapshot = DirectorySnapshot(image_server.cache, directory_path, {"tool": "organize", **walk_options})
+    run = run or ToolRun()
+    categories, analyses = {}, {}
+    if organization_method == "content":
+        analyses = dict(analyze_image_files(snapshot.diff(entries), run))
+        image_files = list(analyses)
+    else:
+        image_files = list(snapshot.diff(entries, need_analysis=False))
+    cancelled = run.is_cancelled()
+    if cancelled:
+        create_folders = False
+    else:
+        for image_path, analysis in analyses.items():
+            snapshot.record(image_path, analysis)
+        if organization_method == "content":
+            analyses = dict(snapshot.results(only_delta=since_last_scan))
+            image_files = list(analyses)
+        elif not since_last_scan:
+            image_files = [image_path for image_path, _ in snapshot.results()]
+    if not image_files and not cancelled:
+        snapshot.save()
+        if structured:
+            summary = {"directory": str(directory_path), "method": organization_method, "images": 0, "cancelled": False}
+            if snapshot.exists:
+                summary["changes"] = snapshot.changes()
+            return structured_reply(output_format, summary, [], fields, limit)
+        if since_last_scan and snapshot.exists:
+            return [TextContent(type="text", text=f"No new or changed images since the last scan\n{snapshot.summary()}")]
         return [TextContent(type="text", text="No image files found in the directory")]
     
-    categories = {}
-    
     for image_path in image_files:
         try:
-            category = "miscellaneous"
-            if organization_method == "content":
-                analysis = image_server.advanced_heuristic_analysis(image_path)
-                if 'screenshot' in analysis.get('filename_hints', []):
-                    category = "screenshots"
-                elif 'photo' in analysis.get('filename_hints', []):
-                    category = "photos"
-                elif analysis.get('source') == 'camera':
-                    category = "camera_photos"
-                elif 'edited' in analysis.get('filename_hints', []):
-                    category = "edited_images"
-                elif analysis.get('orientation') == 'portrait':
-                    category = "portraits"
-                elif analysis.get('orientation') == 'landscape':
-                    category = "landscapes"
-                elif analysis.get('color_family') in ['black', 'white', 'gray']:
-                    category = "black_white"
-            elif organization_method == "date":
-                stat = image_path.stat()
-                date = datetime.fromtimestamp(stat.st_ctime)
-                category = f"{date.year}-{date.month:02d}"
-            elif organization_method == "size":
-                with Image.open(image_path) as img:
-                    category = image_server.categorize_size(img.width * img.height)
-            elif organization_method == "format":
-                category = image_path.suffix.lower().replace('.', '')
+            category = categorize_image(image_path, organization_method, analyses[image_path] if organization_method == "content" else None)
             
             if category not in categories:
                 categories[category] = []
@@ -483,52 +3962,220 @@ async def organize_images_by_content(arguments: Dict[str, Any]) -> list[TextCont
                 categories["errors"] = []
             categories["errors"].append(image_path)
     
+    def move_into_categories():
+        plan, moves = RenamePlan(), []
+        for category, files in categories.items():
+            category_dir = directory_path / category
+            moves.extend((file_path, plan.reserve(file_path, category_dir, file_path.name)) for file_path in files)
+        journal = RenameJournal.create("organize_images_by_content", directory_path, moves)
+        moved, failed = journal.apply(run.is_cancelled, snapshot.moved)
+        return moves, journal, moved, failed
+    
+    if structured:
+        records = [{"path": str(file_path), "category": category, "status": "planned"} for category, files in categories.items() for file_path in files]
+        summary = {"directory": str(directory_path), "method": organization_method, "images": len(image_files), "cancelled": cancelled, "categories": {category: len(files) for category, files in categories.items()}}
+        if not cancelled and snapshot.exists:
+            summary["changes"] = snapshot.changes()
+        if create_folders:
+            moves, journal, moved, failed = move_into_categories()
+            # moves follow the same category order as records
+            for record, (_, target) in zip(records, moves):
+                record.update(target=str(target), status="pending")
+            for i in moved:
+                records[i]["status"] = "moved"
+            for i, error in failed:
+                records[i].update(status="move_failed", error=str(error))
+            summary.update(moved=len(moved), errors=len(failed), journal_id=journal.id)
+        if not cancelled:
+            snapshot.save()
+        return structured_reply(output_format, summary, records, fields, limit)
+    
     plan_parts = [f"📁 Image Organization Plan", f"📊 Method: {organization_method}", f"🔍 Found {len(image_files)} images in {len(categories)} categories", ""]
+    if cancelled:
+        plan_parts[0] = f"⏹️ Image Organization Cancelled (partial plan, no files were moved)"
+    elif snapshot.exists:
+        plan_parts.insert(3, snapshot.summary())
     
-    for category, files in categories.items():
-        plan_parts.append(f"📂 {category.replace('_', ' ').title()} ({len(files)} files):")
-        for file_path in files[:5]:
-            plan_parts.append(f"   • {file_path.name}")
-        if len(files) > 5:
-            plan_parts.append(f"   • ... and {len(files) - 5} more")
+    entries = []
+    if limit is not None:
+        for category, files in categories.items():
+            plan_parts.append(f"📂 {category.replace('_', ' ').title()} ({len(files)} files)")
+            entries.extend(f"   • {category}/{file_path.name}" for file_path in files)
         plan_parts.append("")
+    else:
+        for category, files in categories.items():
+            plan_parts.append(f"📂 {category.replace('_', ' ').title()} ({len(files)} files):")
+            for file_path in files[:5]:
+                plan_parts.append(f"   • {file_path.name}")
+            if len(files) > 5:
+                plan_parts.append(f"   • ... and {len(files) - 5} more")
+            plan_parts.append("")
     
+    footer_parts = [""] if entries else []
     if create_folders:
-        moved_files, errors = [], []
-        for category, files in categories.items():
-            category_dir = directory_path / category
-            try:
-                category_dir.mkdir(exist_ok=True)
-                for file_path in files:
-                    try:
-                        new_path = category_dir / file_path.name
-                        counter = 1
-                        while new_path.exists():
-                            name_parts = file_path.name.rsplit('.', 1)
-                            new_name = f"{name_parts[0]}_{counter}.{name_parts[1]}"
-                            new_path = category_dir / new_name
-                            counter += 1
-                        file_path.rename(new_path)
-                        moved_files.append(f"✅ {file_path.name} → {category}/{new_path.name}")
-                    except Exception as e:
-                        errors.append(f"❌ Failed to move {file_path.name}: {str(e)}")
-            except Exception as e:
-                errors.append(f"❌ Failed to create folder {category}: {str(e)}")
+        moves, journal, moved, failed = move_into_categories()
+        moved_files = [f"✅ {moves[i][0].name} → {moves[i][1].parent.name}/{moves[i][1].name}" for i in moved]
+        errors = [f"❌ Failed to move {moves[i][0].name}: {error}" for i, error in failed]
         
-        plan_parts.extend([f"🎯 Organization Results:", f"✅ Successfully moved {len(moved_files)} files", f"❌ Encountered {len(errors)} errors", ""])
+        footer_parts.extend([f"🎯 Organization Results:", f"✅ Successfully moved {len(moved_files)} files", f"❌ Encountered {len(errors)} errors", f"🧾 Journal {journal.id}: undo with manage_rename_journals (action=rollback)", ""])
         
         if moved_files:
-            plan_parts.extend(["Moved Files:"] + moved_files[:10])
+            footer_parts.extend(["Moved Files:"] + moved_files[:10])
             if len(moved_files) > 10:
-                plan_parts.append(f"... and {len(moved_files) - 10} more")
+                footer_parts.append(f"... and {len(moved_files) - 10} more")
         if errors:
-            plan_parts.extend(["Errors:"] + errors)
+            footer_parts.extend(["Errors:"] + errors)
+    else:
+        footer_parts.append("💡 Use create_folders=true to actually organize the files")
+    if not cancelled:
+        snapshot.save()
+    
+    if limit is not None:
+        run_id = result_pages.store(plan_parts, entries, footer_parts)
+        return [TextContent(type="text", text=result_pages.render(run_id, 0, limit))]
+    return [TextContent(type="text", text="\n".join(plan_parts + footer_parts))]
+
+def submit_job(arguments: Dict[str, Any]) -> list[TextContent]:
+    output_format, fields = output_options(arguments)
+    tool = arguments.get("tool")
+    if tool not in JobQueue.TOOLS:
+        raise ValueError(f"Jobs can run {' or '.join(JobQueue.TOOLS)}, not {tool}")
+    job_arguments = dict(arguments.get("arguments") or {})
+    if not job_arguments.get("directory_path"):
+        return error_reply(output_format, "arguments.directory_path is required")
+    directory_path = Path(job_arguments["directory_path"]).expanduser()
+    if not directory_path.is_dir():
+        return error_reply(output_format, f"Directory does not exist: {directory_path}")
+    # The job may resume after a restart from another working directory
+    job_arguments["directory_path"] = str(directory_path.resolve())
+    job = jobs.submit(tool, job_arguments)
+    if output_format != "text":
+        return render_record(output_format, JobQueue.describe(job), fields)
+    return [TextContent(type="text", text=f"🧾 Job {job['id']} queued: {tool} in {job_arguments['directory_path']}\n💡 Follow it with job_status, read records with job_results, stop it with cancel_job")]
+
+def job_status(arguments: Dict[str, Any]) -> list[TextContent]:
+    output_format, fields = output_options(arguments)
+    if not arguments.get("job_id"):
+        count, recent = jobs.list(int(arguments.get("limit", 20)))
+        if output_format != "text":
+            return structured_reply(output_format, {"jobs": count, "shown": len(recent)}, [JobQueue.describe(job) for job in recent], fields)
+        if not recent:
+            return [TextContent(type="text", text="No jobs found")]
+        result_parts = [f"🧾 Jobs ({count}):", ""] + [JobQueue.summary(job) for job in recent]
+        if count > len(recent):
+            result_parts.append(f"... and {count - len(recent)} older")
+        return [TextContent(type="text", text="\n".join(result_parts))]
+    
+    job = jobs.get(arguments["job_id"])
+    if output_format != "text":
+        return render_record(output_format, JobQueue.describe(job), fields)
+    totals = job["totals"]
+    result_parts = [JobQueue.summary(job)]
+    if totals.get("errors"):
+        result_parts.append(f"❌ {totals['errors']} files could not be processed")
+    for key, label in (("categories", "📂 Categories"), ("color_families", "🎨 Color distribution"), ("orientations", "📐 Orientations")):
+        if totals.get(key):
+            result_parts.append(f"{label}: {totals[key]}")
+    if job["journal_id"]:
+        result_parts.append(f"🧾 Journal {job['journal_id']}: {totals.get('moved', 0)} files moved; undo with manage_rename_journals (action=rollback)")
+    return [TextContent(type="text", text="\n".join(result_parts))]
+
+def job_results(arguments: Dict[str, Any]) -> list[TextContent]:
+    output_format, fields = output_options(arguments)
+    limit = max(1, min(int(arguments.get("limit", 100)), ResultPages.MAX_PAGE_SIZE))
+    if arguments.get("cursor"):
+        job_id, offset = ResultPages.decode_cursor(arguments["cursor"])
+    else:
+        job_id, offset = arguments.get("job_id"), 0
+    job = jobs.get(job_id)
+    records, next_offset = jobs.results(job, offset, limit)
+    next_cursor = ResultPages.encode_cursor(job_id, next_offset) if next_offset is not None else None
+    if output_format != "text":
+        return [TextContent(type="text", text=render_structured(output_format, JobQueue.describe(job) if offset == 0 else None, records, fields, paging={"count": len(records), "next_cursor": next_cursor}))]
+    
+    result_parts = [JobQueue.summary(job), ""] if offset == 0 else []
+    for record in records:
+        if job["tool"] == "organize_images_by_content":
+            result_parts.append(f"   • {record['category']}/{Path(record['path']).name}" + (f" ❌ {record['error']}" if "error" in record else ""))
+        elif "error" in record:
+            result_parts.append(f"❌ Error processing {record['original']}: {record['error']}")
+        else:
+            result_parts.append(f"💡 {record['original']} → {record['suggested']}")
+    if not records:
+        result_parts.append("No results checkpointed yet" if job["state"] in ("queued", "running") else "No results")
+    if next_cursor is not None:
+        result_parts.extend(["", f"📄 Showing {len(records)} results. Next cursor: {next_cursor}"])
+    return [TextContent(type="text", text="\n".join(result_parts))]
+
+def cancel_job(arguments: Dict[str, Any]) -> list[TextContent]:
+    output_format, fields = output_options(arguments)
+    previous = jobs.get(arguments.get("job_id"))["state"]
+    job = jobs.cancel(arguments.get("job_id"))
+    if output_format != "text":
+        return render_record(output_format, JobQueue.describe(job), fields)
+    if previous in JobQueue.FINISHED:
+        return [TextContent(type="text", text=f"Job {job['id']} has already {'been cancelled' if previous == 'cancelled' else previous}")]
+    return [TextContent(type="text", text=f"⏹️ Cancelling job {job['id']} at {job['done']} files; results checkpointed so far remain available from job_results")]
+
+async def serve_http(host: str, port: int) -> None:
+    """Serve every client from this process over MCP streamable HTTP at ``http://host:port/mcp``.
+
+    Each client gets its own session, while the analysis cache, worker pools, feature
+    indexes and result pages stay warm and shared. On SIGINT or SIGTERM the listener
+    closes, in-flight calls get ``SHUTDOWN_GRACE_SECONDS`` to finish, and whatever is
+    left is cancelled.
+    """
+    import uvicorn
+    from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
+    from mcp.server.transport_security import TransportSecuritySettings
+    from starlette.applications import Starlette
+    from starlette.routing import Route
+    global client_limits
+    
+    # Browsers on other sites must not reach a loopback server through DNS rebinding
+    security = None
+    if host in ("127.0.0.1", "localhost", "::1"):
+        security = TransportSecuritySettings(allowed_hosts=["127.0.0.1:*", "localhost:*", "[::1]:*"], allowed_origins=["http://127.0.0.1:*", "http://localhost:*", "http://[::1]:*"])
     else:
-        plan_parts.append("💡 Use create_folders=true to actually organize the files")
+        logger.warning(f"Serving on {host}, which is reachable from other machines; the server has no authentication")
+    manager = StreamableHTTPSessionManager(app=server, security_settings=security)
+    client_limits = ClientLimits(CLIENT_MAX_CALLS)
+    
+    class Endpoint:
+        async def __call__(self, scope, receive, send):
+            await manager.handle_request(scope, receive, send)
+    
+    class DrainingServer(uvicorn.Server):
+        # Responses stream over SSE, and sse-starlette ends every stream as soon as uvicorn's
+        # should_exit is set, so in-flight calls are drained before uvicorn sees the signal
+        draining = False
+        
+        def handle_exit(self, sig, frame) -> None:
+            if self.draining:
+                super().handle_exit(sig, frame)
+                return
+            self.draining = True
+            client_limits.closing = True
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self.drain(sig)))
+        
+        async def drain(self, sig) -> None:
+            deadline = time.monotonic() + SHUTDOWN_GRACE_SECONDS
+            if not foreground.idle.is_set():
+                logger.info(f"Shutting down: waiting up to {SHUTDOWN_GRACE_SECONDS:g}s for in-flight tool calls")
+            while not foreground.idle.is_set() and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            # Calls still running are cancelled when the session manager stops
+            super().handle_exit(sig, None)
     
-    return [TextContent(type="text", text="\n".join(plan_parts))]
+    loop = asyncio.get_running_loop()
+    app = Starlette(routes=[Route("/mcp", endpoint=Endpoint())], lifespan=lambda app: manager.run())
+    config = uvicorn.Config(app, host=host, port=port, log_level="warning", timeout_graceful_shutdown=SHUTDOWN_GRACE_SECONDS)
+    logger.info(f"Listening on http://{host}:{port}/mcp")
+    # uvicorn re-raises SIGTERM once it has stopped; leave through main()'s cleanup instead of dying on it
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    await DrainingServer(config).serve()
 
-async def main():
+async def main(transport: str = "stdio", host: str = "127.0.0.1", port: int = 8765):
     logger.info("Starting Enhanced Image Analysis MCP Server")
     
     # Check dependencies at startup
@@ -540,16 +4187,46 @@ async def main():
         print(f"Warning: PIL/Pillow not found. Limited functionality available.", file=sys.stderr)
         print(f"Install with: {sys.executable} -m pip install Pillow", file=sys.stderr)
     
-    async with stdio_server() as (read_stream, write_stream):
-        await server.run(
-            read_stream, 
-            write_stream, 
-            InitializationOptions(
-                server_name="enhanced-image-analysis-server", 
-                server_version="2.1.0", 
-                capabilities={}
-            )
-        )
+    watcher = None
+    if WATCH_ROOTS and image_server.cache is not None:
+        watcher = LibraryWatcher(image_server, WATCH_ROOTS)
+        watcher.start()
+    elif WATCH_ROOTS:
+        logger.warning("IMAGE_ANALYSIS_WATCH_ROOTS is ignored while the analysis cache is disabled")
+
+    dumper = StatsDumper(Path(STATS_FILE).expanduser()) if STATS_FILE else None
+    if dumper is not None:
+        dumper.start()
+    
+    jobs.start()
+
+    try:
+        if transport == "http":
+            await serve_http(host, port)
+        else:
+            async with stdio_server() as (read_stream, write_stream):
+                await server.run(
+                    read_stream, 
+                    write_stream, 
+                    InitializationOptions(
+                        server_name="enhanced-image-analysis-server", 
+                        server_version=SERVER_VERSION, 
+                        capabilities={}
+                    )
+                )
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        if dumper is not None:
+            dumper.stop()
+        jobs.stop()
+        shutdown_pools()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    import argparse
+    parser = argparse.ArgumentParser(description="Enhanced Image Analysis MCP Server")
+    parser.add_argument("--transport", choices=["stdio", "http"], default="stdio", help="stdio serves one client; http serves many from one warm process")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on with --transport http")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on with --transport http")
+    args = parser.parse_args()
+    asyncio.run(main(args.transport, args.host, args.port))
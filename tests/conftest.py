@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# The server reads its settings at import; keep its cache, journals and jobs out of the user's home
+os.environ.setdefault("IMAGE_ANALYSIS_CACHE_DIR", tempfile.mkdtemp(prefix="image-analysis-tests-"))
+os.environ.setdefault("IMAGE_ANALYSIS_WORKERS", "1")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
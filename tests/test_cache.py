@@ -0,0 +1,58 @@
+import pytest
+from PIL import Image
+
+import enhanced_image_analysis_server as server
+from enhanced_image_analysis_server import AnalysisCache, EnhancedImageAnalysisServer
+
+FILES = 6
+
+
+@pytest.fixture
+def library(tmp_path):
+    directory = tmp_path / "library"
+    directory.mkdir()
+    for i in range(FILES):
+        Image.new("RGB", (48 + i, 32), (30 * i, 90, 180 - 20 * i)).save(directory / f"img{i}.png")
+    return sorted(directory.iterdir())
+
+
+@pytest.fixture
+def analyzer(tmp_path):
+    cache = AnalysisCache(tmp_path / "cache")
+    yield EnhancedImageAnalysisServer(cache)
+    cache.close()
+
+
+def run_through_pool(analyzer, files, task):
+    results = list(analyzer.analyze_files(files, server.get_process_pool(), chunk_size=4, task=task))
+    assert [path for path, _ in results] == files
+    assert not any("error" in analysis for _, analysis in results)
+    return results
+
+
+def cached_parts(analyzer, path):
+    return set(analyzer.cache.get(path.stat()))
+
+
+def test_pooled_tasks_add_to_the_cached_record(analyzer, library):
+    run_through_pool(analyzer, library, "analysis")
+    colors = analyzer.cache.get(library[0].stat())["colors"]
+    run_through_pool(analyzer, library, "hashes")
+    for path in library:
+        assert {"header", "exif", "colors", "hashes"} <= cached_parts(analyzer, path)
+    assert analyzer.cache.get(library[0].stat())["colors"] == colors
+
+
+def test_put_merges_into_the_stored_record(analyzer, library):
+    stat = library[0].stat()
+    analyzer.cache.put(stat, {"header": {"width": 1}, "colors": [1]})
+    analyzer.cache.put(stat, {"colors": [2], "hashes": {"phash": "0"}})
+    assert analyzer.cache.get(stat) == {"header": {"width": 1}, "colors": [2], "hashes": {"phash": "0"}}
+
+
+@pytest.mark.parametrize("first, second", [("features", "hashes"), ("hashes", "features")])
+def test_similarity_and_duplicate_tasks_keep_each_others_parts(analyzer, library, first, second):
+    run_through_pool(analyzer, library, first)
+    run_through_pool(analyzer, library, second)
+    for path in library:
+        assert {"features", "hashes"} <= cached_parts(analyzer, path)
@@ -0,0 +1,35 @@
+import random
+from collections import Counter
+
+import pytest
+from PIL import Image
+
+import enhanced_image_analysis_server as server
+from enhanced_image_analysis_server import EnhancedImageAnalysisServer
+
+
+def reference_dominant_colors(img, bits, k=5):
+    """Bin every pixel, most frequent first and ties by colour, reported at the bin centre."""
+    shift = 8 - bits
+    counts = Counter()
+    for count, pixel in img.getcolors(img.width * img.height):
+        counts[tuple(v >> shift for v in pixel)] += count
+    top = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:k]
+    return [(count, tuple((v << shift) | (1 << (shift - 1)) for v in color)) for color, count in top]
+
+
+def noisy_image(seed):
+    rng = random.Random(seed)
+    img = Image.new("RGB", (60, 40))
+    # Repeated shades make ties and shared bins likely
+    img.putdata([tuple(rng.choice((rng.randrange(256), 17 * (i % 15))) for _ in range(3)) for i in range(60 * 40)])
+    return img
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_dominant_colors_match_per_pixel_binning(monkeypatch, numpy):
+    monkeypatch.setattr(server, "NUMPY_AVAILABLE", numpy and server.NUMPY_AVAILABLE)
+    analyzer = EnhancedImageAnalysisServer()
+    images = [noisy_image(seed) for seed in range(10)] + [Image.new("RGB", (8, 8), (255, 255, 255))]
+    for img in images:
+        assert analyzer.dominant_colors(img) == reference_dominant_colors(img, analyzer.color_bin_bits)
@@ -0,0 +1,48 @@
+import pytest
+from PIL import Image
+
+from enhanced_image_analysis_server import probe_image_header
+
+CASES = [
+    ("jpg", "JPEG", "RGB", (640, 480), {}),
+    ("jpg", "JPEG", "L", (17, 301), {}),
+    ("jpg", "JPEG", "RGB", (1200, 33), {"progressive": True}),
+    ("png", "PNG", "RGBA", (123, 45), {}),
+    ("png", "PNG", "P", (64, 64), {}),
+    ("gif", "GIF", "P", (300, 200), {}),
+    ("webp", "WEBP", "RGB", (250, 100), {"lossless": False}),
+    ("webp", "WEBP", "RGBA", (99, 77), {"lossless": True}),
+    ("bmp", "BMP", "RGB", (31, 17), {}),
+    ("tiff", "TIFF", "RGB", (80, 120), {}),
+    ("tif", "TIFF", "L", (5, 3), {"compression": "tiff_lzw"}),
+]
+
+
+@pytest.mark.parametrize("suffix, fmt, mode, size, options", CASES)
+def test_probe_matches_pillow(tmp_path, suffix, fmt, mode, size, options):
+    path = tmp_path / f"image.{suffix}"
+    image = Image.new(mode, size, 0)
+    if mode == "P":
+        image.putpalette([(i * 7) % 256 for i in range(768)])
+    image.save(path, fmt, **options)
+
+    probed = probe_image_header(path)
+
+    with Image.open(path) as opened:
+        assert probed is not None
+        assert (probed["format"], probed["width"], probed["height"]) == (opened.format, opened.width, opened.height)
+        if probed["mode"] is not None:
+            assert probed["mode"] == opened.mode
+
+
+def test_probe_rejects_mismatched_extension(tmp_path):
+    path = tmp_path / "image.jpg"
+    Image.new("RGB", (10, 10)).save(path, "PNG")
+    assert probe_image_header(path) is None
+
+
+def test_probe_rejects_truncated_file(tmp_path):
+    path = tmp_path / "image.png"
+    Image.new("RGB", (10, 10)).save(path, "PNG")
+    path.write_bytes(path.read_bytes()[:20])
+    assert probe_image_header(path) is None
@@ -0,0 +1,113 @@
+import json
+import socket
+import subprocess
+import sys
+
+import pytest
+from PIL import Image
+
+import enhanced_image_analysis_server as server
+from enhanced_image_analysis_server import JobQueue, ToolRun
+
+FILES = 12
+
+
+@pytest.fixture
+def library(tmp_path):
+    directory = tmp_path / "library"
+    directory.mkdir()
+    for i in range(FILES):
+        Image.new("RGB", (40 + i, 30), (20 * i, 100, 200 - 10 * i)).save(directory / f"img{i:02}.png")
+    return directory
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "JOB_CHUNK_FILES", 4)
+    return JobQueue(tmp_path / "jobs")
+
+
+def run_next(queue, stop_after=None):
+    """Claim and run the next job; with ``stop_after``, stop once that many files are checkpointed, as a crash would."""
+    job = queue._claim()
+    assert job is not None
+    run = ToolRun()
+    if stop_after is not None:
+        count = queue._count
+
+        def counting(totals, record):
+            count(totals, record)
+            if totals["processed"] >= stop_after:
+                run.cancelled.set()
+        queue._count = counting
+    queue._execute_job(job, run)
+    return queue.get(job["id"])
+
+
+def set_owner(queue, job_id, owner, updated):
+    queue._execute("UPDATE jobs SET owner=?, updated=? WHERE id=?", (owner, updated, job_id))
+
+
+def dead_pid():
+    child = subprocess.Popen([sys.executable, "-c", ""])
+    child.wait()
+    return child.pid
+
+
+def all_results(queue, job):
+    records, offset = [], 0
+    while offset is not None:
+        page, offset = queue.results(job, offset, 5)
+        records.extend(page)
+    return records
+
+
+def test_resume_after_dead_owner(tmp_path, library, queue):
+    job = queue.submit("ai_analyze_directory_images", {"directory_path": str(library), "naming_style": "technical"})
+    job = run_next(queue, stop_after=6)
+    assert (job["state"], job["done"], job["total"]) == ("running", 6, FILES)
+    # The owner died after writing a record and half of another past its last checkpoint
+    with open(tmp_path / "jobs" / f"{job['id']}.jsonl", "ab") as results:
+        results.write(json.dumps({"path": str(library / "img06.png"), "original": "img06.png", "suggested": "x.png"}).encode() + b"\n{\"path\": ")
+    set_owner(queue, job["id"], f"{socket.gethostname()}:{dead_pid()}", 0)
+
+    job = run_next(JobQueue(tmp_path / "jobs"))
+
+    assert (job["state"], job["done"], job["totals"]["processed"]) == ("completed", FILES, FILES)
+    paths = [record["path"] for record in all_results(queue, job)]
+    assert sorted(paths) == sorted(str(path) for path in library.iterdir())
+    suggested = [record["suggested"] for record in all_results(queue, job)]
+    assert len(set(suggested)) == FILES
+
+
+def test_live_owner_on_this_host_keeps_a_stale_lease(library, queue):
+    job = queue.submit("organize_images_by_content", {"directory_path": str(library)})
+    owner = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    try:
+        queue._execute("UPDATE jobs SET state='running' WHERE id=?", (job["id"],))
+        set_owner(queue, job["id"], f"{socket.gethostname()}:{owner.pid}", 0)
+        assert queue._claim() is None
+    finally:
+        owner.kill()
+        owner.wait()
+    assert queue._claim()["id"] == job["id"]
+
+
+def test_other_host_is_taken_over_once_its_lease_lapses(library, queue):
+    job = queue.submit("organize_images_by_content", {"directory_path": str(library)})
+    queue._execute("UPDATE jobs SET state='running' WHERE id=?", (job["id"],))
+    set_owner(queue, job["id"], "some-other-host:1", server.time.time())
+    assert queue._claim() is None
+    set_owner(queue, job["id"], "some-other-host:1", server.time.time() - server.JOB_LEASE_SECONDS - 1)
+    assert queue._claim()["id"] == job["id"]
+
+
+def test_results_reject_a_cursor_inside_a_record(library, queue):
+    queue.submit("organize_images_by_content", {"directory_path": str(library), "organization_method": "size"})
+    job = run_next(queue)
+    page, offset = queue.results(job, 0, 2)
+    assert len(page) == 2 and offset is not None
+    assert queue.results(job, offset, 100)[0][0]["path"] == str(library / "img02.png")
+    for bad in (offset - 1, offset + 1, -1):
+        with pytest.raises(ValueError, match="Invalid cursor"):
+            queue.results(job, bad, 10)
@@ -0,0 +1,66 @@
+import asyncio
+import threading
+
+import pytest
+from PIL import Image
+
+import enhanced_image_analysis_server as server
+from enhanced_image_analysis_server import ToolRun, analyze_image_files
+
+
+class RecordingSession:
+    def __init__(self):
+        self.notifications = []
+
+    async def send_progress_notification(self, token, progress, total, message):
+        self.notifications.append((progress, total, message))
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def notifications(loop, session):
+    # Notifications are scheduled on the loop; wait for them to be sent
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result(5)
+    return session.notifications
+
+
+# Fewer files than the discovery look-ahead, and more, so the total is only known at the end
+@pytest.mark.parametrize("files", [5, server.PARALLEL_MIN_FILES + 11])
+def test_streamed_analysis_ends_with_the_total(tmp_path, loop, files):
+    for i in range(files):
+        Image.new("RGB", (16, 16), (i, 80, 160)).save(tmp_path / f"photo_{i:02}.png")
+    session = RecordingSession()
+    run = ToolRun(loop, session, "token", interval=60)
+
+    analysed = list(analyze_image_files(sorted(tmp_path.iterdir()), run))
+
+    assert len(analysed) == files
+    sent = notifications(loop, session)
+    assert sent[-1][:2] == (files, files)
+    assert sum(done == files for done, _, _ in sent) == 1
+
+
+def test_cancelled_analysis_does_not_report_completion(tmp_path, loop):
+    for i in range(3):
+        Image.new("RGB", (16, 16), (i, 80, 160)).save(tmp_path / f"photo_{i}.png")
+    session = RecordingSession()
+    run = ToolRun(loop, session, "token", interval=60)
+    run.cancelled.set()
+
+    assert list(analyze_image_files(sorted(tmp_path.iterdir()), run)) == []
+    assert notifications(loop, session) == []
+
+
+@pytest.mark.parametrize("output_format, reply", [("text", "Error: progress_interval must be a number of seconds, got 'abc'"), ("json", '{"error":"progress_interval must be a number of seconds, got \'abc\'"}')])
+def test_bad_progress_interval_is_a_tool_error(output_format, reply):
+    result = asyncio.run(server.handle_call_tool("server_stats", {"progress_interval": "abc", "output_format": output_format}))
+    assert result[0].text == reply
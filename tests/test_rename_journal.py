@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from enhanced_image_analysis_server import RenameJournal, RenamePlan, move_no_replace
+
+
+def make_batch(tmp_path, count=4):
+    library = tmp_path / "library"
+    library.mkdir()
+    moves = []
+    for i in range(count):
+        source = library / f"img{i}.jpg"
+        source.write_bytes(f"image {i}".encode())
+        moves.append((source, library / "sorted" / f"renamed{i}.jpg"))
+    return library, moves
+
+
+def interrupted(library, moves, journal_root, stop_after):
+    """Apply a batch until ``stop_after`` moves are logged, then reopen it from disk as a restart would."""
+    journal = RenameJournal.create("test", library, moves, directory_root=journal_root)
+    journal.apply(cancelled=lambda: len(journal.done) >= stop_after)
+    return RenameJournal.open(journal.id, journal_root)
+
+
+def test_move_no_replace_never_overwrites(tmp_path):
+    source, target = tmp_path / "a.jpg", tmp_path / "b.jpg"
+    source.write_bytes(b"source")
+    target.write_bytes(b"target")
+    with pytest.raises(FileExistsError):
+        move_no_replace(source, target)
+    assert source.read_bytes() == b"source" and target.read_bytes() == b"target"
+
+    target.unlink()
+    move_no_replace(source, target)
+    assert not source.exists() and target.read_bytes() == b"source"
+
+
+def test_apply_and_rollback(tmp_path):
+    library, moves = make_batch(tmp_path)
+    journal = RenameJournal.create("test", library, moves, directory_root=tmp_path / "journals")
+
+    moved, errors = journal.apply()
+    assert (moved, errors) == ([0, 1, 2, 3], [])
+    assert all(target.exists() and not source.exists() for source, target in moves)
+
+    restored, errors = RenameJournal.open(journal.id, tmp_path / "journals").rollback()
+    assert (sorted(restored), errors) == ([0, 1, 2, 3], [])
+    assert all(source.exists() for source, _ in moves)
+    assert not (library / "sorted").exists()
+
+
+def test_resume_after_crash(tmp_path):
+    library, moves = make_batch(tmp_path)
+    journal = interrupted(library, moves, tmp_path / "journals", stop_after=1)
+    assert journal.state == "planned" and journal.done == {0}
+    # Crash after move 1 happened but before it was logged, and halfway through move 2
+    os.rename(*moves[1])
+    os.link(*moves[2])
+
+    moved, errors = journal.apply()
+
+    assert (moved, errors) == ([1, 2, 3], [])
+    assert all(target.read_bytes() == f"image {i}".encode() and not source.exists() for i, (source, target) in enumerate(moves))
+    assert RenameJournal.open(journal.id, tmp_path / "journals").state == "applied"
+
+
+def test_rollback_after_crash(tmp_path):
+    library, moves = make_batch(tmp_path)
+    journal = interrupted(library, moves, tmp_path / "journals", stop_after=2)
+    os.rename(*moves[2])
+
+    restored, errors = journal.rollback()
+
+    assert (sorted(restored), errors) == ([0, 1, 2], [])
+    assert all(source.read_bytes() == f"image {i}".encode() for i, (source, _) in enumerate(moves))
+    assert not (library / "sorted").exists()
+    with pytest.raises(ValueError):
+        RenameJournal.open(journal.id, tmp_path / "journals").apply()
+
+
+def test_target_taken_after_planning(tmp_path):
+    library, moves = make_batch(tmp_path, count=2)
+    journal = RenameJournal.create("test", library, moves, directory_root=tmp_path / "journals")
+    moves[1][1].parent.mkdir()
+    moves[1][1].write_bytes(b"someone else's file")
+
+    moved, errors = journal.apply()
+
+    assert moved == [0] and [i for i, _ in errors] == [1]
+    assert moves[1][0].exists() and moves[1][1].read_bytes() == b"someone else's file"
+
+
+def test_plan_keeps_only_files_a_journal_renamed(tmp_path):
+    library, journals = tmp_path / "library", tmp_path / "journals"
+    library.mkdir()
+    for name in ("IMG_2041.jpg", "sunset_2019.jpg", "photo.jpg"):
+        (library / name).write_bytes(name.encode())
+    journal = RenameJournal.create("test", library, [(library / "photo.jpg", library / "sunset_1.jpg")], directory_root=journals)
+    journal.apply()
+
+    plan = RenamePlan(journals)
+    # Looks numbered but was never renamed by a plan
+    assert plan.reserve(library / "IMG_2041.jpg", library, "img.jpg") == library / "img.jpg"
+    assert plan.reserve(library / "sunset_2019.jpg", library, "sunset.jpg") == library / "sunset.jpg"
+    assert plan.reserve(library / "sunset_1.jpg", library, "sunset.jpg") == library / "sunset_1.jpg"
+
+    # Once rolled back, a file that later takes the same name is not the plan's
+    RenameJournal.open(journal.id, journals).rollback()
+    (library / "sunset_1.jpg").write_bytes(b"other")
+    assert RenamePlan(journals).reserve(library / "sunset_1.jpg", library, "sunset.jpg") == library / "sunset.jpg"
@@ -0,0 +1,36 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+from PIL import Image
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+
+import enhanced_image_analysis_server as server
+
+SCRIPT = Path(server.__file__).resolve()
+# Enough files that the directory tools hand them to the process pool
+FILES = server.PARALLEL_MIN_FILES + 8
+
+
+async def call_over_stdio(tool, arguments, env, timeout=60):
+    params = StdioServerParameters(command=sys.executable, args=[str(SCRIPT)], env=env)
+    async with stdio_client(params) as (read_stream, write_stream):
+        async with ClientSession(read_stream, write_stream) as session:
+            await session.initialize()
+            result = await asyncio.wait_for(session.call_tool(tool, arguments), timeout)
+    return result.content[0].text
+
+
+def test_pooled_tools_answer_over_stdio(tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    for i in range(FILES):
+        Image.new("RGB", (64 + i, 48), (5 * i, 100, 200 - 4 * i)).save(library / f"photo_{i:02}.jpg")
+    env = dict(os.environ, IMAGE_ANALYSIS_WORKERS="2", IMAGE_ANALYSIS_CACHE_DIR=str(tmp_path / "cache"))
+
+    text = asyncio.run(call_over_stdio("ai_analyze_directory_images", {"directory_path": str(library)}, env))
+    assert f"[{FILES}/{FILES}]" in text
+    text = asyncio.run(call_over_stdio("find_duplicate_images", {"directory_path": str(library), "output_format": "json"}, env))
+    assert not text.startswith("Error")
@@ -0,0 +1,20 @@
+import os
+
+import pytest
+
+from enhanced_image_analysis_server import EnhancedImageAnalysisServer
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink") or os.name == "nt", reason="needs POSIX symlinks")
+def test_directory_reached_through_a_symlink_is_walked_once(tmp_path):
+    real = tmp_path / "a_real" / "sub"
+    real.mkdir(parents=True)
+    (tmp_path / "a_real" / "x.jpg").write_bytes(b"")
+    (real / "y.png").write_bytes(b"")
+    (tmp_path / "z").mkdir()
+    (tmp_path / "z" / "link").symlink_to(tmp_path / "a_real")
+    (real / "loop").symlink_to(tmp_path)
+
+    found = [os.path.relpath(path, tmp_path) for path in EnhancedImageAnalysisServer().iter_image_files(tmp_path, True)]
+
+    assert sorted(found) == [os.path.join("a_real", "sub", "y.png"), os.path.join("a_real", "x.jpg")]